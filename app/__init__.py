@@ -1,8 +1,9 @@
 # app/__init__.py
 import os
 import logging
+from contextlib import contextmanager
 from pytz import utc
-from flask import Flask
+from flask import Flask, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
@@ -20,14 +21,23 @@ login_manager = LoginManager()
 scheduler = BackgroundScheduler(daemon=True, timezone=utc)
 mail = Mail()
 
+# Приложение, в контексте которого выполняются фоновые задачи (планировщик, воркер).
+# Создается один раз и переиспользуется всеми запусками задач — без create_app на каждый запуск.
+_task_app = None
+
 # Настройка для Flask-Login:
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Пожалуйста, войдите, чтобы получить доступ к этой странице.'
 login_manager.login_message_category = 'info'
 
-def create_app(test_config=None):
-    """Фабрика для создания экземпляра приложения Flask."""
+def create_app(test_config=None, start_scheduler=True):
+    """
+    Фабрика для создания экземпляра приложения Flask.
+    start_scheduler=False — для отдельных процессов (worker.py), которым планировщик не нужен.
+    """
     
+    global _task_app
+
     app = Flask(__name__)
     if test_config is None:
         # Обычный запуск
@@ -79,25 +89,95 @@ def create_app(test_config=None):
     from .routes_admin import admin_bp
     app.register_blueprint(admin_bp, url_prefix='/admin')
 
+    # Команды обслуживания: flask media-shard
+    from .media import shard_media_command
+    app.cli.add_command(shard_media_command)
+
+    # --- Создание БД (если нужно) и новые колонки в существующих таблицах ---
+    with app.app_context():
+        db.create_all()
+        from app.schema import upgrade_schema
+        upgrade_schema()
+
     # --- Запуск планировщика ---
-    if not scheduler.running:
+    if start_scheduler and not scheduler.running:
+        # Планировщик есть в каждом процессе (gunicorn-воркеры, хосты), поэтому задачи
+        # хранятся в памяти процесса: общее хранилище APScheduler несколько
+        # планировщиков делить не умеют. Задачи только периодические — хранить
+        # между рестартами нечего, а один запуск на кластер обеспечивает leader_only.
+        scheduler.configure(
+            job_defaults={
+                'misfire_grace_time': app.config.get('SCHEDULER_MISFIRE_GRACE_SECONDS', 3600),
+                'coalesce': True
+            }
+        )
         scheduler.start()
         
         from app.services_rss import parse_rss_feeds
-        from app.services import check_expired_tariffs
+        from app.services import check_expired_tariffs, prestage_media
+        from app.services_queue import dispatch_due_posts
+        from app.leader import leader_heartbeat
+        from app.media import cleanup_stale_uploads, collect_media_garbage
+
+        # Диспетчер публикаций: одна задача вместо отдельной задачи на каждый пост.
+        # Работает только в процессе-лидере. Если посты публикуют отдельные воркеры
+        # (worker.py, несколько штук — только на PostgreSQL), диспетчер не нужен.
+        if not app.config.get('PUBLISH_WORKER_ENABLED'):
+            scheduler.add_job(id='dispatcher_job', func=dispatch_due_posts, trigger='interval',
+                              seconds=app.config.get('DISPATCHER_INTERVAL_SECONDS', 5),
+                              replace_existing=True)
         
-        # Добавляем задачу проверки RSS каждые 15 минут
-        if not scheduler.get_job('rss_job'):
-            scheduler.add_job(id='rss_job', func=parse_rss_feeds, trigger='interval', minutes=15)
+        # Аренда лидера: RSS и биллинг выполняет только процесс-лидер (см. app/leader.py)
+        scheduler.add_job(id='leader_heartbeat_job', func=leader_heartbeat, trigger='interval',
+                          seconds=app.config.get('LEADER_HEARTBEAT_SECONDS', 20),
+                          replace_existing=True)
+
+        # Опрос RSS: каждую минуту опрашиваются только ленты, которым подошло время
+        # (у каждой ленты свой интервал, см. app/services_rss.py)
+        scheduler.add_job(id='rss_job', func=parse_rss_feeds, trigger='interval',
+                          seconds=app.config.get('RSS_POLL_TICK_SECONDS', 60), replace_existing=True)
             
         # Биллинг раз в час (или раз в сутки)
-        if not scheduler.get_job('billing_job'):
-            scheduler.add_job(id='billing_job', func=check_expired_tariffs, trigger='interval', hours=1)            
+        scheduler.add_job(id='billing_job', func=check_expired_tariffs, trigger='interval', hours=1,
+                          replace_existing=True)
+        
+        # Предзагрузка медиа отложенных постов (к scheduled_at остается только сам пост)
+        if app.config.get('MEDIA_PRESTAGE_MINUTES'):
+            scheduler.add_job(id='prestage_job', func=prestage_media, trigger='interval',
+                              seconds=app.config.get('MEDIA_PRESTAGE_INTERVAL_SECONDS', 60),
+                              replace_existing=True)
+        
+        # Брошенные загрузки по частям (недокачанные файлы в UPLOAD_FOLDER)
+        scheduler.add_job(id='uploads_cleanup_job', func=cleanup_stale_uploads, trigger='interval', hours=1,
+                          replace_existing=True)
+        
+        # Сборка мусора в UPLOAD_FOLDER: файлы, на которые не ссылается ни один пост
+        scheduler.add_job(id='media_gc_job', func=collect_media_garbage, trigger='interval',
+                          hours=app.config.get('MEDIA_GC_INTERVAL_HOURS', 6), replace_existing=True)
         
         logging.info("Планировщик APScheduler запущен.")
 
-    # --- Создание БД (если нужно) ---
-    with app.app_context():
-        db.create_all()
+    # Фоновые задачи этого процесса работают в контексте этого приложения
+    _task_app = app
+
+    return app
+
+def get_task_app():
+    """Возвращает общее приложение для фоновых задач (создает его при первом обращении)."""
+    global _task_app
+    if _task_app is None:
+        _task_app = create_app(start_scheduler=False)
+    return _task_app
 
-    return app
\ No newline at end of file
+@contextmanager
+def task_context():
+    """
+    Контекст для фоновых задач.
+    Если app_context уже активен (вызов из другой задачи или из тестов) — используем его,
+    иначе поднимаем контекст общего приложения. Сессия БД закрывается при выходе из контекста.
+    """
+    if has_app_context():
+        yield
+        return
+    with get_task_app().app_context():
+        yield
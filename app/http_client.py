@@ -0,0 +1,99 @@
+# app/http_client.py
+import os
+import threading
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ОБЩИЕ HTTP-СЕССИИ (KEEP-ALIVE + ПУЛ СОЕДИНЕНИЙ)
+# --------------------------------------------------------------------------
+# Вместо requests.post/get (новое TCP+TLS соединение на каждый запрос) все
+# обращения к API соцсетей идут через общие сессии — по одной на хост.
+# Соединения переиспользуются между постами и потоками.
+#
+# Повторы: ошибки соединения (запрос еще не ушел) повторяются для любых методов,
+# ошибки чтения и 5xx — только для идемпотентных (GET/HEAD/...). POST в API
+# соцсетей повторно не отправляется: это привело бы к дублям постов.
+# Для запросов с собственным лимитом времени (ленты RSS) повторы отключаются
+# параметром retries=0 — у них отдельная сессия без повторов.
+
+# Значения по умолчанию (если нет app_context или ключа в конфиге)
+DEFAULTS = {
+    'HTTP_POOL_CONNECTIONS': 10,
+    'HTTP_POOL_MAXSIZE': 20,
+    'HTTP_RETRIES': 3,
+    'HTTP_RETRY_BACKOFF': 0.5,
+    'HTTP_TIMEOUT_SECONDS': 30,
+}
+
+_sessions = {}
+_lock = threading.Lock()
+# PID процесса, создавшего сессии: после fork (gunicorn) сокеты родителя не используем
+_owner_pid = os.getpid()
+
+def _setting(key):
+    if has_app_context():
+        return current_app.config.get(key, DEFAULTS[key])
+    return DEFAULTS[key]
+
+def _make_retry(retries=None):
+    if retries is None:
+        retries = _setting('HTTP_RETRIES')
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=_setting('HTTP_RETRY_BACKOFF'),
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False
+    )
+
+def configure_session(session, retries=None):
+    """Подключает к сессии пул соединений и политику повторов (retries=None — HTTP_RETRIES)."""
+    adapter = HTTPAdapter(
+        pool_connections=_setting('HTTP_POOL_CONNECTIONS'),
+        pool_maxsize=_setting('HTTP_POOL_MAXSIZE'),
+        max_retries=_make_retry(retries)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def session_for(url, session_class=requests.Session, retries=None):
+    """Общая сессия для хоста из `url` (создается при первом обращении)."""
+    global _owner_pid
+    parts = urlsplit(url)
+    key = (session_class, parts.scheme, parts.netloc, retries)
+
+    with _lock:
+        if _owner_pid != os.getpid():
+            _sessions.clear()
+            _owner_pid = os.getpid()
+
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = configure_session(session_class(), retries)
+    return session
+
+def request(method, url, retries=None, **kwargs):
+    """
+    Как requests.request, но через общую сессию хоста и с таймаутом по умолчанию.
+    retries — число повторов вместо HTTP_RETRIES (0 — без повторов).
+    """
+    kwargs.setdefault('timeout', _setting('HTTP_TIMEOUT_SECONDS'))
+    return session_for(url, retries=retries).request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
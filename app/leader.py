@@ -0,0 +1,116 @@
+# app/leader.py
+import os
+import atexit
+import socket
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from app import db, task_context
+from app.models import SchedulerLock
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ВЫБОР ЛИДЕРА ДЛЯ ПЕРИОДИЧЕСКИХ ЗАДАЧ
+# --------------------------------------------------------------------------
+# Планировщик запускается в каждом gunicorn-воркере на каждом хосте, но задачи
+# вроде RSS и биллинга должны выполняться один раз на весь кластер.
+# Лидер — процесс, который держит аренду (строка в scheduler_locks).
+# Аренда продлевается задачей leader_heartbeat каждые LEADER_HEARTBEAT_SECONDS;
+# если лидер умер, через LEADER_LEASE_SECONDS ее забирает другой процесс.
+
+LEADER_LOCK_NAME = 'scheduler'
+
+# Держит ли этот процесс аренду (чтобы при выходе отдавать только свою)
+_is_holder = False
+
+def holder_id():
+    """ID этого процесса: хост + PID (вычисляется при вызове — gunicorn форкает воркеры)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_lock(name, holder, lease_seconds):
+    """
+    Захватывает или продлевает аренду `name` для `holder`.
+    Возвращает True, если аренда наша. Требует app_context.
+    """
+    table = SchedulerLock.__table__
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=lease_seconds)
+
+    # Продлеваем свою аренду или забираем истекшую (одним атомарным UPDATE)
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            table.update()
+            .where(table.c.name == name,
+                   or_(table.c.holder == holder, table.c.expires_at < now))
+            .values(holder=holder, expires_at=expires_at)
+        ).rowcount
+    if updated:
+        return True
+
+    # Строки еще нет — создаем. Если ее одновременно создал другой процесс, лидер он.
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(name=name, holder=holder, expires_at=expires_at))
+        return True
+    except IntegrityError:
+        return False
+
+def release_lock(name, holder):
+    """Отдает аренду, если она наша (при остановке процесса)."""
+    table = SchedulerLock.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.name == name, table.c.holder == holder))
+
+def is_leader():
+    """Является ли этот процесс лидером (заодно продлевает аренду). Требует app_context."""
+    global _is_holder
+    lease_seconds = current_app.config.get('LEADER_LEASE_SECONDS', 60)
+    try:
+        leader = acquire_lock(LEADER_LOCK_NAME, holder_id(), lease_seconds)
+    except Exception as e:
+        # Без БД лидерство не подтвердить — лучше пропустить запуск, чем выполнить его N раз
+        logger.error(f"Leader: ошибка аренды: {e}")
+        leader = False
+
+    if leader and not _is_holder:
+        logger.info(f"Leader: {holder_id()} стал лидером периодических задач.")
+    _is_holder = leader
+    return leader
+
+def is_holder():
+    """Держал ли этот процесс аренду при последней проверке (без обращения к БД)."""
+    return _is_holder
+
+def leader_heartbeat():
+    """Периодическая задача: продлевает аренду лидера (или забирает ее у умершего)."""
+    with task_context():
+        is_leader()
+
+def leader_only(func):
+    """
+    Декоратор для периодических задач: выполняет задачу, только если этот процесс — лидер.
+    В остальных процессах запуск молча пропускается.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with task_context():
+            if not is_leader():
+                return None
+        return func(*args, **kwargs)
+    return wrapper
+
+@atexit.register
+def _release_on_exit():
+    """При штатной остановке процесса отдаем лидерство сразу, не дожидаясь истечения аренды."""
+    if not _is_holder:
+        return
+    try:
+        with task_context():
+            release_lock(LEADER_LOCK_NAME, holder_id())
+    except Exception:
+        pass
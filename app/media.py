@@ -0,0 +1,668 @@
+# app/media.py
+import os
+import re
+from collections import defaultdict
+import uuid
+import hashlib
+import logging
+import mimetypes
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, exists, union
+from sqlalchemy.exc import IntegrityError
+
+from app import db, task_context
+from app.leader import leader_only
+from app.models import MediaFile, MediaUpload, MediaUploadChunk, MediaUploadCache, MediaUsage, Post, PostMedia
+from app.media_processing import schedule_variants, remove_variants, image_size
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ХРАНИЛИЩЕ МЕДИА С АДРЕСАЦИЕЙ ПО СОДЕРЖИМОМУ
+# --------------------------------------------------------------------------
+# Файл в UPLOAD_FOLDER называется <sha256><расширение>: одинаковые картинки
+# (повторно загруженный логотип, одна и та же картинка RSS) хранятся один раз.
+# Файлы разложены по подпапкам из первых символов имени: ab/cd/abcd...jpg
+# (в одной папке не скапливаются сотни тысяч файлов). В Post.media_files
+# хранится только имя, путь дает media_path(). Старые файлы из корня
+# UPLOAD_FOLDER переносит команда `flask media-shard`.
+# Таблица media_files считает ссылки из Post.media_files: файл удаляется с
+# диска, только когда удален последний пост, который на него ссылается.
+# Объем (media_usage) засчитывается каждому проекту, посты которого ссылаются
+# на файл, один раз на проект; файл, еще не попавший в пост, — проекту, который
+# его загрузил. Строка project_id=0 — физический объем хранилища.
+#
+# Жизненный цикл:
+#   store_chunks() / store_stream() / store_file() — сохранить файл (хеш считается при записи)
+#     и поставить подготовку вариантов под соцсети (app/media_processing.py)
+#   acquire_media() — пост начал ссылаться на файлы (до commit поста)
+#   release_media() — пост удален (до commit), затем unlink_media() после commit
+#   start_upload() / write_chunk() / finish_upload() — то же для загрузки по частям
+
+CHUNK_SIZE = 64 * 1024
+
+def _upload_folder():
+    return current_app.config['UPLOAD_FOLDER']
+
+def media_relpath(filename):
+    """Путь файла относительно UPLOAD_FOLDER (он же путь в URL /static/uploads/...)."""
+    return f"{filename[:2]}/{filename[2:4]}/{filename}"
+
+def media_path(filename):
+    """Полный путь к файлу хранилища (или к старому файлу в корне, если он еще не перенесен)."""
+    folder = _upload_folder()
+    path = os.path.join(folder, *media_relpath(filename).split('/'))
+    if not os.path.exists(path):
+        legacy_path = os.path.join(folder, filename)
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path
+
+def media_filename(sha256, original_name):
+    ext = os.path.splitext(original_name or '')[1].lower()
+    return f"{sha256}{ext}"
+
+def store_chunks(chunks, original_name, project_id=None):
+    """
+    Сохраняет файл из итератора байтовых кусков в UPLOAD_FOLDER и возвращает его имя.
+    SHA-256 считается во время записи во временный файл, затем файл переименовывается
+    в <sha256><ext>. Если такой файл уже есть, временный просто удаляется.
+    Новый файл засчитывается в объем проекта project_id (media_usage).
+    Ссылку на файл нужно учесть через acquire_media().
+    """
+    tmp_path = os.path.join(_upload_folder(), f".tmp-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    size = 0
+
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        return _store_tmp(tmp_path, digest.hexdigest(), size, original_name, project_id)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _store_tmp(tmp_path, sha256, size, original_name, project_id=None):
+    """Переносит готовый временный файл в хранилище под именем <sha256><ext>."""
+    filename = media_filename(sha256, original_name)
+    final_path = media_path(filename)
+
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+        # Файл снова в деле: сборщик мусора не тронет его в течение MEDIA_GC_GRACE_HOURS
+        os.utime(final_path)
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+
+    _ensure_record(filename, sha256, size, final_path, project_id)
+    schedule_variants(final_path)
+    return filename
+
+def store_stream(stream, original_name, project_id=None):
+    """store_chunks() для file-like объекта с .read()."""
+    return store_chunks(iter(lambda: stream.read(CHUNK_SIZE), b''), original_name, project_id)
+
+def store_file(file_storage, project_id=None):
+    """Сохраняет загруженный через форму файл (werkzeug FileStorage)."""
+    return store_stream(file_storage.stream, file_storage.filename, project_id)
+
+def file_size(file_storage):
+    """Размер загруженного через форму файла (werkzeug FileStorage) без чтения в память."""
+    stream = file_storage.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def _ensure_record(filename, sha256, size, path, project_id=None):
+    """
+    Создает запись о файле (ref_count=0) с метаданными, если ее еще нет,
+    и прибавляет файл к итогам сервиса и загрузившего проекта. Отдельная транзакция.
+    """
+    table = MediaFile.__table__
+    try:
+        with db.engine.begin() as conn:
+            exists = conn.execute(
+                table.select().where(table.c.filename == filename)
+            ).first()
+            if exists is None:
+                width, height = image_size(path)
+                conn.execute(table.insert().values(filename=filename, sha256=sha256, size=size,
+                                                   mime=mimetypes.guess_type(filename)[0],
+                                                   width=width, height=height,
+                                                   project_id=project_id, ref_count=0))
+                change_usage(conn, project_id, 1, size)
+    except IntegrityError:
+        # Тот же файл одновременно сохранил другой процесс
+        pass
+
+def change_usage(conn, project_id, files, size, total=True):
+    """
+    Прибавляет files/size к итогам проекта и (total=True) всего сервиса (project_id=0).
+    conn — соединение внутри транзакции (db.engine.begin() или db.session.connection()).
+    """
+    table = MediaUsage.__table__
+    keys = {0, project_id or 0} if total else {project_id} if project_id else set()
+    for key in keys:
+        values = dict(files_count=table.c.files_count + files, total_bytes=table.c.total_bytes + size)
+        if conn.execute(table.update().where(table.c.project_id == key).values(**values)).rowcount:
+            continue
+        try:
+            with conn.begin_nested():
+                conn.execute(table.insert().values(project_id=key, files_count=files, total_bytes=size))
+        except IntegrityError:
+            # Строку итогов одновременно создал другой процесс
+            conn.execute(table.update().where(table.c.project_id == key).values(**values))
+
+def _project_files(project_id, names, exclude_posts=None):
+    """Какие из файлов names уже есть в постах проекта (кроме постов exclude_posts)."""
+    query = db.session.query(PostMedia.filename).join(Post, Post.id == PostMedia.post_id)\
+        .filter(Post.project_id == project_id, PostMedia.filename.in_(names))
+    if exclude_posts is not None:
+        query = query.filter(~PostMedia.post_id.in_(exclude_posts))
+    return {name for (name,) in query.distinct()}
+
+def _charge_project(project_id, filenames):
+    """Прибавляет к итогам проекта файлы, на которые в его постах еще нет ссылок."""
+    names = set(filenames or [])
+    if not project_id or not names:
+        return
+    conn = db.session.connection()
+    held = _project_files(project_id, names)
+    for record in MediaFile.query.filter(MediaFile.filename.in_(names - held)):
+        if record.ref_count == 0:
+            if record.project_id == project_id:
+                continue  # своя загрузка: уже засчитана при сохранении
+            # Чужая загрузка попадает в пост: загрузившему проекту она больше не засчитывается
+            change_usage(conn, record.project_id, -1, -record.size, total=False)
+        change_usage(conn, project_id, 1, record.size, total=False)
+
+def _uncharge_projects(files_by_project, sizes, exclude_posts):
+    """Вычитает из итогов проектов файлы, на которые у них не осталось других постов."""
+    conn = db.session.connection()
+    for project_id, names in files_by_project.items():
+        names = set(names) & sizes.keys()
+        if not project_id or not names:
+            continue
+        for name in names - _project_files(project_id, names, exclude_posts):
+            change_usage(conn, project_id, -1, -sizes[name], total=False)
+
+def acquire_media(filenames, post=None):
+    """
+    Увеличивает счетчики ссылок (в текущей сессии, commit делает вызывающий).
+    Если передан пост, его файлы записываются в индекс post_media
+    и засчитываются в объем проекта поста.
+    """
+    if post is not None:
+        _charge_project(post.project_id, filenames)
+    for name in filenames or []:
+        MediaFile.query.filter_by(filename=name)\
+            .update({'ref_count': MediaFile.ref_count + 1}, synchronize_session=False)
+    if post is not None:
+        post.media_refs = [PostMedia(position=i, filename=name) for i, name in enumerate(filenames or [])]
+
+def _release_refs(filenames, sizes):
+    """Уменьшает счетчики ссылок; размеры файлов складывает в sizes. Возвращает осиротевшие файлы."""
+    orphaned = []
+    for name in filenames or []:
+        record = MediaFile.query.filter_by(filename=name).first()
+        if record is None:
+            orphaned.append(name)
+            continue
+        sizes[name] = record.size
+
+        MediaFile.query.filter_by(filename=name)\
+            .update({'ref_count': MediaFile.ref_count - 1}, synchronize_session=False)
+        db.session.refresh(record)
+        if record.ref_count <= 0:
+            change_usage(db.session.connection(), None, -1, -record.size)
+            db.session.delete(record)
+            orphaned.append(name)
+    return orphaned
+
+def release_media(filenames, post=None):
+    """
+    Уменьшает счетчики ссылок (в текущей сессии, commit делает вызывающий).
+    Возвращает имена файлов, на которые больше никто не ссылается, —
+    их нужно удалить с диска через unlink_media() после commit.
+    Если передан удаляемый пост, его файлы вычитаются из объема проекта.
+    Старые файлы (с uuid-именами, без записи в media_files) принадлежат одному посту
+    и тоже возвращаются на удаление.
+    """
+    sizes = {}
+    orphaned = _release_refs(filenames, sizes)
+    if post is not None:
+        _uncharge_projects({post.project_id: filenames or []}, sizes, [post.id])
+    return orphaned
+
+def release_posts_media(post_query):
+    """release_media() для всех постов запроса (перед массовым удалением постов)."""
+    orphaned = []
+    sizes = {}
+    files_by_project = defaultdict(set)
+    for project_id, media_files in post_query.with_entities(Post.project_id, Post.media_files):
+        orphaned.extend(_release_refs(media_files, sizes))
+        files_by_project[project_id].update(media_files or [])
+    _uncharge_projects(files_by_project, sizes, post_query.with_entities(Post.id).scalar_subquery())
+    # Массовое удаление постов не проходит через ORM-каскад: чистим индекс сами
+    PostMedia.query.filter(PostMedia.post_id.in_(post_query.with_entities(Post.id).scalar_subquery()))\
+        .delete(synchronize_session=False)
+    return orphaned
+
+def unlink_media(filenames):
+    """
+    Удаляет файлы с диска вместе с вариантами под соцсети (после commit),
+    если их не успел сохранить заново другой пост.
+    """
+    for name in set(filenames or []):
+        if MediaFile.query.filter_by(filename=name).first() is not None:
+            continue
+        path = media_path(name)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        remove_variants(os.path.dirname(path), name)
+
+# --------------------------------------------------------------------------
+#  ЗАГРУЗКА ПО ЧАСТЯМ (RESUMABLE)
+# --------------------------------------------------------------------------
+# Большие видео браузер шлет частями по MEDIA_CHUNK_SIZE байт (параллельно,
+# в любом порядке). Каждая часть пишется по своему смещению прямо в
+# UPLOAD_FOLDER/.upload-<id>; полученные части отмечаются в media_upload_chunks,
+# так что после обрыва браузер дозагружает только недостающие.
+# finish_upload() считает хеш собранного файла и переносит его в хранилище.
+
+class UploadError(Exception):
+    pass
+
+def _upload_part_path(upload_id):
+    return os.path.join(_upload_folder(), f".upload-{upload_id}")
+
+def start_upload(user_id, original_name, size, project_id=None):
+    """Создает загрузку и заготовку файла нужного размера. Commit делает вызывающий."""
+    max_size = current_app.config.get('MAX_CONTENT_LENGTH') or 0
+    if size <= 0:
+        raise UploadError("Пустой файл.")
+    if max_size and size > max_size:
+        raise UploadError(f"Файл больше {max_size // (1024 * 1024)} МБ.")
+
+    upload = MediaUpload(
+        id=uuid.uuid4().hex,
+        user_id=user_id,
+        project_id=project_id,
+        original_name=os.path.basename(original_name or 'file')[:255],
+        size=size,
+        chunk_size=current_app.config.get('MEDIA_CHUNK_SIZE', 5 * 1024 * 1024)
+    )
+    with open(_upload_part_path(upload.id), 'wb') as f:
+        f.truncate(size)
+    db.session.add(upload)
+    return upload
+
+def received_chunks(upload):
+    return sorted(index for (index,) in
+                  db.session.query(MediaUploadChunk.index).filter_by(upload_id=upload.id))
+
+def write_chunk(upload, index, stream):
+    """
+    Записывает часть `index` из потока по ее смещению.
+    Часть засчитывается, только если пришла целиком. Повтор той же части не вредит.
+    """
+    if upload.filename:
+        raise UploadError("Загрузка уже завершена.")
+    if not 0 <= index < upload.total_chunks:
+        raise UploadError("Неверный номер части.")
+
+    offset = index * upload.chunk_size
+    expected = min(upload.chunk_size, upload.size - offset)
+    written = 0
+    with open(_upload_part_path(upload.id), 'r+b') as out:
+        out.seek(offset)
+        while written < expected:
+            data = stream.read(min(CHUNK_SIZE, expected - written))
+            if not data:
+                break
+            out.write(data)
+            written += len(data)
+    if written != expected:
+        raise UploadError(f"Часть {index} пришла не полностью ({written} из {expected} байт).")
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(MediaUploadChunk.__table__.insert().values(upload_id=upload.id, index=index))
+    except IntegrityError:
+        # Часть уже была получена (повтор после обрыва)
+        pass
+
+def finish_upload(upload):
+    """Собирает файл: проверяет, что все части на месте, и переносит его в хранилище."""
+    if upload.filename:
+        return upload.filename
+    missing = upload.total_chunks - upload.chunks.count()
+    if missing:
+        raise UploadError(f"Не хватает частей: {missing}.")
+
+    part_path = _upload_part_path(upload.id)
+    digest = hashlib.sha256()
+    with open(part_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    upload.filename = _store_tmp(part_path, digest.hexdigest(), upload.size, upload.original_name,
+                                 upload.project_id)
+    upload.chunks.delete()
+    return upload.filename
+
+@leader_only
+def cleanup_stale_uploads():
+    """
+    Удаляет брошенные загрузки старше MEDIA_UPLOAD_SESSION_HOURS
+    вместе с их недокачанными файлами (запускается по расписанию).
+    """
+    with task_context():
+        hours = current_app.config.get('MEDIA_UPLOAD_SESSION_HOURS', 24)
+        cutoff = datetime.utcnow() - timedelta(hours=hours)
+        stale = MediaUpload.query.filter(MediaUpload.created_at < cutoff).all()
+        for upload in stale:
+            try:
+                os.remove(_upload_part_path(upload.id))
+            except OSError:
+                pass
+            db.session.delete(upload)
+        db.session.commit()
+        if stale:
+            logger.info(f"Media: удалено брошенных загрузок: {len(stale)}")
+
+# --------------------------------------------------------------------------
+#  СБОРКА МУСОРА В UPLOAD_FOLDER
+# --------------------------------------------------------------------------
+# Периодическая задача проходит по папке потоково (os.scandir) пачками по
+# MEDIA_GC_BATCH_SIZE и удаляет файлы старше MEDIA_GC_GRACE_HOURS, на которые
+# не ссылается ни один пост (по индексу post_media):
+#   - медиа удаленных постов, которые не удалил массовый clear_*/delete_project;
+#   - картинки RSS и загрузки, пост для которых так и не был создан;
+#   - варианты под соцсети (<sha256>.<платформа>.jpg) без оригинала;
+#   - брошенные временные файлы (.tmp-*, .upload-* без записи о загрузке).
+# Заодно создает записи media_files для файлов старых постов, сверяет
+# media_files.ref_count с индексом и пересчитывает итоги media_usage.
+# Срок ожидания защищает файлы, которые только что сохранены и еще не попали в пост.
+
+def iter_media_entries():
+    """
+    Потоково перебирает файлы UPLOAD_FOLDER (os.DirEntry): корень
+    (временные и еще не перенесенные файлы) и подпапки ab/cd/.
+    """
+    def scan(path, depth):
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        yield entry
+                    elif depth < 2 and entry.is_dir(follow_symlinks=False):
+                        yield from scan(entry.path, depth + 1)
+        except OSError:
+            return
+    return scan(_upload_folder(), 0)
+
+_VARIANT_NAME = re.compile(r'^([0-9a-f]{64})\.[a-z]+\.jpg$')
+
+def _index_unindexed_posts(batch_size):
+    """Заполняет post_media для постов, созданных до появления индекса."""
+    has_refs = exists().where(PostMedia.post_id == Post.id)
+    indexed = 0
+    last_id = 0
+    while True:
+        posts = Post.query.filter(Post.id > last_id, Post.media_files.isnot(None), ~has_refs)\
+            .order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            return indexed
+        for post in posts:
+            if post.media_files:
+                post.media_refs = [PostMedia(position=i, filename=name)
+                                   for i, name in enumerate(post.media_files)]
+                indexed += 1
+        last_id = posts[-1].id
+        db.session.commit()
+
+def _backfill_records(batch_size):
+    """Создает записи media_files для файлов постов, сохраненных до появления таблицы."""
+    created = 0
+    last_name = ''
+    while True:
+        rows = db.session.query(PostMedia.filename, func.count(), func.min(Post.project_id))\
+            .join(Post, Post.id == PostMedia.post_id)\
+            .outerjoin(MediaFile, MediaFile.filename == PostMedia.filename)\
+            .filter(MediaFile.id.is_(None), PostMedia.filename > last_name)\
+            .group_by(PostMedia.filename).order_by(PostMedia.filename).limit(batch_size).all()
+        if not rows:
+            return created
+        for filename, refs, project_id in rows:
+            path = media_path(filename)
+            if not os.path.exists(path):
+                continue
+            width, height = image_size(path)
+            db.session.add(MediaFile(filename=filename, sha256=media_sha256(path),
+                                     size=os.path.getsize(path), mime=mimetypes.guess_type(filename)[0],
+                                     width=width, height=height, project_id=project_id, ref_count=refs))
+            created += 1
+        last_name = rows[-1][0]
+        db.session.commit()
+
+def _collect_batch(entries, report):
+    names = [entry.name for entry in entries]
+    referenced = {name for (name,) in db.session.query(PostMedia.filename)
+                  .filter(PostMedia.filename.in_(names)).distinct()}
+    upload_ids = {name[len('.upload-'):] for name in names if name.startswith('.upload-')}
+    active_uploads = {upload_id for (upload_id,) in db.session.query(MediaUpload.id)
+                      .filter(MediaUpload.id.in_(upload_ids))} if upload_ids else set()
+    variant_owners = {m.group(1) for m in map(_VARIANT_NAME.match, names) if m}
+    live_hashes = {sha for (sha,) in db.session.query(MediaFile.sha256)
+                   .filter(MediaFile.sha256.in_(variant_owners))} if variant_owners else set()
+
+    # Сверка счетчиков ссылок с индексом
+    refs = select(func.count()).where(PostMedia.filename == MediaFile.filename).scalar_subquery()
+    report['reconciled'] += MediaFile.query.filter(MediaFile.filename.in_(names), MediaFile.ref_count != refs)\
+        .update({'ref_count': refs}, synchronize_session=False)
+
+    garbage = []
+    for entry in entries:
+        name = entry.name
+        if name.startswith('.upload-'):
+            if name[len('.upload-'):] not in active_uploads:
+                garbage.append(entry)
+        elif name.startswith('.tmp-'):
+            garbage.append(entry)
+        elif _VARIANT_NAME.match(name):
+            if _VARIANT_NAME.match(name).group(1) not in live_hashes:
+                garbage.append(entry)
+        elif name not in referenced:
+            record = MediaFile.query.filter_by(filename=name).first()
+            if record is not None:
+                # Запись удаляется, только если ссылка так и не появилась (проверка в том же запросе)
+                deleted = MediaFile.query.filter(MediaFile.filename == name,
+                                                 ~exists().where(PostMedia.filename == name))\
+                    .delete(synchronize_session=False)
+                if not deleted:
+                    continue
+                change_usage(db.session.connection(), record.project_id, -1, -record.size)
+            garbage.append(entry)
+    db.session.commit()
+
+    for entry in garbage:
+        try:
+            size = entry.stat().st_size
+            os.remove(entry.path)
+        except OSError:
+            continue
+        report['removed'] += 1
+        report['reclaimed_bytes'] += size
+
+def recount_usage():
+    """
+    Пересчитывает итоги media_usage (исправляет накопившиеся расхождения): проекту —
+    файлы его постов и его загрузки, еще не попавшие в пост; сервису — все файлы.
+    """
+    held = union(
+        select(Post.project_id, PostMedia.filename).join(Post, Post.id == PostMedia.post_id)
+        .where(Post.project_id.isnot(None)),
+        select(MediaFile.project_id, MediaFile.filename)
+        .where(MediaFile.project_id.isnot(None), MediaFile.ref_count == 0),
+    ).subquery()
+    rows = db.session.query(held.c.project_id, func.count(), func.coalesce(func.sum(MediaFile.size), 0))\
+        .join(MediaFile, MediaFile.filename == held.c.filename).group_by(held.c.project_id)
+    totals = {project_id: (count, size) for project_id, count, size in rows}
+    totals[0] = db.session.query(func.count(MediaFile.id), func.coalesce(func.sum(MediaFile.size), 0)).one()
+
+    for usage in MediaUsage.query.all():
+        count, size = totals.pop(usage.project_id, (0, 0))
+        usage.files_count, usage.total_bytes = count, size
+    for project_id, (count, size) in totals.items():
+        db.session.add(MediaUsage(project_id=project_id, files_count=count, total_bytes=size))
+    db.session.commit()
+
+@leader_only
+def collect_media_garbage():
+    """
+    Удаляет из UPLOAD_FOLDER файлы, на которые не ссылается ни один пост.
+    Возвращает отчет: сколько файлов просмотрено, удалено и сколько байт освобождено.
+    """
+    with task_context():
+        batch_size = current_app.config.get('MEDIA_GC_BATCH_SIZE', 500)
+        grace_hours = current_app.config.get('MEDIA_GC_GRACE_HOURS', 24)
+        cutoff = datetime.now().timestamp() - grace_hours * 3600
+
+        report = {'scanned': 0, 'removed': 0, 'reclaimed_bytes': 0, 'reconciled': 0,
+                  'indexed_posts': _index_unindexed_posts(batch_size),
+                  'backfilled': _backfill_records(batch_size)}
+
+        batch = []
+        for entry in iter_media_entries():
+            report['scanned'] += 1
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+            except OSError:
+                continue
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                _collect_batch(batch, report)
+                batch = []
+        if batch:
+            _collect_batch(batch, report)
+        recount_usage()
+
+        logger.info(f"Media GC: просмотрено {report['scanned']}, удалено {report['removed']}, "
+                    f"освобождено {report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ, "
+                    f"исправлено счетчиков {report['reconciled']}, проиндексировано постов {report['indexed_posts']}, "
+                    f"создано записей о файлах {report['backfilled']}")
+        return report
+
+@click.command('media-shard')
+@with_appcontext
+def shard_media_command():
+    """Переносит файлы из корня UPLOAD_FOLDER в подпапки ab/cd/ (можно запускать повторно)."""
+    folder = _upload_folder()
+    moved = 0
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                continue
+            target = os.path.join(folder, *media_relpath(entry.name).split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(entry.path, target)
+            moved += 1
+            if moved % 1000 == 0:
+                click.echo(f"Перенесено файлов: {moved}...")
+    click.echo(f"Готово. Перенесено файлов: {moved}.")
+
+# --------------------------------------------------------------------------
+#  КЕШ ЗАГРУЗОК В СОЦСЕТИ
+# --------------------------------------------------------------------------
+# Хеш файла + платформа + цель (группа VK/OK, бот TG) -> ID, который вернула платформа.
+# Если платформа отвергла ID из кеша, запись удаляется (forget_upload) и файл
+# загружается заново. Функции работают через отдельные транзакции (без db.session),
+# поэтому их можно вызывать из параллельных отправок.
+
+_HASH_NAME = re.compile(r'^[0-9a-f]{64}$')
+
+def media_sha256(path):
+    """SHA-256 файла: из имени (файлы хранилища) или по содержимому (старые uuid-файлы)."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if _HASH_NAME.match(stem):
+        return stem
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_cache_enabled():
+    return bool(current_app.config.get('MEDIA_UPLOAD_CACHE_ENABLED'))
+
+def cached_upload(path, platform, target):
+    """ID ранее загруженного файла или None (кеш выключен, записи нет или она истекла)."""
+    if not upload_cache_enabled():
+        return None
+    table = MediaUploadCache.__table__
+    try:
+        with db.engine.connect() as conn:
+            row = conn.execute(table.select().where(
+                table.c.sha256 == media_sha256(path),
+                table.c.platform == platform,
+                table.c.target == str(target),
+                table.c.expires_at > datetime.utcnow()
+            )).first()
+        return row.remote_id if row else None
+    except Exception as e:
+        logger.error(f"Media cache: ошибка чтения ({platform}): {e}")
+        return None
+
+def remember_upload(path, platform, target, remote_id):
+    """Запоминает ID загруженного файла на MEDIA_UPLOAD_CACHE_TTL[platform] секунд."""
+    if not upload_cache_enabled() or not remote_id:
+        return
+    ttl = current_app.config.get('MEDIA_UPLOAD_CACHE_TTL', {}).get(platform)
+    if not ttl:
+        return
+
+    table = MediaUploadCache.__table__
+    sha256 = media_sha256(path)
+    expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+    key = (table.c.sha256 == sha256) & (table.c.platform == platform) & (table.c.target == str(target))
+    try:
+        with db.engine.begin() as conn:
+            updated = conn.execute(table.update().where(key)
+                                   .values(remote_id=str(remote_id), expires_at=expires_at)).rowcount
+            if not updated:
+                conn.execute(table.insert().values(sha256=sha256, platform=platform, target=str(target),
+                                                   remote_id=str(remote_id), expires_at=expires_at))
+    except IntegrityError:
+        # Тот же файл одновременно загрузил другой процесс — его запись не хуже нашей
+        pass
+    except Exception as e:
+        logger.error(f"Media cache: ошибка записи ({platform}): {e}")
+
+def forget_upload(path, platform, target):
+    """Удаляет запись, ID из которой платформа отвергла."""
+    table = MediaUploadCache.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(
+                table.c.sha256 == media_sha256(path),
+                table.c.platform == platform,
+                table.c.target == str(target)
+            ))
+    except Exception as e:
+        logger.error(f"Media cache: ошибка удаления ({platform}): {e}")
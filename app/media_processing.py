@@ -0,0 +1,175 @@
+# app/media_processing.py
+import os
+import uuid
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен — публикуем оригиналы как раньше
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ПОДГОТОВКА КАРТИНОК ПОД ЛИМИТЫ СОЦСЕТЕЙ
+# --------------------------------------------------------------------------
+# Для каждой соцсети из MEDIA_VARIANT_PROFILES картинка при необходимости
+# уменьшается, пережимается в JPEG, очищается от EXIF (с учетом поворота)
+# и сохраняется рядом с оригиналом (в той же папке) как <имя>.<платформа>.jpg.
+# Если оригинал и так подходит, вариант не создается и отправляется оригинал.
+#
+# Варианты готовятся в пуле процессов сразу после загрузки (schedule_variants),
+# чтобы не занимать веб-воркер. Если к публикации вариант еще не готов,
+# platform_media() подготовит его на месте.
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+
+_pool = None
+
+def variant_name(filename, platform):
+    return f"{os.path.splitext(filename)[0]}.{platform}.jpg"
+
+def _needs_variant(img, path, profile):
+    ext = os.path.splitext(path)[1].lower()
+    return (
+        max(img.size) > profile['max_side']
+        or os.path.getsize(path) > profile['max_bytes']
+        or ext not in profile['formats']
+        or bool(img.getexif())
+    )
+
+# Если на качестве 50 JPEG все еще больше max_bytes, сторона уменьшается в
+# VARIANT_SHRINK_STEP раз, но не меньше VARIANT_MIN_SIDE
+VARIANT_SHRINK_STEP = 0.75
+VARIANT_MIN_SIDE = 320
+
+def _to_rgb(img):
+    """RGB для JPEG: прозрачные области ложатся на белый фон, а не на черный."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+def build_variant(folder, filename, platform, profile):
+    """
+    Готовит вариант картинки для платформы. Возвращает имя варианта
+    или None, если оригинал подходит как есть (или ужать его до лимита не удалось).
+    Не требует app_context (для пула процессов).
+    """
+    src = os.path.join(folder, filename)
+    dst_name = variant_name(filename, platform)
+    dst = os.path.join(folder, dst_name)
+    if os.path.exists(dst):
+        return dst_name
+
+    with Image.open(src) as img:
+        if not _needs_variant(img, src, profile):
+            return None
+
+        # Поворот из EXIF применяем до того, как EXIF будет отброшен
+        img = _to_rgb(ImageOps.exif_transpose(img))
+
+    # Уникальное временное имя: тот же вариант может готовить и пул, и публикация
+    tmp = os.path.join(folder, f".tmp-{uuid.uuid4().hex}")
+    side = min(profile['max_side'], max(img.size))
+    while True:
+        frame = img.copy()
+        frame.thumbnail((side, side), Image.LANCZOS)
+        for quality in (profile.get('quality', 85), 75, 65, 50):
+            frame.save(tmp, 'JPEG', quality=quality, optimize=True, progressive=True)
+            if os.path.getsize(tmp) <= profile['max_bytes']:
+                os.replace(tmp, dst)
+                return dst_name
+        side = int(side * VARIANT_SHRINK_STEP)
+        if side < VARIANT_MIN_SIDE:
+            os.remove(tmp)
+            logger.warning(f"Media: {filename} не ужимается до {profile['max_bytes']} байт для {platform}, "
+                           f"отправляется оригинал")
+            return None
+
+def build_variants(folder, filename, profiles):
+    """Готовит варианты для всех платформ. Возвращает {платформа: имя варианта или None}."""
+    result = {}
+    for platform, profile in profiles.items():
+        try:
+            result[platform] = build_variant(folder, filename, platform, profile)
+        except Exception as e:
+            logger.error(f"Media: не удалось подготовить {filename} для {platform}: {e}")
+            result[platform] = None
+    return result
+
+def _enabled():
+    return Image is not None and bool(current_app.config.get('MEDIA_PREPROCESS_ENABLED'))
+
+def _is_image(filename):
+    return filename.lower().endswith(IMAGE_EXTS)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: веб-процесс многопоточный (планировщик, пулы соединений)
+        _pool = ProcessPoolExecutor(
+            max_workers=current_app.config.get('MEDIA_PROCESS_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _pool
+
+def _log_failure(future):
+    if future.exception():
+        logger.error(f"Media: ошибка подготовки вариантов: {future.exception()}")
+
+def schedule_variants(path):
+    """Ставит подготовку вариантов файла в пул процессов (не ждет результата)."""
+    if not _enabled() or not _is_image(path):
+        return
+    folder, filename = os.path.split(path)
+    try:
+        future = _get_pool().submit(build_variants, folder, filename,
+                                    current_app.config.get('MEDIA_VARIANT_PROFILES', {}))
+        future.add_done_callback(_log_failure)
+    except Exception as e:
+        # Не страшно: вариант будет подготовлен при публикации
+        logger.error(f"Media: пул обработки недоступен: {e}")
+
+def platform_media(paths, platform):
+    """Подменяет пути картинок на варианты для платформы (готовит недостающие на месте)."""
+    profile = current_app.config.get('MEDIA_VARIANT_PROFILES', {}).get(platform)
+    if not profile or not _enabled():
+        return paths
+
+    result = []
+    for path in paths:
+        if not _is_image(path):
+            result.append(path)
+            continue
+        folder, filename = os.path.split(path)
+        try:
+            name = build_variant(folder, filename, platform, profile)
+        except Exception as e:
+            logger.error(f"Media: не удалось подготовить {filename} для {platform}: {e}")
+            name = None
+        result.append(os.path.join(folder, name) if name else path)
+    return result
+
+def image_size(path):
+    """(ширина, высота) картинки по заголовку файла или (None, None) — видео, нет Pillow, битый файл."""
+    if Image is None or not _is_image(path):
+        return None, None
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+def remove_variants(folder, filename):
+    """Удаляет подготовленные варианты файла из его папки (оригинал удаляет app/media.py)."""
+    for platform in current_app.config.get('MEDIA_VARIANT_PROFILES', {}):
+        try:
+            os.remove(os.path.join(folder, variant_name(filename, platform)))
+        except OSError:
+            pass
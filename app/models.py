@@ -179,6 +179,19 @@ class User(UserMixin, db.Model):
             
         if posts_count >= limit:
             return False, f"Лимит постов на этот месяц исчерпан ({limit})."
+        return True, "OK"
+
+    def can_store_media(self, project_id, extra_bytes):
+        """Проверка лимита хранилища проекта (опция тарифа max_files_size_mb, МБ на проект)."""
+        limit_mb = self.get_limit('max_files_size_mb')
+        if not limit_mb:
+            return True, "OK"
+
+        usage = MediaUsage.query.get(project_id) if project_id else None
+        used = usage.total_bytes if usage else 0
+        if used + extra_bytes > limit_mb * 1024 * 1024:
+            return False, (f"Не хватает места для файлов: занято {used / 1024 / 1024:.1f} из {limit_mb} МБ. "
+                           f"Удалите старые посты или обновите тариф.")
         return True, "OK"        
 
 class SocialTokens(db.Model):
@@ -188,6 +201,8 @@ class SocialTokens(db.Model):
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
     
     _tg_token_encrypted = db.Column(db.String(1024))
+    # Закрытый чат бота для предзагрузки медиа (file_id получаем до времени публикации)
+    tg_cache_chat_id = db.Column(db.String(256), nullable=True)
     _vk_token_encrypted = db.Column(db.String(1024))
     _ig_page_token_encrypted = db.Column(db.String(1024))
     ig_user_id = db.Column(db.String(256)) 
@@ -304,6 +319,10 @@ class Signature(db.Model):
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    __table_args__ = (
+        # Диспетчер очереди выбирает готовые посты по диапазону (status, scheduled_at)
+        db.Index('ix_posts_status_scheduled_at', 'status', 'scheduled_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=True)    
@@ -332,9 +351,36 @@ class Post(db.Model):
     vk_group_id = db.Column(db.Integer, db.ForeignKey('vk_groups.id'))
     ok_group_id = db.Column(db.Integer, db.ForeignKey('ok_groups.id'))
     max_chat_id = db.Column(db.Integer, db.ForeignKey('max_chats.id'))       
+
+    # Связи с каналами/группами (для загрузки графа поста одним запросом)
+    tg_channel = db.relationship('TgChannel', foreign_keys=[tg_channel_id], lazy=True)
+    vk_group = db.relationship('VkGroup', foreign_keys=[vk_group_id], lazy=True)
+    ok_group = db.relationship('OkGroup', foreign_keys=[ok_group_id], lazy=True)
+    max_chat = db.relationship('MaxChat', foreign_keys=[max_chat_id], lazy=True)
+
+    # Индекс файлов поста (заполняет app/media.acquire_media)
+    media_refs = db.relationship('PostMedia', lazy=True, cascade='all, delete-orphan',
+                                 order_by='PostMedia.position')
     
     vk_layout = db.Column(db.String(50), default='grid')   
     
+    # Аренда (lease) поста воркером очереди публикаций (app/services_queue.py).
+    # Если воркер упал, после locked_until пост снова может забрать другой воркер.
+    locked_by = db.Column(db.String(255), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+
+    # Автоповторы (status='retrying'): сколько было попыток и когда следующая.
+    # Повторно отправляются только платформы, которых еще нет в platform_info.
+    retry_count = db.Column(db.Integer, default=0, nullable=False)
+    next_retry_at = db.Column(db.DateTime, nullable=True)
+
+    # Все платформы поста, включая VK, публикует очередь (посты из RSS).
+    # Посты из формы отправляются в VK сразу из routes_main, и очередь их VK не трогает.
+    publish_via_queue = db.Column(db.Boolean, default=False, nullable=False)
+
+    # Когда медиа отложенного поста загружены в соцсети заранее (app/services.prestage_media)
+    media_staged_at = db.Column(db.DateTime, nullable=True)
+    
 class RssSource(db.Model):
     __tablename__ = 'rss_sources'
     
@@ -344,6 +390,8 @@ class RssSource(db.Model):
     
     name = db.Column(db.String(100))
     url = db.Column(db.String(512), nullable=False)
+    # Ключ группировки одинаковых лент (normalize_feed_url в app/services_rss.py)
+    normalized_url = db.Column(db.String(512), nullable=True, index=True)
     
     publish_to_tg = db.Column(db.Boolean, default=False)
     tg_channel_id = db.Column(db.Integer, db.ForeignKey('tg_channels.id'), nullable=True)
@@ -358,9 +406,139 @@ class RssSource(db.Model):
     
     last_guid = db.Column(db.String(512))
     is_active = db.Column(db.Boolean, default=True)
+
+    # Условный GET: валидаторы последнего ответа (If-None-Match / If-Modified-Since)
+    # и HTTP-статус последнего опроса (304 — лента не менялась)
+    etag = db.Column(db.String(512), nullable=True)
+    modified = db.Column(db.String(64), nullable=True)
+    last_status = db.Column(db.Integer, nullable=True)
+
+    # Расписание опроса (app/services_rss.py): когда опросить ленту в следующий раз,
+    # текущий интервал (сек, подстраивается под частоту публикаций) и ошибки подряд
+    next_poll_at = db.Column(db.DateTime, nullable=True, index=True)
+    poll_interval = db.Column(db.Integer, nullable=True)
+    error_count = db.Column(db.Integer, default=0, nullable=False)
     
     user = db.relationship('User', backref=db.backref('rss_sources', lazy=True))
     
+class RateLimitBucket(db.Model):
+    """
+    Токен-бакет ограничителя частоты отправки (app/ratelimit.py).
+    Хранится в БД, чтобы лимит был общим для всех процессов и хостов.
+    """
+    __tablename__ = 'rate_limit_buckets'
+
+    # Например: 'tg_chat:<hash бота>:<chat_id>', 'vk_group:123'
+    key = db.Column(db.String(255), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False, default=0)
+    # Время (unix time), от которого пополняются токены.
+    # После 429/flood control может быть в будущем — до него бакет пуст.
+    updated_at = db.Column(db.Float, nullable=False)
+
+class MediaFile(db.Model):
+    """
+    Файл в UPLOAD_FOLDER с адресацией по содержимому (app/media.py).
+    Имя файла = sha256 + расширение; ref_count — сколько ссылок из Post.media_files.
+    """
+    __tablename__ = 'media_files'
+
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), unique=True, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    mime = db.Column(db.String(100), nullable=True)
+    # Размеры картинки (для видео и без Pillow — пусто)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    # Проект, в котором файл появился впервые (объем ему засчитывается, пока файл не попал в пост)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='SET NULL'), nullable=True, index=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MediaUsage(db.Model):
+    """
+    Накопительные итоги по хранилищу медиа: количество и объем файлов проекта
+    (файл, на который ссылаются посты нескольких проектов, засчитан каждому).
+    Строка с project_id=0 — итоги по всему сервису (для админки), каждый файл один раз.
+    Обновляются при сохранении и удалении файлов (app/media.py), без обхода папки.
+    """
+    __tablename__ = 'media_usage'
+
+    project_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    files_count = db.Column(db.BigInteger, nullable=False, default=0)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+class PostMedia(db.Model):
+    """
+    Индекс ссылок постов на файлы (то же, что Post.media_files, но с индексом по имени файла).
+    По нему сборщик мусора (app/media.py) быстро проверяет, нужен ли файл хоть одному посту.
+    """
+    __tablename__ = 'post_media'
+
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    filename = db.Column(db.String(255), nullable=False, index=True)
+
+class MediaUpload(db.Model):
+    """
+    Загрузка файла по частям (app/media.py): части пишутся по своим смещениям
+    во временный файл в UPLOAD_FOLDER, полученные части — в media_upload_chunks.
+    После сборки filename = имя файла в хранилище, пост ссылается на него по id загрузки.
+    """
+    __tablename__ = 'media_uploads'
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='SET NULL'), nullable=True)
+    original_name = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=True)  # заполняется после сборки
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    chunks = db.relationship('MediaUploadChunk', backref='upload', lazy='dynamic',
+                             cascade='all, delete-orphan')
+
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+class MediaUploadChunk(db.Model):
+    __tablename__ = 'media_upload_chunks'
+
+    upload_id = db.Column(db.String(32), db.ForeignKey('media_uploads.id', ondelete='CASCADE'), primary_key=True)
+    index = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+class MediaUploadCache(db.Model):
+    """
+    Уже загруженные в соцсеть медиа: хеш файла + платформа + цель -> ID на стороне платформы
+    (VK 'photo<owner>_<id>', OK токен фото, TG file_id). Повторная публикация того же файла
+    в ту же группу/бота идет без повторной загрузки (app/media.py).
+    """
+    __tablename__ = 'media_upload_cache'
+    __table_args__ = (
+        db.UniqueConstraint('sha256', 'platform', 'target', name='uq_media_upload_cache'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    platform = db.Column(db.String(10), nullable=False)   # 'tg', 'vk', 'ok'
+    target = db.Column(db.String(255), nullable=False)    # группа VK/OK или бот TG
+    remote_id = db.Column(db.String(512), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class SchedulerLock(db.Model):
+    """
+    Аренда (lease) для выбора лидера периодических задач (app/leader.py).
+    Строка принадлежит holder до expires_at; лидер продлевает ее heartbeat-задачей.
+    """
+    __tablename__ = 'scheduler_locks'
+
+    name = db.Column(db.String(100), primary_key=True)
+    # Кто держит аренду: 'хост:PID'
+    holder = db.Column(db.String(255), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
 # Транзакции
 class Transaction(db.Model):
     __tablename__ = 'transactions'
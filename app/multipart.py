@@ -0,0 +1,112 @@
+# app/multipart.py
+import os
+import uuid
+import mimetypes
+
+# --------------------------------------------------------------------------
+#  ПОТОКОВОЕ ТЕЛО MULTIPART/FORM-DATA
+# --------------------------------------------------------------------------
+# requests с files={...} собирает все тело запроса в памяти: альбом из 10 видео
+# раздувает воркер на сотни МБ. MultipartStream отдается в data=... как файл:
+# длина известна заранее (Content-Length), а файлы читаются кусками и открываются
+# по одному — в момент, когда до них дошла отправка, и сразу закрываются.
+#
+#   with MultipartStream({'chat_id': 1}, {'photo': '/path/a.jpg'}) as body:
+#       http_client.post(url, data=body, headers={'Content-Type': body.content_type})
+
+CHUNK_SIZE = 64 * 1024
+
+class MultipartStream:
+    """
+    fields — {имя: значение} обычных полей.
+    files  — {имя поля: путь} или {имя поля: (имя файла, путь, mime)}.
+    """
+
+    def __init__(self, fields=None, files=None):
+        self.boundary = uuid.uuid4().hex
+        self._parts = []  # bytes или путь к файлу (str)
+
+        for name, value in (fields or {}).items():
+            if value is None:
+                continue
+            self._parts.append(
+                self._header(f'name="{name}"') + str(value).encode('utf-8') + b'\r\n'
+            )
+
+        for name, spec in (files or {}).items():
+            filename, path, mime = spec if isinstance(spec, tuple) else (os.path.basename(spec), spec, None)
+            mime = mime or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self._parts.append(self._header(f'name="{name}"; filename="{filename}"', mime))
+            self._parts.append(path)
+            self._parts.append(b'\r\n')
+
+        self._parts.append(f'--{self.boundary}--\r\n'.encode())
+        self.len = sum(os.path.getsize(p) if isinstance(p, str) else len(p) for p in self._parts)
+        self.seek(0)
+
+    def _header(self, disposition, mime=None):
+        header = f'--{self.boundary}\r\nContent-Disposition: form-data; {disposition}\r\n'
+        if mime:
+            header += f'Content-Type: {mime}\r\n'
+        return (header + '\r\n').encode('utf-8')
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        out = bytearray()
+        while len(out) < size and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                data = part[self._offset:self._offset + size - len(out)]
+                self._offset += len(data)
+                done = self._offset >= len(part)
+            else:
+                if self._file is None:
+                    self._file = open(part, 'rb')
+                data = self._file.read(min(CHUNK_SIZE, size - len(out)))
+                done = not data
+            out += data
+            self._pos += len(data)
+            if done:
+                self._next_part()
+        return bytes(out)
+
+    def _next_part(self):
+        self._close_file()
+        self._index += 1
+        self._offset = 0
+
+    def _close_file(self):
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+        self._file = None
+
+    def seek(self, offset, whence=0):
+        """Поддерживается только перемотка в начало (для повтора запроса)."""
+        if offset != 0 or whence != 0:
+            raise ValueError("MultipartStream: поддерживается только seek(0)")
+        self._close_file()
+        self._index = 0
+        self._offset = 0
+        self._pos = 0
+        return 0
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,125 @@
+# app/ratelimit.py
+import time
+import hashlib
+import logging
+from flask import current_app, has_request_context
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ОГРАНИЧИТЕЛЬ ЧАСТОТЫ (TOKEN BUCKET В БД)
+# --------------------------------------------------------------------------
+# Бакеты лежат в таблице rate_limit_buckets, поэтому лимит общий для всех
+# gunicorn-воркеров, воркеров очереди и хостов. Отправка не отклоняется, а
+# откладывается: acquire() резервирует слот и ждет своей очереди.
+# В веб-запросе ждать можно не дольше RATE_LIMIT_WEB_MAX_WAIT_SECONDS — иначе
+# RateLimitError, и пост досылает очередь (воркер ждет до RATE_LIMIT_MAX_WAIT_SECONDS).
+# Виды ключей и их лимиты задаются в RATE_LIMITS (config.py).
+
+class RateLimitError(Exception):
+    """Ожидание слота превысило допустимое или бакет недоступен (сбой БД)."""
+
+def tg_bot_key(token):
+    """Ключ бота без самого токена (в БД токен хранить нельзя)."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+def _reserve(key, rate, burst, max_wait):
+    """
+    Резервирует один слот в бакете и возвращает, сколько секунд ждать до него.
+    Токены могут уходить в минус — это и есть очередь из уже зарезервированных слотов.
+    Если ждать дольше max_wait, слот не резервируется (чтобы не удлинять очередь остальным).
+    """
+    table = RateLimitBucket.__table__
+
+    for _ in range(3):
+        now = time.time()
+        try:
+            # Отдельная короткая транзакция, не связанная с db.session
+            with db.engine.begin() as conn:
+                row = conn.execute(
+                    select(table).where(table.c.key == key).with_for_update()
+                ).first()
+
+                if row is None:
+                    conn.execute(table.insert().values(key=key, tokens=burst - 1, updated_at=now))
+                    return 0.0
+
+                # Если бакет заблокирован (updated_at в будущем), токены уходят в минус
+                # на весь остаток блокировки — ожидающие выстраиваются в очередь за ней.
+                tokens = min(burst, row.tokens + (now - row.updated_at) * rate) - 1
+                wait = -tokens / rate if tokens < 0 else 0.0
+
+                if wait <= max_wait:
+                    conn.execute(table.update().where(table.c.key == key)
+                                 .values(tokens=tokens, updated_at=now))
+                return wait
+        except IntegrityError:
+            # Бакет одновременно создал другой процесс — повторяем
+            continue
+    return 0.0
+
+def acquire(kind, target):
+    """
+    Ждет свободный слот для ключа `kind:target`.
+    Бросает RateLimitError, если ждать пришлось бы дольше RATE_LIMIT_MAX_WAIT_SECONDS
+    (в веб-запросе — RATE_LIMIT_WEB_MAX_WAIT_SECONDS) или бакет недоступен.
+    Требует app_context.
+    """
+    config = current_app.config
+    if not config.get('RATE_LIMIT_ENABLED'):
+        return
+
+    limits = config.get('RATE_LIMITS', {}).get(kind)
+    if not limits:
+        return
+    rate, burst = limits
+    key = f"{kind}:{target}"
+
+    max_wait = config.get('RATE_LIMIT_MAX_WAIT_SECONDS', 300)
+    if has_request_context():
+        # Веб-запрос не держим: долгое ожидание — дело очереди
+        max_wait = min(max_wait, config.get('RATE_LIMIT_WEB_MAX_WAIT_SECONDS', 2))
+    try:
+        wait = _reserve(key, rate, burst, max_wait)
+    except Exception as e:
+        # Без бакета лимит не соблюсти: не отправляем, очередь повторит позже
+        logger.warning(f"RateLimit: бакет {key} недоступен, отправка отложена: {e}")
+        raise RateLimitError(f"Ограничитель частоты недоступен ({kind})") from e
+
+    if wait > max_wait:
+        raise RateLimitError(f"Превышен лимит отправки ({kind}), ожидание {int(wait)} сек.")
+    if wait > 0:
+        logger.info(f"RateLimit: {key} — жду {wait:.1f} сек.")
+        time.sleep(wait)
+
+def penalize(kind, target, seconds):
+    """
+    Блокирует ключ `kind:target` на `seconds` секунд (429 retry_after, flood control):
+    бакет опустошается, а пополнение начнется только после блокировки.
+    Блокировка видна всем процессам: их acquire() подождет до ее окончания.
+    """
+    if not current_app.config.get('RATE_LIMIT_ENABLED'):
+        return
+
+    table = RateLimitBucket.__table__
+    key = f"{kind}:{target}"
+    until = time.time() + seconds
+
+    try:
+        with db.engine.begin() as conn:
+            row = conn.execute(
+                select(table).where(table.c.key == key).with_for_update()
+            ).first()
+            if row is None:
+                conn.execute(table.insert().values(key=key, tokens=0, updated_at=until))
+            elif row.updated_at < until:
+                conn.execute(table.update().where(table.c.key == key)
+                             .values(tokens=0, updated_at=until))
+        logger.warning(f"RateLimit: {key} заблокирован на {seconds} сек.")
+    except Exception as e:
+        logger.error(f"RateLimit: не удалось заблокировать {key}: {e}")
@@ -3,11 +3,12 @@ import os
 import json
 from datetime import datetime, timedelta
 from flask import (Blueprint, render_template, redirect, 
-                    url_for, flash, session, current_app, request)
+                    url_for, flash, session, request)
 from flask_login import login_required
 from app.utils import admin_required
 from app import db, scheduler
-from app.models import User, Post, Tariff
+from app.models import User, Post, Tariff, Project, MediaUsage
+from app.services_queue import queue_stats
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -28,6 +29,9 @@ def dashboard():
     except Exception:
         scheduler_status = 'UNKNOWN'
 
+    # Очередь публикаций: сколько постов ждут и на сколько отстает диспетчер
+    queue_due, queue_lag = queue_stats()
+
     # 3. Логи (читаем последние 50 строк)
     log_content = ""
     try:
@@ -50,24 +54,14 @@ def dashboard():
     # 4. Пользователи
     all_users = User.query.order_by(User.created_at.desc()).all()
     
-    # 5. Файлы (Количество и Объем)
-    upload_path = current_app.config['UPLOAD_FOLDER']
-    media_files_count = 0
-    media_total_size_mb = 0.0
-    
-    if os.path.exists(upload_path):
-        files = os.listdir(upload_path)
-        media_files_count = len(files)
-        
-        total_bytes = 0
-        for f in files:
-            fp = os.path.join(upload_path, f)
-            # Пропускаем, если это папка (на всякий случай)
-            if os.path.isfile(fp):
-                total_bytes += os.path.getsize(fp)
-        
-        # Переводим байты в мегабайты
-        media_total_size_mb = total_bytes / (1024 * 1024)
+    # 5. Файлы (Количество и Объем) — из накопительных итогов, без обхода папки
+    media_total = MediaUsage.query.get(0)
+    media_files_count = media_total.files_count if media_total else 0
+    media_total_size_mb = (media_total.total_bytes if media_total else 0) / (1024 * 1024)
+    # Проекты, занимающие больше всего места
+    media_top_projects = db.session.query(Project, MediaUsage)\
+        .join(MediaUsage, MediaUsage.project_id == Project.id)\
+        .order_by(MediaUsage.total_bytes.desc()).limit(5).all()
 
     # 6. Текущее время (для заголовка)
     now = datetime.utcnow()
@@ -81,11 +75,14 @@ def dashboard():
                            posts_published=posts_published,
                            posts_failed=posts_failed,
                            scheduler_status=scheduler_status,
+                           queue_due=queue_due,
+                           queue_lag=queue_lag,
                            log_content=log_content,
                            all_users=all_users,
                            now=now,
                            media_files_count=media_files_count,
-                           media_total_size_mb=round(media_total_size_mb, 2))
+                           media_total_size_mb=round(media_total_size_mb, 2),
+                           media_top_projects=media_top_projects)
                            
 # --- НОВЫЕ МАРШРУТЫ АДМИНА ---
 @admin_bp.route('/user/<int:user_id>/toggle_active', methods=['POST'])
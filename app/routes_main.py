@@ -1,23 +1,24 @@
 # app/routes_main.py
-import os
-import uuid
 import json
 from datetime import datetime, timedelta
 import pytz
 from bs4 import BeautifulSoup
-import requests
 import calendar
 from flask import (Blueprint, render_template, request, redirect, 
                    url_for, flash, current_app, session, abort, jsonify, g) 
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 
-from app import db, scheduler
-from app.models import Post, TgChannel, VkGroup, OkGroup, MaxChat, User, SocialTokens, Signature, Project, Tariff
+from app import db, http_client
+from app.models import Post, TgChannel, VkGroup, OkGroup, MaxChat, User, SocialTokens, Signature, Project, Tariff, MediaUpload
 from app.services import (
-    publish_post_task, vk_send_service, 
-    tg_delete_service, vk_delete_service
+    vk_send_service, 
+    tg_delete_service, vk_delete_service, forget_staged_media
 )
+from app.services_queue import retry_failed_posts, make_worker_id
+from app.ratelimit import RateLimitError
+from app.media import (store_file, file_size, acquire_media, release_media, unlink_media, media_path,
+                       UploadError, start_upload, received_chunks, write_chunk, finish_upload)
 # , max_send_service
 main_bp = Blueprint('main', __name__)
 
@@ -226,7 +227,8 @@ def index():
             max_chat_id = request.form.get('channel_max')            
             schedule_at_str = request.form.get('schedule')
 
-            if not vk_text_final and not request.files.getlist('media'):
+            upload_ids = request.form.getlist('upload_id')
+            if not vk_text_final and not request.files.getlist('media') and not upload_ids:
                 return jsonify({'status': 'error', 'message': 'Пост не может быть пустым.'}), 400
 
             # --- 4. Кнопки ---
@@ -241,14 +243,23 @@ def index():
             
             # --- 5. Медиа ---
             media_files = [] 
-            upload_folder = current_app.config['UPLOAD_FOLDER']
-            for f in request.files.getlist('media'):
-                if f and f.filename:
-                    ext = os.path.splitext(f.filename)[1]
-                    safe_name = f"{uuid.uuid4()}{ext}"
-                    full_path = os.path.join(upload_folder, safe_name)
-                    f.save(full_path)
-                    media_files.append(safe_name) 
+            # Файлы, заранее загруженные по частям (/uploads), — в порядке из формы
+            finished_uploads = []
+            for upload_id in upload_ids:
+                upload = MediaUpload.query.filter_by(id=upload_id, user_id=current_user.id).first()
+                if not upload or not upload.filename:
+                    return jsonify({'status': 'error', 'message': 'Файл не загружен до конца. Попробуйте еще раз.'}), 400
+                media_files.append(upload.filename)
+                finished_uploads.append(upload)
+            form_files = [f for f in request.files.getlist('media') if f and f.filename]
+            if form_files:
+                # Считаем сами файлы, а не весь запрос с полями формы
+                allowed, msg = current_user.can_store_media(g.project.id, sum(map(file_size, form_files)))
+                if not allowed:
+                    return jsonify({'status': 'error', 'message': msg}), 403
+            for f in form_files:
+                # Имя = хеш содержимого: одинаковые файлы хранятся один раз
+                media_files.append(store_file(f, g.project.id))
 
             # --- 6. ВРЕМЯ (С учетом часового пояса) ---
             scheduled_at_utc = None
@@ -283,14 +294,22 @@ def index():
                     scheduled_at_utc = None
 
             # --- 7. БД: Создаем пост В ТЕКУЩЕМ ПРОЕКТЕ ---
+            # Пока идет прямая отправка в VK (п. 8.1), пост "арендован" этим процессом:
+            # иначе диспетчер мог бы забрать его и отправить в VK второй раз.
+            # Если процесс упадет, после аренды пост подберет очередь.
+            direct_vk = bool(publish_vk and vk_group_id)
+            lease_until = datetime.utcnow() + timedelta(seconds=current_app.config.get('PUBLISH_LEASE_SECONDS', 900))
             new_post = Post(
                 user_id=current_user.id,
                 project_id=g.project.id,
                 text=tg_html,
                 text_vk=vk_text_final,
                 media_files=media_files,
-                status='scheduled',
-                scheduled_at=scheduled_at_utc, 
+                status='publishing' if direct_vk else 'scheduled',
+                locked_by=f"web:{make_worker_id()}" if direct_vk else None,
+                locked_until=lease_until if direct_vk else None,
+                # В БД храним "наивное" UTC-время: с ним сравнивает диспетчер
+                scheduled_at=scheduled_at_utc.replace(tzinfo=None) if scheduled_at_utc else None, 
                 publish_to_tg=publish_tg,
                 publish_to_vk=publish_vk,
                 publish_to_ig=publish_ig,
@@ -304,17 +323,23 @@ def index():
                 platform_info={"buttons": buttons} 
             )
             db.session.add(new_post)
+            acquire_media(media_files, new_post)
+            # Загрузка израсходована: дальше на файл ссылается пост
+            for upload in finished_uploads:
+                db.session.delete(upload)
             db.session.commit()
             current_app.logger.info(f"User {current_user.email} created Post {new_post.id}.")
 
             # --- 8. Запуск ---
             # 8.1. VK (сразу)
-            if publish_vk and vk_group_id:
+            if direct_vk:
+                # Остальные платформы поста публикует очередь
+                queue_platforms = publish_tg or publish_ig or publish_ok or publish_max
                 try:
                     vk_group = VkGroup.query.get(vk_group_id)
                     # Проверяем, что группа принадлежит этому проекту
                     if vk_group and vk_group.project_id == g.project.id:
-                        full_paths = [os.path.join(upload_folder, f) for f in media_files]
+                        full_paths = [media_path(f) for f in media_files]
                         
                         # Получаем токены проекта
                         project_tokens = g.project.tokens
@@ -322,7 +347,6 @@ def index():
                         # Если токенов нет (новое состояние), нужно обработать это, чтобы не упало с NoneType error
                         if not project_tokens:
                             new_post.error_message = "Ошибка: В проекте не настроены соцсети (нет токенов)."
-                            db.session.commit()
                             return jsonify({'status': 'error', 'message': 'Нет токенов в проекте'}), 400
 
                         post_id, err = vk_send_service(
@@ -337,58 +361,35 @@ def index():
                         if err: 
                             new_post.error_message = f"VK Error: {err}"
                             # Если была ошибка и это единственная сеть -> ставим failed
-                            if not (publish_tg or publish_ig):
+                            if not queue_platforms:
                                 new_post.status = 'failed'
                         else:
-                            p_info = new_post.platform_info or {}
+                            p_info = dict(new_post.platform_info or {})
                             p_info['vk_post_id'] = post_id
                             new_post.platform_info = p_info
                             
-                            # Если отправляем ТОЛЬКО в VK (и не планируем TG/IG), 
+                            # Если отправляем ТОЛЬКО в VK (и не планируем другие сети), 
                             # то сразу ставим статус "Опубликовано".
-                            if not (publish_tg or publish_ig) and not scheduled_at_utc:
+                            if not queue_platforms and not scheduled_at_utc:
                                 new_post.status = 'published'
                                 new_post.published_at = datetime.utcnow()
-
-                        db.session.commit()
+                except RateLimitError as e:
+                    # Слот VK не освободится быстро: пост отправит очередь
+                    current_app.logger.info(f"VK direct send deferred to queue: {e}")
+                    new_post.publish_via_queue = True
                 except Exception as e:
                     current_app.logger.error(f"VK direct send error: {e}")
-
-            # 8.2 Планировщик (TG, IG, OK, MAX)
-            task_id = f"post_{new_post.id}"
-            
-            # Если время есть — ставим его. Если нет — ставим "сейчас + 1 сек"
-            if scheduled_at_utc:
-                run_time = scheduled_at_utc
-            else:
-                run_time = datetime.now(pytz.UTC) + timedelta(seconds=2)
-            
-            # Добавляем задачу только если выбрана хотя бы одна отложенная сеть
-            if publish_tg or publish_ig or publish_ok or publish_max:  
-                scheduler.add_job(
-                    publish_post_task, 'date',
-                    run_date=run_time, 
-                    id=task_id, 
-                    args=[new_post.id],
-                    replace_existing=True
-                )
-
-            return jsonify({
-                "status": "ok", 
-                "message": "Пост принят.",
-                "post_id": new_post.id 
-            })              
-            
-            print(f"DEBUG TIME: Задача добавлена в планировщик на {run_time}")            
-
-            if publish_tg or publish_ig or publish_ok or publish_max:  
-                run_time = scheduled_at_utc if scheduled_at_utc else (datetime.utcnow() + timedelta(seconds=1))
-                scheduler.add_job(
-                    publish_post_task, 'date',
-                    run_date=run_time, 
-                    id=task_id, args=[new_post.id],
-                    replace_existing=True
-                )               
+                    db.session.rollback()
+                finally:
+                    # Результат VK записан — отдаем пост очереди
+                    if new_post.status == 'publishing':
+                        new_post.status = 'scheduled'
+                    new_post.locked_by = None
+                    new_post.locked_until = None
+                    db.session.commit()
+
+            # 8.2 TG, IG, OK, MAX публикует диспетчер очереди (app/services_queue.py):
+            # он сам заберет пост, когда наступит scheduled_at (или сразу, если времени нет).
 
             return jsonify({
                 "status": "ok", 
@@ -468,16 +469,15 @@ def delete(post_id):
             # ВАЖНО: Мы передаем теперь 'tokens', а не 'current_user'
             vk_delete_service(tokens, group.group_id, vk_post_id)
 
-    # Files (Удаление файлов)
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    if post.media_files:
-        for f in post.media_files:
-            try:
-                os.remove(os.path.join(upload_folder, f))
-            except OSError: pass
+    # Заранее загруженные медиа пост уже не использует
+    forget_staged_media(post)
+
+    # Files: файл удаляется с диска, только если на него больше не ссылается ни один пост
+    orphaned = release_media(post.media_files, post)
 
     db.session.delete(post)
     db.session.commit()
+    unlink_media(orphaned)
     
     flash('Пост удален.', 'success')
     return redirect(url_for('main.index'))
@@ -509,7 +509,7 @@ def webhook():
 
     if token:
         try:
-            requests.post(
+            http_client.post(
                 f'https://api.telegram.org/bot{token}/answerCallbackQuery',
                 json={"callback_query_id": callback_id, "text": text_to_show, "show_alert": True}, 
                 timeout=5
@@ -518,6 +518,85 @@ def webhook():
     
     return '', 200
 
+@main_bp.route('/retry-failed', methods=['POST'])
+@login_required
+def retry_failed():
+    """Повторная публикация всех неудачных постов текущего проекта (только в несработавшие соцсети)."""
+    if not g.project:
+        abort(403)
+
+    count = retry_failed_posts(g.project.id)
+    if count:
+        flash(f'Постов поставлено на повтор: {count}.', 'success')
+    else:
+        flash('Неудачных постов нет.', 'info')
+    return redirect(url_for('main.index'))
+
+# --- Загрузка больших файлов по частям (см. app/media.py) ---
+# POST /uploads {filename, size}      -> {upload_id, chunk_size, total_chunks, received: []}
+# GET  /uploads/<id>                  -> то же + filename после сборки (для дозагрузки)
+# PUT  /uploads/<id>/chunks/<index>   -> тело запроса = байты части
+# POST /uploads/<id>/complete         -> {upload_id, filename}
+# После сборки upload_id передается в форме поста вместо самого файла.
+
+def _get_upload_or_404(upload_id):
+    upload = MediaUpload.query.get_or_404(upload_id)
+    if upload.user_id != current_user.id:
+        abort(403)
+    return upload
+
+def _upload_json(upload):
+    return {
+        'upload_id': upload.id,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'received': received_chunks(upload),
+        'filename': upload.filename,
+    }
+
+@main_bp.route('/uploads', methods=['POST'])
+@login_required
+def upload_start():
+    data = request.get_json(silent=True) or {}
+    project_id = g.project.id if g.project else None
+    try:
+        size = int(data.get('size') or 0)
+        allowed, msg = current_user.can_store_media(project_id, size)
+        if not allowed:
+            return jsonify({'status': 'error', 'message': msg}), 403
+        upload = start_upload(current_user.id, data.get('filename'), size, project_id)
+        db.session.commit()
+    except (UploadError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify(_upload_json(upload)), 201
+
+@main_bp.route('/uploads/<upload_id>')
+@login_required
+def upload_status(upload_id):
+    return jsonify(_upload_json(_get_upload_or_404(upload_id)))
+
+@main_bp.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    upload = _get_upload_or_404(upload_id)
+    try:
+        write_chunk(upload, index, request.stream)
+    except UploadError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'status': 'ok', 'index': index})
+
+@main_bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def upload_complete(upload_id):
+    upload = _get_upload_or_404(upload_id)
+    try:
+        filename = finish_upload(upload)
+        db.session.commit()
+    except UploadError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'upload_id': upload.id, 'filename': filename})
+
 @main_bp.route('/post-status/<int:post_id>')
 @login_required
 def post_status(post_id):
@@ -526,7 +605,7 @@ def post_status(post_id):
         return jsonify({'status': 'error', 'message': 'Нет доступа'}), 403
         
     status = post.status
-    if status == 'published' or status == 'failed':
+    if status in ('published', 'failed', 'partial', 'retrying'):
         # Рендерим user_now для истории
         user_tz_name = current_user.timezone or 'UTC'
         try:
@@ -7,9 +7,10 @@ import base64     # Для Base64 URL-safe
 from flask import (Blueprint, render_template, request, flash, 
                    redirect, url_for, current_app, abort, session, g)
 from flask_login import login_required, current_user
-from app import db
+from app import db, http_client
 from app.models import SocialTokens, TgChannel, VkGroup, User, Signature, RssSource, Project, Post, RssSource, OkGroup, MaxChat, Tariff, Transaction
 from sqlalchemy.exc import IntegrityError
+from app.services_rss import normalize_feed_url
 from app.services import fetch_tg_channels, fetch_vk_groups, fetch_ok_groups, clear_tg_data, clear_vk_data, clear_ok_data, clear_max_data, delete_project_fully
 from datetime import datetime, timedelta
 
@@ -44,7 +45,7 @@ def social():
                 webhook_url = url_for('main.webhook', _external=True)
                 api_url = f"https://api.telegram.org/bot{tokens.tg_token}/setWebhook"
 
-                resp = requests.post(api_url, json={"url": webhook_url}, timeout=5)
+                resp = http_client.post(api_url, json={"url": webhook_url}, timeout=5)
 
                 if resp.ok and resp.json().get('result') == True:
                     flash('Вебхук Telegram успешно установлен!', 'info')
@@ -57,7 +58,7 @@ def social():
             # Пытаемся проверить токен
             try:
                 TG_API_URL = f"https://api.telegram.org/bot{tokens.tg_token}/getMe"
-                resp = requests.get(TG_API_URL, timeout=5)
+                resp = http_client.get(TG_API_URL, timeout=5)
                 if resp.ok:
                     bot_name = resp.json()['result']['username']
                     flash(f'Токен Telegram для @{bot_name} успешно сохранен.', 'success')
@@ -66,6 +67,10 @@ def social():
             except Exception as e:
                 flash(f'Ошибка проверки токена: {e}', 'danger')
                 
+        tg_cache_chat_form = request.form.get('tg_cache_chat_id')
+        if tg_cache_chat_form is not None:
+            tokens.tg_cache_chat_id = tg_cache_chat_form.strip() or None
+
         # --- 2. VK ---
         vk_token_form = request.form.get('vk_token')
         if vk_token_form:
@@ -322,7 +327,7 @@ def vk_callback():
             'state': state                      
         }
 
-        resp = requests.post(token_url, data=params, timeout=10) 
+        resp = http_client.post(token_url, data=params, timeout=10) 
         resp.raise_for_status() 
         data = resp.json()
         
@@ -447,20 +452,22 @@ def rss_add():
         user_id=current_user.id,
         project_id=g.project.id,
         url=url,
+        normalized_url=normalize_feed_url(url),
         name=name,
         publish_to_tg=pub_tg,
         tg_channel_id=tg_id if pub_tg else None,
         publish_to_vk=pub_vk,
         vk_group_id=vk_id if pub_vk else None,
         publish_to_ok=publish_ok,
-        ok_group_id=ok_group_id        
+        ok_group_id=ok_group_id,
+        next_poll_at=datetime.utcnow()  # первый опрос — на ближайшем запуске
         # publish_to_max=pub_max
     )
     
     db.session.add(new_source)
     db.session.commit()
     
-    flash('RSS источник добавлен. Посты появятся в течение 15 минут.', 'success')
+    flash('RSS источник добавлен. Посты появятся в течение нескольких минут.', 'success')
     return redirect(url_for('settings.social'))
 
 @settings_bp.route('/rss/delete/<int:source_id>')
@@ -585,7 +592,7 @@ def ok_callback():
     redirect_uri = url_for('settings.ok_callback', _external=True)
     
     try:
-        resp = requests.post('https://api.ok.ru/oauth/token.do', data={
+        resp = http_client.post('https://api.ok.ru/oauth/token.do', data={
             'code': code,
             'client_id': client_id,
             'client_secret': client_secret,
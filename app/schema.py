@@ -0,0 +1,99 @@
+# app/schema.py
+import logging
+from sqlalchemy import inspect, text, literal
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ОБНОВЛЕНИЕ СХЕМЫ СУЩЕСТВУЮЩЕЙ БД
+# --------------------------------------------------------------------------
+# Миграций в проекте нет: db.create_all() создает только недостающие таблицы,
+# а в уже существующие новые колонки и индексы не добавляет — после обновления
+# кода первый же запрос к такой таблице упал бы. upgrade_schema() при старте
+# приложения добавляет то, чего в БД еще нет (ALTER TABLE ... ADD COLUMN,
+# CREATE INDEX); повторный запуск ничего не меняет.
+#
+# Добавили колонку в существующую таблицу — допишите ее в COLUMNS,
+# индекс по существующим колонкам — в INDEXES. Определение (тип, DEFAULT для
+# NOT NULL) берется из модели.
+
+# (таблица, колонка)
+COLUMNS = [
+    # Очередь публикаций: аренда поста воркером (app/services_queue.py)
+    ('posts', 'locked_by'),
+    ('posts', 'locked_until'),
+    # Автоповтор неудачных отправок
+    ('posts', 'retry_count'),
+    ('posts', 'next_retry_at'),
+    # Предзагрузка медиа отложенных постов
+    ('posts', 'media_staged_at'),
+    # VK-only посты RSS публикует очередь
+    ('posts', 'publish_via_queue'),
+    ('social_tokens', 'tg_cache_chat_id'),
+    # Условный GET лент RSS
+    ('rss_sources', 'etag'),
+    ('rss_sources', 'modified'),
+    ('rss_sources', 'last_status'),
+    # Расписание опроса RSS (next_poll_at — с индексом)
+    ('rss_sources', 'next_poll_at'),
+    ('rss_sources', 'poll_interval'),
+    ('rss_sources', 'error_count'),
+    # Группировка одинаковых лент (с индексом; заполняется fill_normalized_urls)
+    ('rss_sources', 'normalized_url'),
+]
+
+# (таблица, имя индекса из модели)
+INDEXES = [
+    # Выборка готовых постов диспетчером
+    ('posts', 'ix_posts_status_scheduled_at'),
+]
+
+def _column_ddl(column, dialect):
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        ddl += " DEFAULT " + str(literal(default, column.type).compile(
+            dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if not column.nullable:
+        if default is None:
+            raise RuntimeError(f"{column.table.name}.{column.name}: NOT NULL без DEFAULT не добавить в заполненную таблицу")
+        ddl += " NOT NULL"
+    return ddl
+
+def upgrade_schema():
+    """Добавляет в существующие таблицы недостающие колонки и индексы. Требует app_context."""
+    engine = db.engine
+    tables = db.metadata.tables
+    added = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        existing = set(inspector.get_table_names())
+        for table_name, column_name in COLUMNS:
+            if table_name not in existing:
+                continue  # таблицу только что создал create_all — уже с колонкой
+            columns = {c['name'] for c in inspector.get_columns(table_name)}
+            if column_name in columns:
+                continue
+            column = tables[table_name].c[column_name]
+            conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {_column_ddl(column, engine.dialect)}"))
+            added.append(f"{table_name}.{column_name}")
+
+    # Индексы: и для колонок с index=True, и составные из INDEXES
+    wanted = {(t, n) for t, n in INDEXES}
+    wanted |= {(t, index.name) for t, c in COLUMNS for index in tables[t].indexes
+               if c in index.columns}
+    with engine.begin() as conn:
+        for table_name, index_name in sorted(wanted):
+            if table_name not in existing:
+                continue
+            if index_name in {i['name'] for i in inspect(conn).get_indexes(table_name)}:
+                continue
+            index = next(i for i in tables[table_name].indexes if i.name == index_name)
+            index.create(bind=conn)
+            added.append(index_name)
+
+    if added:
+        logger.info(f"Schema: добавлено: {', '.join(added)}")
+    return added
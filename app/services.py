@@ -5,21 +5,72 @@ import logging
 import requests
 import base64
 import hashlib
+import random
+import socket
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import mimetypes  
+from concurrent.futures import ThreadPoolExecutor
 import vk_api
 from vk_api.upload import VkUpload
 from flask import current_app, url_for
+from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
 from requests.exceptions import ConnectionError, Timeout, RequestException
 
-from app import db, scheduler 
+from app import db, scheduler, task_context
+from app import ratelimit, http_client
+from app.leader import leader_only
+from app.media import (release_posts_media, unlink_media, media_path, upload_cache_enabled,
+                       cached_upload, remember_upload, forget_upload)
+from app.media_processing import platform_media
+from app.multipart import MultipartStream
 from app.models import User, Post, SocialTokens, TgChannel, VkGroup, OkGroup, MaxChat, RssSource, Project, Tariff, Transaction
-# Принудительно меняем адрес API VK по умолчанию
-vk_api.vk_api.VkApi.DEFAULT_API_HOST = 'api.vk.ru'
+# Адрес API VK, который vk_api прописывает в запросах жестко
+VK_DEFAULT_API_BASE = 'https://api.vk.ru'
 
 logger = logging.getLogger(__name__)
 
+# --------------------------------------------------------------------------
+#  ПАРАЛЛЕЛЬНАЯ ЗАГРУЗКА МЕДИА ВНУТРИ ОДНОЙ ОТПРАВКИ
+# --------------------------------------------------------------------------
+# Фото и видео поста загружаются в VK/OK не по очереди, а параллельно.
+# Одновременно у проекта (в пределах процесса) идет не больше
+# MEDIA_UPLOAD_CONCURRENCY загрузок — сколько бы постов и соцсетей ни публиковалось.
+
+_upload_slots = {}
+_upload_slots_lock = threading.Lock()
+
+def _project_upload_slot(project_id):
+    with _upload_slots_lock:
+        slot = _upload_slots.get(project_id)
+        if slot is None:
+            slot = _upload_slots[project_id] = threading.BoundedSemaphore(
+                current_app.config.get('MEDIA_UPLOAD_CONCURRENCY', 3))
+        return slot
+
+def _upload_parallel(project_id, func, items):
+    """
+    Вызывает func(item) для всех items параллельно (каждый вызов — в своем app_context)
+    и возвращает результаты в исходном порядке. Исключение вызова возвращается вместо результата.
+    """
+    app = current_app._get_current_object()
+    slot = _project_upload_slot(project_id)
+
+    def run(item):
+        with slot, app.app_context():
+            try:
+                return func(item)
+            except Exception as e:
+                return e
+
+    if len(items) <= 1:
+        return [run(item) for item in items]
+    workers = min(len(items), current_app.config.get('MEDIA_UPLOAD_CONCURRENCY', 3))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media-upload') as pool:
+        return list(pool.map(run, items))
+
 # --------------------------------------------------------------------------
 #  VK: ЛОГИКА АВТО-ОБНОВЛЕНИЯ ТОКЕНА
 # --------------------------------------------------------------------------
@@ -41,7 +92,7 @@ def _refresh_vk_token(tokens_obj):
             'state': state
         }
         
-        resp = requests.post('https://id.vk.ru/oauth2/auth', data=refresh_params, timeout=10)
+        resp = http_client.post('https://id.vk.ru/oauth2/auth', data=refresh_params, timeout=10)
         resp.raise_for_status() 
         data = resp.json()
         
@@ -84,7 +135,20 @@ def get_valid_vk_session(tokens_obj):
             return None
         current_access_token = new_token
         
-    return vk_api.VkApi(token=current_access_token, api_version='5.199')
+    return vk_api.VkApi(token=current_access_token, api_version='5.199', session=_vk_http_session())
+
+class _VkBaseUrlSession(requests.Session):
+    """HTTP-сессия для vk_api, перенаправляющая запросы к API на VK_API_BASE."""
+
+    def request(self, method, url, *args, **kwargs):
+        base_url = current_app.config.get('VK_API_BASE', VK_DEFAULT_API_BASE).rstrip('/')
+        if base_url != VK_DEFAULT_API_BASE and url.startswith(VK_DEFAULT_API_BASE):
+            url = base_url + url[len(VK_DEFAULT_API_BASE):]
+        return super().request(method, url, *args, **kwargs)
+
+def _vk_http_session():
+    """Общая (keep-alive) сессия для всех VkApi процесса."""
+    return http_client.session_for(VK_DEFAULT_API_BASE, _VkBaseUrlSession)
 
 
 # --------------------------------------------------------------------------
@@ -92,10 +156,63 @@ def get_valid_vk_session(tokens_obj):
 # --------------------------------------------------------------------------
 
 def TG_API(token, method):
-    return f'https://api.telegram.org/bot{token}/{method}'
+    base_url = current_app.config.get('TG_API_BASE', 'https://api.telegram.org')
+    return f'{base_url}/bot{token}/{method}'
 
-def tg_send_service(token, chat_id, text, media_paths, buttons_json):
+# Сколько раз повторяем запрос после ответа 429 Too Many Requests
+TG_MAX_ATTEMPTS = 3
+
+def _tg_retry_after(resp):
+    """Достает retry_after (сек) из ответа 429 Telegram."""
+    try:
+        return int(resp.json().get('parameters', {}).get('retry_after', 5))
+    except Exception:
+        return 5
+
+def _tg_post(token, chat_id, method, files=None, **kwargs):
+    """
+    POST в Bot API с учетом общих лимитов (на бота и на чат).
+    На 429 блокирует чат на retry_after для всего кластера и повторяет запрос.
+    files — {имя поля: путь}: тело собирается потоково (MultipartStream), файлы
+    читаются с диска кусками и не держатся в памяти целиком.
+    """
+    bot_key = ratelimit.tg_bot_key(token)
+    chat_key = f"{bot_key}:{chat_id}"
+
+    for attempt in range(TG_MAX_ATTEMPTS):
+        ratelimit.acquire('tg_bot', bot_key)
+        ratelimit.acquire('tg_chat', chat_key)
+
+        if files:
+            # Тело собирается заново на каждую попытку; файлы закрываются при выходе из with
+            request = dict(kwargs)
+            with MultipartStream(request.pop('data', None), files) as body:
+                resp = http_client.post(TG_API(token, method), data=body,
+                                        headers={'Content-Type': body.content_type}, **request)
+        else:
+            resp = http_client.post(TG_API(token, method), **kwargs)
+        if resp.status_code != 429:
+            return resp
+
+        retry_after = _tg_retry_after(resp)
+        logger.warning(f"TG 429 ({method}, chat {chat_id}): retry after {retry_after} сек.")
+        ratelimit.penalize('tg_chat', chat_key, retry_after)
+
+    return resp
+
+def _tg_file_id(message):
+    """file_id медиа из отправленного сообщения (для кеша загрузок)."""
+    if message.get('photo'):
+        return message['photo'][-1].get('file_id')
+    for key in ('video', 'animation', 'document'):
+        if message.get(key):
+            return message[key].get('file_id')
+    return None
+
+def tg_send_service(token, chat_id, text, media_paths, buttons_json, use_cache=True):
     buttons = json.loads(buttons_json) if buttons_json else []
+    # file_id в Telegram действует для бота (в любом чате), поэтому кеш — по боту
+    bot_key = ratelimit.tg_bot_key(token)
     
     def make_kb():
         return {
@@ -106,28 +223,41 @@ def tg_send_service(token, chat_id, text, media_paths, buttons_json):
             ]]
         }
 
+    def resend_without_cache(file_ids, description):
+        # file_id из кеша отклонен — забываем и отправляем файлы заново
+        logger.warning(f"TG: file_id из кеша отклонен ({description}), загружаю заново.")
+        for p, file_id in file_ids.items():
+            if file_id:
+                forget_upload(p, 'tg', bot_key)
+        return tg_send_service(token, chat_id, text, media_paths, buttons_json, use_cache=False)
+
+    file_ids = {p: cached_upload(p, 'tg', bot_key) if use_cache else None for p in media_paths}
+
     # 1. Один файл
     if len(media_paths) == 1:
         path = media_paths[0]
         is_photo = path.lower().endswith(('.jpg', '.png', '.jpeg', '.webp'))
         field = 'photo' if is_photo else 'video'
         method = 'sendPhoto' if is_photo else 'sendVideo'
+        data = {
+            "chat_id": chat_id,
+            "caption": text,
+            "parse_mode": "HTML",
+            **({"reply_markup": json.dumps(make_kb())} if buttons else {})
+        }
         
         try:
-            with open(path, 'rb') as f:
-                resp = requests.post(
-                    TG_API(token, method),
-                    data={
-                        "chat_id": chat_id,
-                        "caption": text,
-                        "parse_mode": "HTML",
-                        **({"reply_markup": json.dumps(make_kb())} if buttons else {})
-                    },
-                    files={field: f},
-                    timeout=60
-                )
+            if file_ids[path]:
+                resp = _tg_post(token, chat_id, method, data={**data, field: file_ids[path]}, timeout=60)
+            else:
+                resp = _tg_post(token, chat_id, method, data=data, files={field: path}, timeout=60)
             if resp.ok: 
-                return resp.json()['result']['message_id'], None
+                message = resp.json()['result']
+                if not file_ids[path]:
+                    remember_upload(path, 'tg', bot_key, _tg_file_id(message))
+                return message['message_id'], None
+            if file_ids[path]:
+                return resend_without_cache(file_ids, resp.json().get('description'))
             return None, resp.json().get('description')
         except Exception as e:
             return None, str(e)
@@ -142,32 +272,38 @@ def tg_send_service(token, chat_id, text, media_paths, buttons_json):
                 name = os.path.basename(p)
                 media.append({
                     "type": typ,
-                    "media": f'attach://{name}',
+                    "media": file_ids[p] or f'attach://{name}',
                     **({"caption": text, "parse_mode": "HTML"} if i == 0 else {})
                 })
-                files[name] = open(p, 'rb')
+                if not file_ids[p]:
+                    files[name] = p
                 
-            resp = requests.post(TG_API(token, 'sendMediaGroup'),
-                                 data={"chat_id": chat_id, "media": json.dumps(media)},
-                                 files=files, timeout=120)
-            for fh in files.values(): fh.close()
+            resp = _tg_post(token, chat_id, 'sendMediaGroup',
+                            data={"chat_id": chat_id, "media": json.dumps(media)},
+                            files=files, timeout=120)
             
             if resp.ok:
-                return resp.json()['result'][0]['message_id'], None
+                messages = resp.json()['result']
+                if len(messages) == len(media_paths):
+                    for p, message in zip(media_paths, messages):
+                        if not file_ids[p]:
+                            remember_upload(p, 'tg', bot_key, _tg_file_id(message))
+                return messages[0]['message_id'], None
+            if any(file_ids.values()):
+                return resend_without_cache(file_ids, resp.json().get('description'))
             return None, resp.json().get('description')
         except Exception as e:
-            for fh in files.values(): fh.close()
             return None, str(e)
         
     # 3. Текст
     try:
-        resp = requests.post(TG_API(token, 'sendMessage'),
-                             json={
-                                 "chat_id": chat_id,
-                                 "text": text or ".",
-                                 "parse_mode": "HTML",
-                                 **({"reply_markup": json.dumps(make_kb())} if buttons else {})
-                             }, timeout=30)
+        resp = _tg_post(token, chat_id, 'sendMessage',
+                        json={
+                            "chat_id": chat_id,
+                            "text": text or ".",
+                            "parse_mode": "HTML",
+                            **({"reply_markup": json.dumps(make_kb())} if buttons else {})
+                        }, timeout=30)
         logger.info(f"Tg text: {resp.text}")
         if resp.ok: 
             return resp.json()['result']['message_id'], None
@@ -178,7 +314,7 @@ def tg_send_service(token, chat_id, text, media_paths, buttons_json):
 
 def tg_delete_service(token, chat_id, msg_id):
     try:
-        resp = requests.post(TG_API(token, 'deleteMessage'),
+        resp = http_client.post(TG_API(token, 'deleteMessage'),
             json={"chat_id": chat_id, "message_id": msg_id}, timeout=10)
         if resp.ok: return True, None
         return False, resp.json().get('description')
@@ -188,12 +324,12 @@ def tg_delete_service(token, chat_id, msg_id):
 def fetch_tg_channels(token, user_id):
     """Получает список каналов, где бот является админом."""
     try:
-        me_resp = requests.get(TG_API(token, 'getMe'), timeout=10)
+        me_resp = http_client.get(TG_API(token, 'getMe'), timeout=10)
         if not me_resp.ok:
             return None, "Неверный токен (getMe)"
         bot_id = me_resp.json()['result']['id']
         
-        updates_resp = requests.get(TG_API(token, 'getUpdates'), params={"limit": 50}, timeout=10)
+        updates_resp = http_client.get(TG_API(token, 'getUpdates'), params={"limit": 50}, timeout=10)
         
         chats = {} 
         if updates_resp.ok:
@@ -203,7 +339,7 @@ def fetch_tg_channels(token, user_id):
                 if not chat: continue
                 if chat['type'] in ['channel', 'supergroup']:
                     try:
-                        admin_resp = requests.get(TG_API(token, 'getChatMember'), 
+                        admin_resp = http_client.get(TG_API(token, 'getChatMember'), 
                                                   params={'chat_id': chat['id'], 'user_id': bot_id},
                                                   timeout=5)
                         if admin_resp.ok and admin_resp.json()['result']['status'] in ['administrator', 'creator']:
@@ -238,27 +374,17 @@ def vk_send_service(project_tokens, group_id, text, media_paths,
     if vk_session is None:
         return None, "Не удалось получить/обновить VK токен."
 
+    gid = abs(int(group_id))
     try:
+        ratelimit.acquire('vk_group', gid)
         vk_upload  = VkUpload(vk_session)
+        # Загрузки тоже через общую сессию (VkUpload создает свою на каждый вызов)
+        vk_upload.http = vk_session.http
         vk_api_raw = vk_session.get_api()
-        attach = []
-        
-        for p in media_paths:
-            if p.lower().endswith(('.jpg', '.png', '.jpeg')):
-                try:
-                    a = vk_upload.photo_wall(p, group_id=abs(int(group_id)))[0]
-                    attach.append(f"photo{a['owner_id']}_{a['id']}")
-                except Exception as e:
-                    logger.error(f"VK Photo Upload Error: {e}")
-            elif p.lower().endswith(('.mp4', '.mov', '.avi')):
-                try:
-                    v = vk_upload.video(video_file=p, name=text[:50], group_id=abs(int(group_id)))
-                    attach.append(f"video{v['owner_id']}_{v['video_id']}")
-                except Exception as e:
-                    logger.error(f"VK Video Upload Error: {e}")
+        attach, cached = _vk_upload_attachments(vk_upload, gid, media_paths, text, project_tokens.project_id)
         
         wall_params = dict(
-            owner_id=-abs(int(group_id)),
+            owner_id=-gid,
             from_group=1,
             message=text,
             attachments=",".join(attach)
@@ -271,12 +397,124 @@ def vk_send_service(project_tokens, group_id, text, media_paths,
         if schedule_at_utc:
             wall_params['publish_date'] = int(schedule_at_utc.timestamp())
 
-        post = vk_api_raw.wall.post(**wall_params)
+        try:
+            post = _vk_wall_post(vk_api_raw, gid, wall_params)
+        except vk_api.exceptions.ApiError as e:
+            if not cached:
+                raise
+            # Вложения из кеша могли быть удалены в VK — загружаем всё заново
+            logger.warning(f"VK: вложения из кеша отклонены ({e}), загружаю заново.")
+            for p in cached:
+                forget_upload(p, 'vk', gid)
+            attach, _ = _vk_upload_attachments(vk_upload, gid, media_paths, text, project_tokens.project_id,
+                                               use_cache=False)
+            wall_params['attachments'] = ",".join(attach)
+            post = _vk_wall_post(vk_api_raw, gid, wall_params)
         return post['post_id'], None
+    except ratelimit.RateLimitError:
+        # Отправку отложит вызывающий (routes_main отдает пост очереди)
+        raise
     except Exception as e:
         logger.error(f"VK send error: {e}")
         return None, str(e)
 
+VK_PHOTO_EXTS = ('.jpg', '.png', '.jpeg')
+VK_VIDEO_EXTS = ('.mp4', '.mov', '.avi')
+
+def _vk_upload_attachments(vk_upload, gid, media_paths, text, project_id, use_cache=True):
+    """
+    Загружает медиа на стену группы и возвращает (вложения для wall.post, пути, взятые из кеша).
+    Файлы, которые уже загружались в эту группу, берутся из кеша без загрузки,
+    остальные загружаются параллельно (см. _upload_parallel), а загруженные фото
+    сохраняются пачками через execute. Порядок вложений = порядок файлов.
+    """
+    media = [p for p in media_paths if p.lower().endswith(VK_PHOTO_EXTS + VK_VIDEO_EXTS)]
+    remote_ids = {p: cached_upload(p, 'vk', gid) if use_cache else None for p in media}
+    cached = [p for p in media if remote_ids[p]]
+    to_upload = [p for p in media if not remote_ids[p]]
+
+    # Сервер загрузки на стену один на все фото отправки (на сервер — одно фото за запрос)
+    photo_upload_url = None
+    if any(p.lower().endswith(VK_PHOTO_EXTS) for p in to_upload):
+        photo_upload_url = vk_upload.vk.photos.getWallUploadServer(group_id=gid)['upload_url']
+
+    def upload(p):
+        if p.lower().endswith(VK_PHOTO_EXTS):
+            return _vk_upload_wall_photo(vk_upload, photo_upload_url, p)
+        v = vk_upload.video(video_file=p, name=text[:50], group_id=gid)
+        return f"video{v['owner_id']}_{v['video_id']}"
+
+    uploaded_photos = []
+    for p, result in zip(to_upload, _upload_parallel(project_id, upload, to_upload)):
+        if isinstance(result, Exception):
+            kind = 'Photo' if p.lower().endswith(VK_PHOTO_EXTS) else 'Video'
+            logger.error(f"VK {kind} Upload Error: {result}")
+        elif isinstance(result, dict):
+            uploaded_photos.append((p, result))
+        else:
+            remote_ids[p] = result
+            remember_upload(p, 'vk', gid, result)
+
+    if uploaded_photos:
+        try:
+            saved = _vk_save_wall_photos(vk_upload, gid, [r for _, r in uploaded_photos])
+        except Exception as e:
+            logger.error(f"VK Photo Save Error: {e}")
+            saved = [None] * len(uploaded_photos)
+        for (p, _), remote_id in zip(uploaded_photos, saved):
+            if remote_id:
+                remote_ids[p] = remote_id
+                remember_upload(p, 'vk', gid, remote_id)
+
+    attach = [remote_ids[p] for p in media if remote_ids[p]]
+    return attach, cached
+
+def _vk_upload_wall_photo(vk_upload, upload_url, path):
+    """Загружает одно фото на сервер загрузки стены. Возвращает ответ сервера (server/photo/hash)."""
+    with open(path, 'rb') as f:
+        response = vk_upload.http.post(upload_url, files={'photo': (os.path.basename(path), f)}).json()
+    if not response.get('photo') or response.get('photo') == '[]':
+        raise ValueError(f"VK не принял фото: {response}")
+    return response
+
+# Сколько вызовов API можно сделать за один execute
+VK_EXECUTE_LIMIT = 25
+
+def _vk_save_wall_photos(vk_upload, gid, responses):
+    """
+    photos.saveWallPhoto для пачки загруженных фото — одним вызовом execute на каждые
+    VK_EXECUTE_LIMIT фото вместо отдельного вызова на фото (vk_api выдерживает паузу между вызовами).
+    Возвращает 'photo<owner>_<id>' для каждого фото (None, если фото не сохранилось).
+    """
+    result = []
+    for i in range(0, len(responses), VK_EXECUTE_LIMIT):
+        calls = ",".join(
+            f"API.photos.saveWallPhoto({json.dumps(dict(response, group_id=gid))})"
+            for response in responses[i:i + VK_EXECUTE_LIMIT]
+        )
+        for saved in vk_upload.vk.execute(code=f"return [{calls}];"):
+            result.append(f"photo{saved[0]['owner_id']}_{saved[0]['id']}" if saved else None)
+    return result
+
+# Код ошибки VK "Flood control" (слишком много однотипных действий)
+VK_FLOOD_CONTROL_CODE = 9
+
+def _vk_wall_post(vk_api_raw, gid, wall_params):
+    """
+    wall.post с обработкой flood control: группа блокируется для всего кластера
+    на RATE_LIMIT_FLOOD_DELAY_SECONDS, после чего отправка повторяется один раз.
+    (Ошибку 6 "Too many requests per second" vk_api обрабатывает сам.)
+    """
+    try:
+        return vk_api_raw.wall.post(**wall_params)
+    except vk_api.exceptions.ApiError as e:
+        if e.code != VK_FLOOD_CONTROL_CODE:
+            raise
+        logger.warning(f"VK flood control для группы {gid}, откладываю отправку.")
+        ratelimit.penalize('vk_group', gid, current_app.config.get('RATE_LIMIT_FLOOD_DELAY_SECONDS', 60))
+        ratelimit.acquire('vk_group', gid)
+        return vk_api_raw.wall.post(**wall_params)
+
 def vk_delete_service(tokens_obj, owner_id, post_id):
     vk_session = get_valid_vk_session(tokens_obj)
     if vk_session is None: return False, "Ошибка токена VK"
@@ -347,7 +585,7 @@ def _refresh_ok_token(tokens_obj):
             logger.error("OK Refresh: нет refresh_token или ключей приложения.")
             return False
 
-        resp = requests.post('https://api.ok.ru/oauth/token.do', data={
+        resp = http_client.post(f"{current_app.config.get('OK_API_BASE', 'https://api.ok.ru')}/oauth/token.do", data={
             'refresh_token': refresh_token,
             'grant_type': 'refresh_token',
             'client_id': client_id,
@@ -399,7 +637,8 @@ def _ok_make_request(tokens, method, params_dict):
     req_params['access_token'] = token
     req_params['sig'] = signature
     
-    resp = requests.post("https://api.ok.ru/fb.do", data=req_params, timeout=60)
+    base_url = current_app.config.get('OK_API_BASE', 'https://api.ok.ru')
+    resp = http_client.post(f"{base_url}/fb.do", data=req_params, timeout=60)
     return resp.json()
 
 def _ok_upload_images(tokens, group_id, image_paths):
@@ -433,27 +672,22 @@ def _ok_upload_images(tokens, group_id, image_paths):
         # 2. Формируем файлы с указанием MIME-типа
         # Это критически важно для OK API, иначе токен будет невалидным
         files = {}
-        opened_files = []
         
         for i, path in enumerate(image_paths):
-            f = open(path, 'rb')
-            opened_files.append(f)
-            
             filename = os.path.basename(path)
             # Определяем тип файла (image/jpeg, image/png и т.д.)
             mime_type, _ = mimetypes.guess_type(path)
             if not mime_type:
                 mime_type = 'image/jpeg' # Фолбэк
             
-            # Структура: 'ключ': ('имя_файла', поток, 'mime/type')
-            files[f"pic{i+1}"] = (filename, f, mime_type)
+            # Структура: 'ключ': ('имя_файла', путь, 'mime/type')
+            files[f"pic{i+1}"] = (filename, path, mime_type)
             
-        # 3. Отправляем
+        # 3. Отправляем потоково: файлы читаются с диска кусками по одному
         # Таймаут побольше, так как загрузка медиа может быть долгой
-        up_resp = requests.post(upload_url, files=files, timeout=120)
-        
-        # Закрываем файлы
-        for f in opened_files: f.close()
+        with MultipartStream(files=files) as body:
+            up_resp = http_client.post(upload_url, data=body, timeout=120,
+                                       headers={'Content-Type': body.content_type})
         
         res_json = up_resp.json()
         logger.info(f"OK Upload Response: {res_json}") 
@@ -514,7 +748,7 @@ def _ok_upload_video(tokens, group_id, video_path):
             
         # 2. Загружаем файл
         with open(video_path, 'rb') as f:
-            requests.post(upload_url, data=f, timeout=300) # data=f для потоковой загрузки
+            http_client.post(upload_url, data=f, timeout=300) # data=f для потоковой загрузки
             
         # 3. Возвращаем ID
         # (В OK видео становится доступным не сразу, но ID мы получаем сразу)
@@ -524,6 +758,53 @@ def _ok_upload_video(tokens, group_id, video_path):
         logger.error(f"OK Video Upload Error: {e}")
         return None
 
+def _ok_upload_media(tokens, group_id, images, videos, use_cache=True):
+    """
+    Загружает фото и видео в группу OK и возвращает (элементы media для mediatopic.post,
+    пути видео, взятых из кеша). Уже загруженные в эту группу видео повторно не загружаются.
+    Фото загружаются каждый раз: токен фото OK одноразовый (действует до первого поста).
+    Фото уходят одним запросом (pic1..picN), видео — параллельно с ним и друг с другом.
+    """
+    items = []
+
+    video_ids = {p: cached_upload(p, 'ok', group_id) if use_cache else None for p in videos}
+    cached = [p for p in videos if video_ids[p]]
+    videos_to_upload = [p for p in videos if not video_ids[p]]
+
+    # Задания: одно на пачку фото и по одному на каждое видео
+    jobs = ([('photos', images)] if images else []) + [('video', p) for p in videos_to_upload]
+
+    def upload(job):
+        kind, payload = job
+        if kind == 'photos':
+            return _ok_upload_images(tokens, group_id, payload)
+        return _ok_upload_video(tokens, group_id, payload)
+
+    uploaded_photos = []
+    for (kind, payload), result in zip(jobs, _upload_parallel(tokens.project_id, upload, jobs)):
+        if isinstance(result, Exception):
+            logger.error(f"OK: Ошибка при загрузке {'фото' if kind == 'photos' else 'видео'}: {result}")
+        elif kind == 'photos':
+            uploaded_photos = result
+        elif result:
+            video_ids[payload] = result["id"]
+            remember_upload(payload, 'ok', group_id, result["id"])
+
+    if uploaded_photos:
+        items.append({"type": "photo", "list": uploaded_photos})
+
+    movie_list = [{"id": video_ids[p]} for p in videos if video_ids[p]]
+    if movie_list:
+        items.append({"type": "movie", "list": movie_list})
+
+    return items, cached
+
+def _ok_split_media(media_paths):
+    """(фото, видео) из списка файлов — остальные форматы OK не принимает."""
+    images = [p for p in media_paths if p.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+    videos = [p for p in media_paths if p.lower().endswith(('.mp4', '.mov', '.avi'))]
+    return images, videos
+
 def ok_send_service(project_tokens, group_id, text, media_paths):
     """
     Отправка поста в OK с Фото и Видео.
@@ -532,49 +813,37 @@ def ok_send_service(project_tokens, group_id, text, media_paths):
         return None, "Нет токена OK"
 
     # 1. Сортируем файлы
-    images = [p for p in media_paths if p.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
-    videos = [p for p in media_paths if p.lower().endswith(('.mp4', '.mov', '.avi'))]
+    images, videos = _ok_split_media(media_paths)
 
-    media_json = []
+    def build_params(use_cache):
+        media_json = []
 
-    # 2. Добавляем Текст
-    if text:
-        media_json.append({"type": "text", "text": text})
+        # 2. Добавляем Текст
+        if text:
+            media_json.append({"type": "text", "text": text})
 
-    # 3. Загружаем и добавляем Фото
-    if images:
-        try:
-            photo_list = _ok_upload_images(project_tokens, group_id, images)
-            if photo_list:
-                media_json.append({"type": "photo", "list": photo_list})
-        except Exception as e:
-            logger.error(f"OK: Ошибка при загрузке фото: {e}")
+        # 3-4. Загружаем (или берем из кеша) Фото и Видео
+        media_items, cached = _ok_upload_media(project_tokens, group_id, images, videos, use_cache)
+        media_json.extend(media_items)
 
-    # 4. Загружаем и добавляем Видео
-    if videos:
-        movie_list = []
-        for v_path in videos:
-            v_res = _ok_upload_video(project_tokens, group_id, v_path)
-            if v_res:
-                movie_list.append(v_res)
-        
-        if movie_list:
-             media_json.append({"type": "movie", "list": movie_list})
+        if not media_json:
+            return None, cached
+
+        # 5. Формируем финальный запрос
+        attachment_str = json.dumps({"media": media_json}, separators=(',', ':'), ensure_ascii=False)
+        return {
+            "gid": str(group_id),
+            "type": "GROUP_THEME",
+            "attachment": attachment_str
+        }, cached
 
-    if not media_json:
+    params, cached = build_params(use_cache=True)
+    if params is None:
          return None, "Пустой пост (нет текста и медиа не загрузились)"
-         
-    # 5. Формируем финальный запрос
-    attachment_str = json.dumps({"media": media_json}, separators=(',', ':'), ensure_ascii=False)
-    
-    params = {
-        "gid": str(group_id),
-        "type": "GROUP_THEME",
-        "attachment": attachment_str
-    }
     
     # Попытка отправки с ретраем на 102 ошибку
     try:
+        ratelimit.acquire('ok_group', group_id)
         data = _ok_make_request(project_tokens, "mediatopic.post", params)
     except Exception as e:
         return None, str(e)
@@ -592,6 +861,18 @@ def ok_send_service(project_tokens, group_id, text, media_paths):
         else:
             return None, "OK: Токен истек."
 
+    # Видео из кеша могли устареть — загружаем заново и повторяем пост один раз
+    if isinstance(data, dict) and "error_code" in data and cached:
+        logger.warning(f"OK: медиа из кеша отклонены ({data.get('error_msg')}), загружаю заново.")
+        for p in cached:
+            forget_upload(p, 'ok', group_id)
+        params, _ = build_params(use_cache=False)
+        if params is not None:
+            try:
+                data = _ok_make_request(project_tokens, "mediatopic.post", params)
+            except Exception as e:
+                return None, str(e)
+
     if isinstance(data, dict) and "error_code" in data:
         return None, f"OK Error {data.get('error_code')}: {data.get('error_msg')}"
         
@@ -660,10 +941,10 @@ def max_send_service(project_tokens, chat_id, text):
     token = project_tokens.max_token
     if not token: return None, "Нет токена MAX."
     try:
-        url = "https://api.max-messenger.com/api/v1/send" 
+        url = f"{current_app.config.get('MAX_API_BASE', 'https://api.max-messenger.com')}/api/v1/send"
         payload = {"chat_id": chat_id, "message": text}
         headers = {"Authorization": f"Bearer {token}"}
-        resp = requests.post(url, json=payload, headers=headers, timeout=10)
+        resp = http_client.post(url, json=payload, headers=headers, timeout=10)
         if not resp.ok: return None, f"MAX Error: {resp.text}"
         return "ok", None
     except Exception as e:
@@ -674,25 +955,27 @@ def max_send_service(project_tokens, chat_id, text):
 #  INSTAGRAM
 # --------------------------------------------------------------------------
 
-def ig_get_public_url(filename):
+def ig_get_public_url(relpath):
+    """URL файла по пути относительно UPLOAD_FOLDER (например, 'ab/cd/<hash>.jpg')."""
     base_url = current_app.config.get('APP_URL') 
     if not base_url:
         try:
             base_url = url_for('main.index', _external=True)
         except Exception:
-            return f"/static/uploads/{filename}" 
-    return f"{base_url.rstrip('/')}/static/uploads/{filename}"
+            return f"/static/uploads/{relpath}" 
+    return f"{base_url.rstrip('/')}/static/uploads/{relpath}"
 
 def ig_send_service(project_tokens, image_path, caption):
     IG_USER_ID = project_tokens.ig_user_id
     IG_TOKEN = project_tokens.ig_page_token 
     if not IG_USER_ID or not IG_TOKEN: return "Instagram не настроен."
 
-    filename = os.path.basename(image_path)
-    public_url = ig_get_public_url(filename)
+    relpath = os.path.relpath(image_path, current_app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    public_url = ig_get_public_url(relpath)
+    base_url = current_app.config.get('IG_API_BASE', 'https://graph.facebook.com/v19.0')
 
-    upload_resp = requests.post(
-        f"https://graph.facebook.com/v19.0/{IG_USER_ID}/media",
+    upload_resp = http_client.post(
+        f"{base_url}/{IG_USER_ID}/media",
         params={"image_url": public_url, "caption": caption[:2200], "access_token": IG_TOKEN},
         timeout=30
     )
@@ -701,8 +984,8 @@ def ig_send_service(project_tokens, image_path, caption):
         if "error" in upload: return f"IG upload: {upload['error'].get('message')}"
         if "id" not in upload: return "IG upload: No ID."
         
-        publish_resp = requests.post(
-            f"https://graph.facebook.com/v19.0/{IG_USER_ID}/media_publish",
+        publish_resp = http_client.post(
+            f"{base_url}/{IG_USER_ID}/media_publish",
             params={"creation_id": upload["id"], "access_token": IG_TOKEN},
             timeout=30
         )
@@ -720,6 +1003,7 @@ def clear_tg_data(project_id):
     """
     Удаляет токен TG, все каналы и ВСЕ посты, связанные с TG каналами этого проекта.
     """
+    orphaned = []
     try:
         # 1. Находим каналы проекта
         channels = TgChannel.query.filter_by(project_id=project_id).all()
@@ -728,7 +1012,9 @@ def clear_tg_data(project_id):
         if channel_ids:
             # 2. Удаляем посты, привязанные к этим каналам
             # (Используем synchronize_session=False для массового удаления)
-            Post.query.filter(Post.tg_channel_id.in_(channel_ids)).delete(synchronize_session=False)
+            posts = Post.query.filter(Post.tg_channel_id.in_(channel_ids))
+            orphaned = release_posts_media(posts)
+            posts.delete(synchronize_session=False)
             
             # 3. Удаляем RSS, привязанные к этим каналам
             RssSource.query.filter(RssSource.tg_channel_id.in_(channel_ids)).delete(synchronize_session=False)
@@ -742,6 +1028,7 @@ def clear_tg_data(project_id):
             tokens.tg_token = None
         
         db.session.commit()
+        unlink_media(orphaned)
         return True, "Данные Telegram очищены."
     except Exception as e:
         db.session.rollback()
@@ -749,12 +1036,15 @@ def clear_tg_data(project_id):
 
 def clear_vk_data(project_id):
     """Удаляет токен VK, группы и посты."""
+    orphaned = []
     try:
         groups = VkGroup.query.filter_by(project_id=project_id).all()
         group_ids = [g.id for g in groups]
 
         if group_ids:
-            Post.query.filter(Post.vk_group_id.in_(group_ids)).delete(synchronize_session=False)
+            posts = Post.query.filter(Post.vk_group_id.in_(group_ids))
+            orphaned = release_posts_media(posts)
+            posts.delete(synchronize_session=False)
             RssSource.query.filter(RssSource.vk_group_id.in_(group_ids)).delete(synchronize_session=False)
             VkGroup.query.filter_by(project_id=project_id).delete(synchronize_session=False)
 
@@ -765,6 +1055,7 @@ def clear_vk_data(project_id):
             tokens._vk_token_encrypted = None # Если используется шифрование
             
         db.session.commit()
+        unlink_media(orphaned)
         return True, "Данные VK очищены."
     except Exception as e:
         db.session.rollback()
@@ -772,12 +1063,15 @@ def clear_vk_data(project_id):
 
 def clear_ok_data(project_id):
     """Удаляет токен OK, группы и посты."""
+    orphaned = []
     try:
         groups = OkGroup.query.filter_by(project_id=project_id).all()
         group_ids = [g.id for g in groups]
 
         if group_ids:
-            Post.query.filter(Post.ok_group_id.in_(group_ids)).delete(synchronize_session=False)
+            posts = Post.query.filter(Post.ok_group_id.in_(group_ids))
+            orphaned = release_posts_media(posts)
+            posts.delete(synchronize_session=False)
             OkGroup.query.filter_by(project_id=project_id).delete(synchronize_session=False)
 
         tokens = SocialTokens.query.filter_by(project_id=project_id).first()
@@ -786,6 +1080,7 @@ def clear_ok_data(project_id):
             tokens.ok_refresh_token = None # Важно очистить рефреш
             
         db.session.commit()
+        unlink_media(orphaned)
         return True, "Данные OK очищены."
     except Exception as e:
         db.session.rollback()
@@ -793,12 +1088,15 @@ def clear_ok_data(project_id):
 
 def clear_max_data(project_id):
     """Удаляет токен MAX, чаты и посты."""
+    orphaned = []
     try:
         chats = MaxChat.query.filter_by(project_id=project_id).all()
         chat_ids = [c.id for c in chats]
 
         if chat_ids:
-            Post.query.filter(Post.max_chat_id.in_(chat_ids)).delete(synchronize_session=False)
+            posts = Post.query.filter(Post.max_chat_id.in_(chat_ids))
+            orphaned = release_posts_media(posts)
+            posts.delete(synchronize_session=False)
             MaxChat.query.filter_by(project_id=project_id).delete(synchronize_session=False)
 
         tokens = SocialTokens.query.filter_by(project_id=project_id).first()
@@ -806,6 +1104,7 @@ def clear_max_data(project_id):
             tokens.max_token = None
             
         db.session.commit()
+        unlink_media(orphaned)
         return True, "Данные MAX очищены."
     except Exception as e:
         db.session.rollback()
@@ -816,9 +1115,12 @@ def delete_project_fully(project_id):
     Полное удаление проекта со всеми зависимостями.
     Порядок: Посты -> RSS -> Каналы/Группы -> Токены -> Сброс active_project -> Проект.
     """
+    orphaned = []
     try:
         # 1. Удаляем ВСЕ посты проекта
-        Post.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+        posts = Post.query.filter_by(project_id=project_id)
+        orphaned = release_posts_media(posts)
+        posts.delete(synchronize_session=False)
         
         # 2. Удаляем ВСЕ RSS проекта
         RssSource.query.filter_by(project_id=project_id).delete(synchronize_session=False)
@@ -840,6 +1142,7 @@ def delete_project_fully(project_id):
         Project.query.filter_by(id=project_id).delete(synchronize_session=False)
         
         db.session.commit()
+        unlink_media(orphaned)
         return True, "Проект полностью удален."
     except Exception as e:
         db.session.rollback()
@@ -850,128 +1153,417 @@ def delete_project_fully(project_id):
 # --------------------------------------------------------------------------
 
 def publish_post_task(post_id):
-    from app import create_app 
-    app = create_app() 
-    
-    with app.app_context():
+    """
+    Захватывает и публикует один пост.
+    Обычно посты публикует диспетчер очереди (app/services_queue.py); эта функция —
+    для прямого вызова и для задач post_<id>, оставшихся в хранилище APScheduler.
+    """
+    with task_context():
         logger.info(f"[Task: {post_id}] Начинаю публикацию...")
         
-        post = Post.query.get(post_id)
-        if not post: return
-
-        project = post.project
-        if not project:
-            post.status = 'failed'
-            post.error_message = 'Системная ошибка: нет проекта.'
-            db.session.commit()
+        # Атомарно "захватываем" пост: его параллельно может забрать диспетчер
+        # или другой процесс — публикует только первый.
+        lease_until = datetime.utcnow() + timedelta(seconds=current_app.config.get('PUBLISH_LEASE_SECONDS', 900))
+        claimed = Post.query.filter(Post.id == post_id, Post.status == 'scheduled')\
+            .update({'status': 'publishing', 'error_message': None,
+                     'locked_by': f"task:{socket.gethostname()}:{os.getpid()}", 'locked_until': lease_until},
+                    synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            logger.info(f"[Task: {post_id}] Пост уже обрабатывается или опубликован. Пропуск.")
             return
-            
-        tokens = project.tokens
-        if not tokens:
-            post.status = 'failed'
-            post.error_message = 'Не настроены соцсети в проекте.'
-            db.session.commit()
-            return        
+
+        publish_claimed_post(post_id)
+
+def load_post_graph(post_id):
+    """
+    Загружает пост вместе с проектом, токенами и каналами/группами одним запросом
+    (вместо отдельного Query.get на каждую сущность).
+    """
+    return Post.query.options(
+        joinedload(Post.project).joinedload(Project.tokens),
+        joinedload(Post.tg_channel),
+        joinedload(Post.vk_group),
+        joinedload(Post.ok_group),
+        joinedload(Post.max_chat)
+    ).filter(Post.id == post_id).first()
+
+# --- Отправка в отдельные платформы (выполняются параллельно) ---
+# Каждая функция возвращает (dict с данными для platform_info, текст ошибки или None).
+# Пост и токены каждая отправка получает свои — загруженные в ее потоке и ее сессии
+# (см. _run_platform_send): обновление токена внутри отправки (OK при ошибке 102)
+# сохраняется commit'ом этой сессии и не смешивается с итоговым commit публикации.
+
+def _publish_tg(post, tokens, full_paths, buttons_json):
+    if not tokens.tg_token:
+        return {}, "TG: Токен не найден."
+    channel = post.tg_channel
+    if not channel:
+        return {}, "TG: Канал не найден."
+    msg_id, err = tg_send_service(tokens.tg_token, channel.chat_id, 
+                                  post.text, platform_media(full_paths, 'tg'), buttons_json)
+    if err:
+        return {}, f"TG: {err}"
+    return {'tg_msg_id': msg_id}, None
+
+def _publish_vk(post, tokens, full_paths, buttons_json):
+    logger.info(f"[Task: {post.id}] Отправка в VK...")
+    # Получаем объект группы, чтобы узнать её реальный group_id (в посте хранится ID записи, а не ID группы VK)
+    vk_group = post.vk_group
+    if not vk_group:
+        return {}, "VK: Группа не найдена или нет токенов"
+    # Используем vk_layout из настроек поста или 'grid' по умолчанию
+    layout = post.vk_layout or 'grid'
+    vk_post_id, err = vk_send_service(tokens, vk_group.group_id, post.text_vk,
+                                       platform_media(full_paths, 'vk'), layout)
+    if err:
+        return {}, f"VK: {err}"
+    logger.info(f"VK success: {vk_post_id}")
+    return {'vk_post_id': vk_post_id}, None
+
+def _publish_ig(post, tokens, full_paths, buttons_json):
+    images = [p for p in full_paths if p.lower().endswith(('.jpg', '.png', '.jpeg', '.webp'))]
+    if not images:
+        return {}, "IG: Нужно фото."
+    # IG принимает только JPEG: вариант готовится из первой картинки
+    err = ig_send_service(tokens, platform_media(images[:1], 'ig')[0], post.text_vk)
+    if err:
+        return {}, f"IG: {err}"
+    return {'ig_published': True}, None
+
+def _publish_ok(post, tokens, full_paths, buttons_json):
+    ok_group = post.ok_group
+    if not ok_group:
+        return {}, "OK: Группа/Токены не найдены"
+    post_id_ok, err = ok_send_service(tokens, ok_group.group_id, post.text_vk,
+                                     platform_media(full_paths, 'ok'))
+    if err:
+        return {}, f"OK: {err}"
+    return {'ok_post_id': post_id_ok}, None
+
+def _publish_max(post, tokens, full_paths, buttons_json):
+    max_chat = post.max_chat
+    if not max_chat:
+        return {}, "MAX: Чат не найден"
+    _, err = max_send_service(tokens, max_chat.chat_id, post.text)
+    if err:
+        return {}, f"MAX: {err}"
+    return {'max_sent': True}, None
+
+# Ключ platform_info, по которому видно, что платформа уже опубликована.
+# При повторе такие платформы пропускаются (без повторной загрузки медиа).
+PLATFORM_DONE_KEYS = {
+    'TG': 'tg_msg_id',
+    'VK': 'vk_post_id',
+    'IG': 'ig_published',
+    'OK': 'ok_post_id',
+    'MAX': 'max_sent',
+}
+
+def retry_delay(attempt):
+    """
+    Задержка перед попыткой №attempt (1, 2, ...): экспоненциальная, со случайным разбросом 50–100%,
+    чтобы посты, упавшие вместе (например, при сбое платформы), не повторялись одновременно.
+    """
+    base = current_app.config.get('PUBLISH_RETRY_BASE_SECONDS', 60)
+    cap = current_app.config.get('PUBLISH_RETRY_MAX_SECONDS', 3600)
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+def _run_platform_send(app, name, func, post_id, full_paths, buttons_json):
+    """
+    Выполняет отправку в платформу в отдельном потоке: со своим app_context, своей
+    сессией и своими объектами поста и токенов (ORM-объекты между потоками не передаются).
+    """
+    with app.app_context():
+        try:
+            post = load_post_graph(post_id)
+            return func(post, post.project.tokens, full_paths, buttons_json)
+        except Exception as e:
+            logger.error(f"{name} send error: {e}", exc_info=True)
+            return {}, f"{name}: {e}"
+
+def publish_claimed_post(post_id):
+    """
+    Публикует пост, который уже захвачен (status='publishing').
+    Вызывается из publish_post_task и из диспетчера/воркера очереди (app/services_queue.py).
+    Требует активный app_context.
+
+    Отправка во все выбранные соцсети идет параллельно (до PUBLISH_FANOUT_WORKERS потоков),
+    результаты сводятся в platform_info/error_message и сохраняются одним commit.
+    """
+    post = load_post_graph(post_id)
+    if not post: return
+
+    project = post.project
+    if not project:
+        post.status = 'failed'
+        post.error_message = 'Системная ошибка: нет проекта.'
+        db.session.commit()
+        return
         
-        post.status = 'publishing'
-        post.error_message = None 
+    tokens = project.tokens
+    if not tokens:
+        post.status = 'failed'
+        post.error_message = 'Не настроены соцсети в проекте.'
         db.session.commit()
+        return        
+
+    # Токен VK обновляем заранее в основном потоке: обновление делает commit в сессию,
+    # а параллельные отправки работать с сессией не должны.
+    if post.publish_to_vk and post.vk_group_id:
+        get_valid_vk_session(tokens)
+        # commit сбрасывает загруженные атрибуты — перечитываем граф поста целиком
+        post = load_post_graph(post_id)
+        tokens = post.project.tokens
+    
+    media_files = post.media_files if post.media_files else []
+    full_paths = [media_path(f) for f in media_files]
+    
+    platform_info = dict(post.platform_info or {})
+    buttons_json = json.dumps(platform_info.get('buttons', []))
+
+    # Порядок важен только для порядка ошибок в error_message
+    sends = []
+    if post.publish_to_tg and post.tg_channel_id: sends.append(('TG', _publish_tg))
+    if post.publish_to_vk and post.vk_group_id: sends.append(('VK', _publish_vk))
+    if post.publish_to_ig: sends.append(('IG', _publish_ig))
+    if post.publish_to_ok and post.ok_group_id: sends.append(('OK', _publish_ok))
+    if post.publish_to_max and post.max_chat_id: sends.append(('MAX', _publish_max))
+
+    # Уже опубликованное (прошлая попытка или прямая отправка в VK) не отправляем повторно
+    done = [name for name, _ in sends if PLATFORM_DONE_KEYS[name] in platform_info]
+    if done:
+        logger.info(f"[Task: {post_id}] Уже опубликовано в {', '.join(done)}, пропускаю.")
+        sends = [(name, func) for name, func in sends if name not in done]
+
+    app = current_app._get_current_object()
+    args = (post_id, full_paths, buttons_json)
+    owner = post.locked_by
+    retry_count = post.retry_count
+
+    # Аренда продлевается, пока идут отправки: иначе долгую публикацию (несколько видео)
+    # после PUBLISH_LEASE_SECONDS забрал бы другой воркер и опубликовал бы второй раз
+    with _lease_keeper(app, post_id, owner):
+        if len(sends) <= 1:
+            results = [_run_platform_send(app, name, func, *args) for name, func in sends]
+        else:
+            max_workers = min(len(sends), current_app.config.get('PUBLISH_FANOUT_WORKERS', 5))
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'post{post_id}') as pool:
+                futures = [pool.submit(_run_platform_send, app, name, func, *args) for name, func in sends]
+                results = [f.result() for f in futures]
+
+    errors = []
+    for info, err in results:
+        platform_info.update(info)
+        if err: errors.append(err)
+
+    values = {'platform_info': platform_info, 'locked_by': None, 'locked_until': None}
+    if errors:
+        values['error_message'] = " | ".join(errors)
+        max_retries = current_app.config.get('PUBLISH_MAX_RETRIES', 3)
+        if retry_count < max_retries:
+            # Повторим позже — только те платформы, где была ошибка
+            delay = retry_delay(retry_count + 1)
+            values.update(status='retrying', retry_count=retry_count + 1,
+                          next_retry_at=datetime.utcnow() + timedelta(seconds=delay))
+            logger.info(f"[Task: {post_id}] Попытка {retry_count + 1}/{max_retries} через {delay:.0f} сек.")
+        else:
+            # Статус "частично отправлено", если где-то успех, а где-то ошибка
+            published_any = any(key in platform_info for key in PLATFORM_DONE_KEYS.values())
+            values.update(status='partial' if published_any else 'failed', next_retry_at=None)
+    else:
+        values.update(status='published', published_at=datetime.utcnow(), error_message=None, next_retry_at=None)
+
+    # Результат сохраняется, только если пост все еще принадлежит этому воркеру
+    owned = Post.locked_by == owner if owner else Post.locked_by.is_(None)
+    updated = Post.query.filter(Post.id == post_id, owned).update(values, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        logger.warning(f"[Task: {post_id}] Пост больше не принадлежит {owner} (аренду забрал другой воркер), "
+                       f"результат отброшен: {platform_info}")
+        return
+    db.session.commit()
+    logger.info(f"[Task: {post_id}] Завершено. Статус: {values['status']}")
 
-        upload_folder = app.config['UPLOAD_FOLDER']
-        media_files = post.media_files if post.media_files else []
-        full_paths = [os.path.join(upload_folder, f) for f in media_files]
-        
-        images = [p for p in full_paths if p.lower().endswith(('.jpg', '.png', '.jpeg'))]
-        
-        platform_info = post.platform_info or {}
-        errors = []
-        buttons_json = json.dumps(platform_info.get('buttons', []))
-
-        # 1. Telegram
-        if post.publish_to_tg and post.tg_channel_id:
-            if tokens.tg_token:
-                channel = TgChannel.query.get(post.tg_channel_id)
-                if channel:
-                    msg_id, err = tg_send_service(tokens.tg_token, channel.chat_id, 
-                                                  post.text, full_paths, buttons_json)                
-                    if err: errors.append(f"TG: {err}")
-                    else: platform_info['tg_msg_id'] = msg_id
-                else: errors.append("TG: Канал не найден.")
-            else: errors.append("TG: Токен не найден.")
-
-        # 2. VK (ИСПРАВЛЕНО: Добавлен код отправки)
-        if post.publish_to_vk and post.vk_group_id:
-            logger.info(f"[Task: {post_id}] Отправка в VK...")
-            # Получаем объект группы, чтобы узнать её реальный group_id (если в базе хранится ID записи, а не ID группы VK)
-            vk_group = VkGroup.query.get(post.vk_group_id)
-            
-            if vk_group and tokens:
-                # Используем vk_layout из настроек поста или 'grid' по умолчанию
-                layout = post.vk_layout if hasattr(post, 'vk_layout') else 'grid'
-                
-                # Вызываем сервис отправки (убедитесь, что vk_send_service импортирован)
-                vk_post_id, err = vk_send_service(tokens, vk_group.group_id, post.text_vk, full_paths, layout)
-                
-                if err: 
-                    errors.append(f"VK: {err}")
-                else: 
-                    platform_info['vk_post_id'] = vk_post_id
-                    logger.info(f"VK success: {vk_post_id}")
-            else:
-                errors.append("VK: Группа не найдена или нет токенов")
+@contextmanager
+def _lease_keeper(app, post_id, owner):
+    """
+    Поток-таймер: раз в треть PUBLISH_LEASE_SECONDS продлевает аренду поста (locked_until),
+    пока пост принадлежит owner. Без owner (пост захвачен без аренды) ничего не делает.
+    """
+    if not owner:
+        yield
+        return
 
-        # 3. Instagram
-        if post.publish_to_ig:
-            if not images:
-                errors.append("IG: Нужно фото.")
-            else:
+    lease = app.config.get('PUBLISH_LEASE_SECONDS', 900)
+    table = Post.__table__
+    stop = threading.Event()
+
+    def extend():
+        while not stop.wait(lease / 3):
+            with app.app_context():
                 try:
-                    err = ig_send_service(tokens, images[0], post.text_vk)
-                    if err: errors.append(f"IG: {err}")
-                except Exception as e: errors.append(f"IG: {str(e)}")
-                    
-        # 4. OK
-        if post.publish_to_ok and post.ok_group_id:
-            ok_group = OkGroup.query.get(post.ok_group_id)
-            if ok_group and tokens:
-                post_id_ok, err = ok_send_service(tokens, ok_group.group_id, post.text_vk, full_paths)
-                if err: errors.append(f"OK: {err}")
-                else: platform_info['ok_post_id'] = post_id_ok
-            else:
-                errors.append("OK: Группа/Токены не найдены")
-
-        # 5. MAX
-        if post.publish_to_max and post.max_chat_id:
-            max_chat = MaxChat.query.get(post.max_chat_id)
-            if max_chat and tokens:
-                _, err = max_send_service(tokens, max_chat.chat_id, post.text)
-                if err: errors.append(f"MAX: {err}")
-            else:
-                errors.append("MAX: Чат не найден")
+                    with db.engine.begin() as conn:
+                        updated = conn.execute(table.update().where(
+                            table.c.id == post_id, table.c.locked_by == owner
+                        ).values(locked_until=datetime.utcnow() + timedelta(seconds=lease))).rowcount
+                except Exception as e:
+                    logger.error(f"[Task: {post_id}] Не удалось продлить аренду: {e}")
+                    continue
+            if not updated:
+                logger.warning(f"[Task: {post_id}] Аренда потеряна ({owner}).")
+                return
+
+    keeper = threading.Thread(target=extend, name=f'lease{post_id}', daemon=True)
+    keeper.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        keeper.join()
 
-        if errors:
-            post.status = 'failed'
-            # Статус "частично отправлено", если где-то успех, а где-то ошибка
-            if platform_info: 
-                post.status = 'partial'
-            post.error_message = " | ".join(errors)
-        else:
-            post.status = 'published'
-            post.published_at = datetime.utcnow()
+# --------------------------------------------------------------------------
+#  ПРЕДЗАГРУЗКА МЕДИА ОТЛОЖЕННЫХ ПОСТОВ
+# --------------------------------------------------------------------------
+# За MEDIA_PRESTAGE_MINUTES до scheduled_at медиа поста загружаются в его соцсети,
+# а ID вложений попадают в кеш загрузок (media_upload_cache, см. app/media.py).
+# В момент публикации *_send_service берут их из кеша, и остается только
+# wall.post / sendMediaGroup — пост выходит вовремя даже с видео.
+# file_id Telegram действует для бота в любом чате, поэтому файлы TG отправляются
+# в закрытый чат бота SocialTokens.tg_cache_chat_id (если он не задан, TG не готовится).
+# В VK заранее загружаются только фото: загруженное в группу видео сразу видно
+# подписчикам в разделе видео, то есть вышло бы раньше поста. Видео, как и раньше,
+# загружаются в момент публикации. OK не готовится: токен фото OK одноразовый,
+# а видео, как и в VK, стало бы видно раньше поста.
+
+# Альбом Telegram — не больше 10 файлов
+TG_ALBUM_LIMIT = 10
+
+def _stage_tg(post, tokens, full_paths):
+    if not (tokens.tg_token and tokens.tg_cache_chat_id and post.tg_channel):
+        return None
+    bot_key = ratelimit.tg_bot_key(tokens.tg_token)
+    paths = [p for p in platform_media(full_paths, 'tg') if not cached_upload(p, 'tg', bot_key)]
+    for i in range(0, len(paths), TG_ALBUM_LIMIT):
+        _, err = tg_send_service(tokens.tg_token, tokens.tg_cache_chat_id, '', paths[i:i + TG_ALBUM_LIMIT], None)
+        if err:
+            return f"TG: {err}"
+    return None
 
-        post.platform_info = platform_info
-        db.session.commit()
-        logger.info(f"[Task: {post_id}] Завершено. Статус: {post.status}")
+def _stage_vk(post, tokens, full_paths):
+    if not post.vk_group:
+        return None
+    vk_session = get_valid_vk_session(tokens)
+    if vk_session is None:
+        return "VK: Не удалось получить/обновить VK токен."
+    vk_upload = VkUpload(vk_session)
+    vk_upload.http = vk_session.http
+    # Ошибки отдельных файлов логируются внутри: такие файлы загрузятся при публикации
+    photos = [p for p in platform_media(full_paths, 'vk') if p.lower().endswith(VK_PHOTO_EXTS)]
+    if photos:
+        _vk_upload_attachments(vk_upload, abs(int(post.vk_group.group_id)), photos,
+                               post.text_vk or post.text, tokens.project_id)
+    return None
+
+# Платформа -> (флаг публикации, функция предзагрузки)
+STAGE_PLATFORMS = {
+    'TG': ('publish_to_tg', _stage_tg),
+    'VK': ('publish_to_vk', _stage_vk),
+}
 
+def stage_post_media(post_id):
+    """
+    Загружает медиа отложенного поста в его соцсети заранее (в кеш загрузок).
+    Платформы, в которые пост уже опубликован, пропускаются. Возвращает список ошибок.
+    Требует app_context.
+    """
+    post = load_post_graph(post_id)
+    if not post or not post.media_files or not post.project or not post.project.tokens:
+        return []
+
+    full_paths = [media_path(f) for f in post.media_files]
+    platform_info = post.platform_info or {}
+    errors = []
+    for name, (flag, func) in STAGE_PLATFORMS.items():
+        if not getattr(post, flag) or PLATFORM_DONE_KEYS[name] in platform_info:
+            continue
+        try:
+            err = func(post, post.project.tokens, full_paths)
+        except Exception as e:
+            logger.error(f"[Prestage: {post_id}] {name}: {e}", exc_info=True)
+            err = f"{name}: {e}"
+        if err:
+            errors.append(err)
+        # VK обновляет токен с commit — граф поста перечитываем
+        post = load_post_graph(post_id)
+    return errors
+
+def forget_staged_media(post):
+    """
+    Удаляет из кеша загрузок ID, подготовленные заранее для поста, который удаляют
+    до выхода. Платформы, в которые пост уже опубликован, не трогаются. Требует app_context.
+    """
+    if not post.media_staged_at or not post.media_files or not post.project or not post.project.tokens:
+        return
+    tokens = post.project.tokens
+    platform_info = post.platform_info or {}
+
+    targets = []
+    if post.publish_to_tg and tokens.tg_token and PLATFORM_DONE_KEYS['TG'] not in platform_info:
+        targets.append(('tg', ratelimit.tg_bot_key(tokens.tg_token)))
+    if post.publish_to_vk and post.vk_group and PLATFORM_DONE_KEYS['VK'] not in platform_info:
+        targets.append(('vk', abs(int(post.vk_group.group_id))))
+
+    full_paths = [media_path(f) for f in post.media_files]
+    for platform, target in targets:
+        for p in platform_media(full_paths, platform):
+            forget_upload(p, platform, target)
+
+@leader_only
+def prestage_media():
+    """
+    Периодическая задача (раз в MEDIA_PRESTAGE_INTERVAL_SECONDS): предзагрузка медиа
+    постов, до публикации которых осталось не больше MEDIA_PRESTAGE_MINUTES.
+    Каждый пост готовится один раз (media_staged_at); при ошибке недостающие файлы
+    просто загрузятся в момент публикации, как раньше. Возвращает число подготовленных постов.
+    """
+    with task_context():
+        minutes = current_app.config.get('MEDIA_PRESTAGE_MINUTES', 0)
+        if not minutes or not upload_cache_enabled():
+            return 0
+
+        now = datetime.utcnow()
+        rows = db.session.query(Post.id, Post.media_files).filter(
+            Post.status == 'scheduled',
+            Post.scheduled_at > now,
+            Post.scheduled_at <= now + timedelta(minutes=minutes),
+            Post.media_staged_at.is_(None)
+        ).order_by(Post.scheduled_at).limit(current_app.config.get('MEDIA_PRESTAGE_BATCH_SIZE', 20)).all()
+
+        staged = 0
+        for post_id, media_files in rows:
+            # Посты без медиа тоже отмечаем, чтобы не выбирать их снова
+            if media_files:
+                errors = stage_post_media(post_id)
+                if errors:
+                    logger.warning(f"[Prestage: {post_id}] Не все медиа загружены заранее: {' | '.join(errors)}")
+                staged += 1
+            Post.query.filter_by(id=post_id).update({'media_staged_at': datetime.utcnow()},
+                                                    synchronize_session=False)
+            db.session.commit()
+
+        if staged:
+            logger.info(f"Prestage: подготовлено постов: {staged}")
+        return staged
+
+@leader_only
 def check_expired_tariffs():
     """
-    Фоновая задача: проверяет истекшие тарифы.
+    Фоновая задача: проверяет истекшие тарифы (только в процессе-лидере).
     Пытается продлить (списать баланс) или сбрасывает на MINI.
     """
-    from app import create_app
-    app = create_app()
-    
-    with app.app_context():
+    with task_context():
         # Находим пользователей, у которых срок истек и тариф не дефолтный (предположим ID=1 это MINI)
         # Истекшие = tariff_expires_at < now
         expired_users = User.query.filter(
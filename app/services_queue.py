@@ -0,0 +1,324 @@
+# app/services_queue.py
+import os
+import time
+import signal
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import or_, and_, func
+
+from app import db, task_context
+from app.leader import leader_only, is_holder
+from app.models import Post
+from app.services import publish_claimed_post
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------
+#  ОЧЕРЕДЬ ПУБЛИКАЦИЙ НА ТАБЛИЦЕ posts
+# --------------------------------------------------------------------------
+# Очередью служит сама таблица posts: "задача" = пост со status='scheduled'
+# и наступившим scheduled_at (индекс ix_posts_status_scheduled_at).
+# Посты забираются пачками через SELECT ... FOR UPDATE SKIP LOCKED, поэтому
+# забирающих может быть сколько угодно и на разных хостах — один пост
+# достанется только одному из них. Забирают:
+#   * диспетчер dispatch_due_posts — одна периодическая задача APScheduler
+#     (вместо отдельной задачи на каждый пост), выполняется только в процессе-лидере;
+#     посты по одному забирают слоты его постоянного пула (PublishPool);
+#   * либо отдельные воркеры worker.py (PUBLISH_WORKER_ENABLED=true).
+# Несколько забирающих одновременно (несколько воркеров worker.py или диспетчер
+# рядом с воркерами) — только на PostgreSQL: на SQLite записи в БД сериализуются
+# целиком, и параллельные захваты упираются в блокировку базы.
+
+# Посты, которые вообще проходят через очередь (VK-only из формы уходят сразу из routes_main,
+# VK-only из RSS помечены publish_via_queue)
+QUEUE_PLATFORMS = or_(Post.publish_to_tg, Post.publish_to_ig, Post.publish_to_ok, Post.publish_to_max,
+                      Post.publish_via_queue)
+
+def make_worker_id():
+    """Уникальный ID воркера: хост + PID."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_due_posts(worker_id, limit=10, lease_seconds=900):
+    """
+    Забирает до `limit` постов, готовых к публикации, и "арендует" их на lease_seconds.
+    Возвращает список ID постов. Требует app_context.
+
+    Кроме новых постов забираются и зависшие в 'publishing' с истекшей арендой
+    (воркер упал посреди публикации).
+    """
+    now = datetime.utcnow()
+
+    due = and_(
+        Post.status == 'scheduled',
+        or_(Post.scheduled_at.is_(None), Post.scheduled_at <= now)
+    )
+    # Автоповтор: публикуются только платформы, которых еще нет в platform_info
+    # (поэтому сюда попадают и посты только в VK — их ошибки тоже повторяются здесь)
+    retry = and_(
+        Post.status == 'retrying',
+        Post.next_retry_at <= now,
+        or_(Post.scheduled_at.is_(None), Post.scheduled_at <= now)
+    )
+    stale = and_(
+        Post.status == 'publishing',
+        Post.locked_until.isnot(None),
+        Post.locked_until < now
+    )
+
+    # На PostgreSQL это SELECT ... FOR UPDATE SKIP LOCKED: строки, которые
+    # сейчас забирает другой воркер, просто пропускаются (без ожидания).
+    # SQLite FOR UPDATE не поддерживает, поэтому сам захват — условный UPDATE (claim_posts).
+    candidates = db.session.query(Post.id, Post.status, Post.locked_by).filter(
+        or_(and_(due, QUEUE_PLATFORMS), retry, stale)
+    ).order_by(Post.scheduled_at, Post.id)\
+     .limit(limit)\
+     .with_for_update(skip_locked=True)\
+     .all()
+
+    for post_id, status, locked_by in candidates:
+        if status == 'publishing':
+            logger.warning(f"Queue: пост {post_id} завис у {locked_by}, аренда истекла. Забираю.")
+
+    return claim_posts([post_id for post_id, *_ in candidates], worker_id, lease_seconds, now)
+
+def claim_posts(post_ids, worker_id, lease_seconds, now=None):
+    """
+    Захватывает посты из post_ids одним условным UPDATE: пост достается этому воркеру,
+    только если он все еще ждет публикации (или его аренда истекла). Если тот же пост
+    одновременно забирает другой воркер, UPDATE выиграет только один из них.
+    Возвращает ID постов, которые достались этому воркеру.
+    """
+    if not post_ids:
+        db.session.commit()
+        return []
+    now = now or datetime.utcnow()
+    lease_until = now + timedelta(seconds=lease_seconds)
+
+    Post.query.filter(
+        Post.id.in_(post_ids),
+        or_(
+            Post.status.in_(['scheduled', 'retrying']),
+            and_(Post.status == 'publishing', Post.locked_until < now)
+        )
+    ).update({
+        'status': 'publishing',
+        'error_message': None,
+        'locked_by': worker_id,
+        'locked_until': lease_until
+    }, synchronize_session=False)
+    db.session.commit()
+
+    posts = db.session.query(Post.id, Post.next_retry_at, Post.scheduled_at, Post.created_at).filter(
+        Post.id.in_(post_ids),
+        Post.locked_by == worker_id,
+        Post.locked_until == lease_until
+    ).order_by(Post.scheduled_at, Post.id).all()
+
+    if posts:
+        oldest = min(p.next_retry_at or p.scheduled_at or p.created_at or now for p in posts)
+        lag = max((now - oldest).total_seconds(), 0)
+        logger.info(f"Queue [{worker_id}]: забрано постов: {len(posts)}, задержка: {lag:.1f} сек.")
+    return [p.id for p in posts]
+
+def retry_failed_posts(project_id):
+    """
+    Ставит все неудачные посты проекта (failed/partial) на повторную публикацию.
+    Счетчик попыток сбрасывается; уже опубликованные платформы повторно не отправляются.
+    Возвращает количество постов.
+    """
+    count = Post.query.filter(
+        Post.project_id == project_id,
+        Post.status.in_(['failed', 'partial'])
+    ).update({
+        'status': 'retrying',
+        'retry_count': 0,
+        'next_retry_at': datetime.utcnow(),
+        'error_message': None
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+def expire_missed_posts():
+    """
+    Помечает как failed посты, просроченные больше чем на SCHEDULER_MISFIRE_GRACE_SECONDS
+    (например, сервис долго лежал): "вчерашний" пост публиковать уже не нужно.
+    Посты в пределах окна публикуются как обычно — диспетчер их догонит.
+    """
+    grace = timedelta(seconds=current_app.config.get('SCHEDULER_MISFIRE_GRACE_SECONDS', 3600))
+    expired = Post.query.filter(
+        Post.status == 'scheduled',
+        Post.scheduled_at < datetime.utcnow() - grace,
+        QUEUE_PLATFORMS
+    ).update({
+        'status': 'failed',
+        'error_message': 'Время публикации пропущено (сервер был недоступен).'
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if expired:
+        logger.warning(f"Queue: просрочено постов: {expired}")
+    return expired
+
+def _publish_in_context(app, post_id):
+    """Публикация одного поста в отдельном потоке (со своим app_context и сессией)."""
+    with app.app_context():
+        try:
+            publish_claimed_post(post_id)
+        except Exception as e:
+            logger.error(f"Queue: ошибка публикации поста {post_id}: {e}", exc_info=True)
+            db.session.rollback()
+            # Пост останется в 'publishing' и будет подобран после истечения аренды
+
+def dispatch_batch(worker_id, batch_size, lease_seconds):
+    """
+    Забирает одну пачку готовых постов и публикует их по очереди (воркер worker.py).
+    Возвращает количество забранных постов. Требует app_context.
+    """
+    post_ids = claim_due_posts(worker_id, batch_size, lease_seconds)
+    if not post_ids:
+        return 0
+
+    # Сессию этого контекста дальше не используем: каждый пост публикуется в своем
+    db.session.remove()
+
+    app = current_app._get_current_object()
+    for post_id in post_ids:
+        _publish_in_context(app, post_id)
+    return len(post_ids)
+
+class PublishPool:
+    """
+    Постоянный пул публикаций диспетчера (живет между запусками задачи).
+    Каждый слот сам забирает по одному посту и, опубликовав его, сразу берет следующий,
+    пока очередь не опустеет: медленный пост (например, альбом видео) занимает
+    только свой слот и не задерживает остальные. fill() занимает свободные слоты.
+    """
+
+    def __init__(self, app, worker_id, concurrency, lease_seconds, can_claim=None):
+        self.app = app
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.can_claim = can_claim or (lambda: True)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='dispatch')
+        self._lock = threading.Lock()
+        # Слоты забирают посты по очереди: иначе два слота выбирают один и тот же пост,
+        # проигравший получает пустой результат и завершается при непустой очереди
+        self._claim_lock = threading.Lock()
+        self._active = 0
+
+    @property
+    def active(self):
+        return self._active
+
+    def fill(self):
+        """Запускает слоты на все свободные места. Возвращает число запущенных слотов."""
+        with self._lock:
+            free = self.concurrency - self._active
+            self._active += free
+        for _ in range(free):
+            self._executor.submit(self._run_slot)
+        return free
+
+    def _claim_one(self):
+        with self._claim_lock, self.app.app_context():
+            try:
+                post_ids = claim_due_posts(self.worker_id, 1, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Queue [{self.worker_id}]: ошибка выборки постов: {e}", exc_info=True)
+                db.session.rollback()
+                return None
+            return post_ids[0] if post_ids else None
+
+    def _run_slot(self):
+        try:
+            while self.can_claim():
+                post_id = self._claim_one()
+                if post_id is None:
+                    return
+                _publish_in_context(self.app, post_id)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def shutdown(self, wait=True):
+        self.can_claim = lambda: False
+        self._executor.shutdown(wait=wait)
+
+# Пул диспетчера этого процесса и PID, которым он создан (после fork пул не наследуется)
+_pool = None
+_pool_pid = None
+
+def _dispatcher_pool(app):
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        config = app.config
+        _pool = PublishPool(app, f"dispatcher:{make_worker_id()}",
+                            concurrency=config.get('DISPATCHER_CONCURRENCY', 4),
+                            lease_seconds=config.get('PUBLISH_LEASE_SECONDS', 900),
+                            can_claim=is_holder)
+        _pool_pid = os.getpid()
+    return _pool
+
+@leader_only
+def dispatch_due_posts():
+    """
+    Периодическая задача-диспетчер (APScheduler, раз в DISPATCHER_INTERVAL_SECONDS).
+    Выполняется только в процессе-лидере (см. app/leader.py) — один диспетчер на кластер.
+    Не ждет публикаций: только занимает свободные слоты пула (см. PublishPool),
+    а слоты забирают посты, пока очередь не опустеет или процесс не перестанет быть лидером.
+    """
+    with task_context():
+        expire_missed_posts()
+        _dispatcher_pool(current_app._get_current_object()).fill()
+
+def queue_stats():
+    """(сколько постов ждут публикации, задержка самого старого в секундах) — для админки."""
+    now = datetime.utcnow()
+    count, oldest = db.session.query(func.count(Post.id), func.min(Post.scheduled_at)).filter(
+        Post.status == 'scheduled',
+        or_(Post.scheduled_at.is_(None), Post.scheduled_at <= now),
+        QUEUE_PLATFORMS
+    ).one()
+    lag = max((now - oldest).total_seconds(), 0) if oldest else 0
+    return count, int(lag)
+
+def run_worker(app, worker_id=None):
+    """
+    Основной цикл воркера публикаций. Работает, пока не придет SIGTERM/SIGINT.
+    Настройки: PUBLISH_WORKER_BATCH_SIZE, PUBLISH_WORKER_POLL_SECONDS, PUBLISH_LEASE_SECONDS.
+    """
+    worker_id = worker_id or make_worker_id()
+    batch_size = app.config.get('PUBLISH_WORKER_BATCH_SIZE', 10)
+    poll_seconds = app.config.get('PUBLISH_WORKER_POLL_SECONDS', 2)
+    lease_seconds = app.config.get('PUBLISH_LEASE_SECONDS', 900)
+
+    state = {'running': True}
+
+    def _stop(signum, frame):
+        logger.info(f"Queue [{worker_id}]: получен сигнал {signum}, завершаю после текущей пачки.")
+        state['running'] = False
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    logger.info(f"Queue [{worker_id}]: воркер запущен (batch={batch_size}, lease={lease_seconds}s).")
+
+    while state['running']:
+        with app.app_context():
+            try:
+                expire_missed_posts()
+                dispatched = dispatch_batch(worker_id, batch_size, lease_seconds)
+            except Exception as e:
+                logger.error(f"Queue [{worker_id}]: ошибка выборки постов: {e}", exc_info=True)
+                db.session.rollback()
+                dispatched = 0
+
+        if not dispatched:
+            time.sleep(poll_seconds)
+
+    logger.info(f"Queue [{worker_id}]: воркер остановлен.")
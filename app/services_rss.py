@@ -1,126 +1,409 @@
 # app/services_rss.py
 import feedparser
 import re
-import requests
 import os
-import uuid
-import fcntl
+import time
+import random
 import logging
+import threading
+from urllib.parse import urlsplit
+from urllib3.util import Timeout
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup, NavigableString
 from flask import current_app
-from app import db
+from app import db, task_context, http_client
 from app.models import RssSource, Post
-from app.services import publish_post_task
-from datetime import datetime
+from app.leader import leader_only
+from app.media import store_chunks, acquire_media
+from datetime import datetime, timedelta
+from calendar import timegm
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
 
-def download_image(img_url):
-    """Скачивает картинку по URL и сохраняет в папку uploads"""
+def download_image(img_url, project_id=None):
+    """
+    Скачивает картинку по URL в хранилище медиа (app/media.py) и возвращает имя файла.
+    Одна и та же картинка, встреченная в разных записях/лентах, хранится один раз.
+    Новая картинка засчитывается в объем проекта project_id.
+    """
     if not img_url: return None
     try:
-        # Генерируем имя
         ext = os.path.splitext(img_url)[1].split('?')[0]
         if not ext: ext = '.jpg'
-        filename = f"{uuid.uuid4()}{ext}"
-        
-        # Скачиваем
-        r = requests.get(img_url, timeout=10, stream=True)
-        if r.status_code == 200:
-            upload_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            with open(upload_path, 'wb') as f:
-                for chunk in r.iter_content(1024):
-                    f.write(chunk)
-            return filename
+
+        # with — чтобы соединение вернулось в пул сразу после чтения
+        with http_client.get(img_url, timeout=10, stream=True) as r:
+            if r.status_code == 200:
+                return store_chunks(r.iter_content(64 * 1024), f"image{ext}", project_id)
     except Exception as e:
         logger.error(f"RSS: Error downloading image {img_url}: {e}")
     return None
 
-def parse_rss_feeds():
-    """Эта функция запускается по расписанию"""
+# --------------------------------------------------------------------------
+#  ОПРОС ЛЕНТ: СКАЧИВАНИЕ (ПАРАЛЛЕЛЬНО) -> РАЗБОР И СОЗДАНИЕ ПОСТОВ (ПО ОЧЕРЕДИ)
+# --------------------------------------------------------------------------
+# Этап 1 (fetch_feeds): все ленты скачиваются в пуле из RSS_FETCH_WORKERS потоков,
+# не больше RSS_FETCH_PER_HOST запросов к одному хосту одновременно. У каждой ленты
+# таймауты соединения/чтения, общий лимит времени и лимит размера — медленный или
+# зависший сайт не задерживает остальные. Этот этап не трогает БД.
+# Этап 2 (ingest_feed): разбор и создание постов по источникам в основном потоке.
+# Прогон длится примерно столько, сколько скачивается самая медленная лента.
+#
+# Источники с одинаковой лентой (одна популярная лента в разных проектах)
+# группируются по нормализованному URL (индексированная колонка normalized_url):
+# лента скачивается и разбирается один раз за прогон, новые записи раздаются каждому
+# источнику по его собственному last_guid, а картинки записей скачиваются один раз
+# на всю группу.
+
+def normalize_feed_url(url):
+    """Ключ группировки лент: без пробелов, регистра схемы/хоста, порта по умолчанию и #фрагмента."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{parts.port}"
+    return f"{scheme}://{host}{parts.path or '/'}" + (f"?{parts.query}" if parts.query else '')
+
+def _remaining(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("лента скачивается слишком долго")
+    return remaining
+
+def _read_limited(resp, max_bytes, deadline):
+    """
+    Читает тело ответа не больше max_bytes. Перед каждым чтением таймаут сокета
+    уменьшается до времени, оставшегося до deadline: read1 делает одно чтение
+    из сокета, поэтому и медленная «капающая» лента не выходит за лимит.
+    """
+    chunks, size = [], 0
+    while True:
+        remaining = _remaining(deadline)
+        sock = getattr(resp.raw.connection, 'sock', None)
+        if sock is not None:
+            sock.settimeout(remaining)
+        chunk = resp.raw.read1(64 * 1024, decode_content=True)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValueError(f"лента больше {max_bytes} байт")
+        chunks.append(chunk)
+
+def fetch_feed(url, etag=None, modified=None):
+    """
+    Условный GET ленты с сохраненными ETag/Last-Modified (If-None-Match / If-Modified-Since).
+    Возвращает dict: status, а для 200 еще content, url, content_type, etag, modified.
+    Не трогает БД (выполняется в пуле потоков).
+    """
+    config = current_app.config
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    max_bytes = config.get('RSS_MAX_FEED_BYTES', 5 * 1024 * 1024)
+    deadline_seconds = config.get('RSS_FETCH_DEADLINE_SECONDS', 30)
+    deadline = time.monotonic() + deadline_seconds
+    # total ограничивает соединение вместе с ожиданием заголовков, тело — _read_limited.
+    # Без повторов: повтор зависшей ленты занимал бы место хоста еще несколько таймаутов.
+    timeout = Timeout(total=deadline_seconds, connect=config.get('RSS_CONNECT_TIMEOUT', 5),
+                      read=config.get('RSS_READ_TIMEOUT', 15))
+
+    with http_client.get(url, headers=headers, timeout=timeout, stream=True, retries=0) as resp:
+        result = {'status': resp.status_code}
+        if resp.status_code == 304:
+            return result
+        resp.raise_for_status()
+        length = resp.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ValueError(f"лента больше {max_bytes} байт")
+        result.update(
+            content=_read_limited(resp, max_bytes, deadline),
+            url=resp.url,
+            content_type=resp.headers.get('Content-Type', ''),
+            etag=resp.headers.get('ETag'),
+            modified=resp.headers.get('Last-Modified')
+        )
+    return result
+
+def _interleave_by_host(jobs):
+    """Чередует задания разных хостов, чтобы потоки пула не ждали лимит одного хоста подряд."""
+    by_host = {}
+    for job in jobs:
+        by_host.setdefault(job[0], []).append(job)
+    queues = list(by_host.values())
+    result = []
+    while queues:
+        result.extend(q.pop(0) for q in queues)
+        queues = [q for q in queues if q]
+    return result
+
+def fetch_feeds(groups):
+    """
+    Этап 1: параллельно скачивает ленты — по одному запросу на группу источников.
+    groups — {ключ: [источники с этой лентой]}. Возвращает {ключ: результат fetch_feed}.
+    """
+    if not groups:
+        return {}
+    config = current_app.config
+    app = current_app._get_current_object()
+
+    jobs = []
+    for key, sources in groups.items():
+        # Условный GET — только если валидаторы у всех источников группы одинаковые:
+        # иначе источник с устаревшими валидаторами пропустил бы новые записи
+        validators = {(s.etag, s.modified) for s in sources}
+        etag, modified = validators.pop() if len(validators) == 1 else (None, None)
+        url = sources[0].url.strip()
+        jobs.append((urlsplit(url).hostname or '', key, url, etag, modified))
+    jobs = _interleave_by_host(jobs)
+    per_host = config.get('RSS_FETCH_PER_HOST', 2)
+    host_slots = {host: threading.BoundedSemaphore(per_host) for host, *_ in jobs}
+
+    def run(job):
+        host, key, url, etag, modified = job
+        with app.app_context(), host_slots[host]:
+            try:
+                return key, fetch_feed(url, etag, modified)
+            except Exception as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                return key, {'status': status, 'error': str(e)}
+
+    workers = min(config.get('RSS_FETCH_WORKERS', 16), len(jobs))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rss') as pool:
+        return dict(pool.map(run, jobs))
+
+def parse_feed(result):
+    """Разбирает скачанную ленту (один раз на группу источников)."""
+    # content-location нужен feedparser для относительных ссылок, content-type — для кодировки
+    return feedparser.parse(result['content'], response_headers={
+        'content-location': result['url'],
+        'content-type': result['content_type']
+    })
+
+def ingest_feed(source, feed, result, images=None):
+    """
+    Этап 2: создает посты источника из новых записей разобранной ленты.
+    images — общий для группы кеш {URL картинки: имя файла}. Возвращает число новых записей.
+    """
+    # Ищем новые посты
+    new_entries = []
+    # last_guid может быть None, если это первый запуск
+    last_guid = source.last_guid
     
-    # --- МЕХАНИЗМ БЛОКИРОВКИ (С ЗАЩИТОЙ ОТ GUNICORN) ---
-    # Создаем/открываем файл-лок
-    lock_path = '/tmp/postbot_rss.lock'
-    # 'a' - режим добавления. Он не затирает файл при открытии.
-    lock_file = open(lock_path, 'a')
+    # Пробегаем по ленте сверху вниз
+    for entry in feed.entries:
+        guid = entry.get('id', entry.get('link'))
+        
+        # Если встретили пост, который уже был - останавливаемся
+        if guid == last_guid:
+            break 
+        
+        new_entries.append(entry)
     
-    try:
-        # Пытаемся получить эксклюзивный доступ к файлу.
-        # fcntl.LOCK_EX - эксклюзивный замок
-        # fcntl.LOCK_NB - не ждать (Non-Blocking), если занято - сразу выдать ошибку
-        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError:
-        # Если файл занят другим воркером, просто выходим
-        # logger.info("RSS: Задача уже выполняется другим процессом. Пропуск.")
-        lock_file.close()
-        return
-
-    # --- ЕСЛИ МЫ ТУТ, ЗНАЧИТ МЫ ПЕРВЫЕ ЗАХВАТИЛИ ФАЙЛ ---
-    try:
-        from run import app
-        with app.app_context():
-            # logger.info("RSS: Start parsing...")
-            sources = RssSource.query.filter_by(is_active=True).all()
-            
+    # Если постов много, а last_guid пустой (первый прогон),
+    # берем только 1 самый свежий, чтобы не заспамить канал 20-ю постами.
+    if not last_guid and new_entries:
+        # logger.info(f"RSS: Первый запуск для {source.name}, берем только последний пост.")
+        new_entries = [new_entries[0]]
+    
+    # Если постов слишком много (например, сайт лежал и вывалил 50 штук),
+    # ограничим пачку до 5, чтобы не получить бан от Telegram
+    if len(new_entries) > 5:
+        new_entries = new_entries[:5]
+
+    # Посты создаются в хронологическом порядке (от старых к новым) и сохраняются
+    # одной транзакцией вместе с last_guid и валидаторами: при сбое не сохранится ничего,
+    # и следующий опрос (без 304) обработает те же записи заново.
+    # Публикует их очередь (app/services_queue.py) — RSS не ждет соцсети.
+    posts = []
+    for entry in reversed(new_entries):
+        new_post = build_post(source, entry, images)
+        db.session.add(new_post)
+        acquire_media(new_post.media_files, new_post)
+        posts.append(new_post)
+        source.last_guid = entry.get('id', entry.get('link'))
+
+    source.etag, source.modified = result['etag'], result['modified']
+    db.session.commit()
+
+    if posts:
+        logger.info(f"RSS: {source.name}: создано постов: {len(posts)} "
+                    f"(ID: {', '.join(str(p.id) for p in posts)})")
+    return len(new_entries)
+
+# --------------------------------------------------------------------------
+#  РАСПИСАНИЕ ОПРОСА
+# --------------------------------------------------------------------------
+# Каждая лента опрашивается в свое время (next_poll_at) со своим интервалом:
+#   * интервал ~ половина среднего промежутка между последними записями ленты
+#     (по датам записей; если дат нет — вдвое чаще после новых записей, в 1.5 раза
+#     реже, если новых нет), в пределах RSS_MIN/MAX_INTERVAL_MINUTES;
+#   * после ошибок подряд — удвоение, до RSS_MAX_BACKOFF_HOURS;
+#   * к каждому сроку добавляется разброс ±10%, а ленты без расписания раскладываются
+#     случайно по интервалу по умолчанию — опросы равномерно распределены во времени.
+
+# Сколько последних записей учитываем при оценке частоты публикаций
+RATE_SAMPLE_ENTRIES = 10
+
+def _interval_bounds():
+    config = current_app.config
+    return (config.get('RSS_MIN_INTERVAL_MINUTES', 5) * 60,
+            config.get('RSS_MAX_INTERVAL_MINUTES', 240) * 60)
+
+def _default_interval():
+    return current_app.config.get('RSS_DEFAULT_INTERVAL_MINUTES', 15) * 60
+
+def _publish_gap(feed):
+    """Средний промежуток (сек) между последними записями ленты или None, если дат нет."""
+    stamps = []
+    for entry in feed.entries[:RATE_SAMPLE_ENTRIES]:
+        parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+        if parsed:
+            stamps.append(timegm(parsed))
+    if len(stamps) < 2:
+        return None
+    stamps.sort()
+    gap = (stamps[-1] - stamps[0]) / (len(stamps) - 1)
+    return gap if gap > 0 else None
+
+def _set_next_poll(source, now, interval):
+    source.poll_interval = int(interval)
+    source.next_poll_at = now + timedelta(seconds=interval * random.uniform(0.9, 1.1))
+
+def schedule_after_success(source, now, feed=None, new_count=0):
+    """Следующий опрос после успешного ответа (feed=None — лента не изменилась, 304)."""
+    low, high = _interval_bounds()
+    interval = source.poll_interval or _default_interval()
+    gap = _publish_gap(feed) if feed is not None else None
+    if gap:
+        interval = gap / 2
+    elif new_count:
+        interval /= 2
+    else:
+        interval *= 1.5
+    source.error_count = 0
+    _set_next_poll(source, now, min(max(interval, low), high))
+
+def schedule_after_error(source, now):
+    """Следующий опрос после ошибки: интервал удваивается с каждой ошибкой подряд."""
+    source.error_count = (source.error_count or 0) + 1
+    interval = source.poll_interval or _default_interval()
+    backoff = min(interval * 2 ** source.error_count,
+                  current_app.config.get('RSS_MAX_BACKOFF_HOURS', 24) * 3600)
+    # poll_interval не меняем: после восстановления ленты возвращаемся к прежнему ритму
+    source.next_poll_at = now + timedelta(seconds=backoff * random.uniform(0.9, 1.1))
+
+def _share_schedule(leader, sources):
+    """Источники одной ленты опрашиваются вместе: расписание ведущего копируется остальным."""
+    for source in sources:
+        if source is not leader:
+            source.next_poll_at = leader.next_poll_at
+            source.poll_interval = leader.poll_interval
+            source.error_count = leader.error_count
+
+def fill_normalized_urls():
+    """Ключ группировки для лент, добавленных до появления колонки normalized_url."""
+    sources = RssSource.query.filter(RssSource.normalized_url.is_(None)).all()
+    for source in sources:
+        source.normalized_url = normalize_feed_url(source.url)
+    if sources:
+        db.session.commit()
+
+def stagger_unscheduled(now):
+    """Ленты без расписания (добавлены до его появления) раскладываются по интервалу по умолчанию."""
+    interval = _default_interval()
+    sources = RssSource.query.filter(RssSource.is_active.is_(True), RssSource.next_poll_at.is_(None)).all()
+    for source in sources:
+        source.poll_interval = interval
+        source.next_poll_at = now + timedelta(seconds=random.uniform(0, interval))
+    if sources:
+        db.session.commit()
+        logger.info(f"RSS: расписание назначено лентам: {len(sources)}")
+
+@leader_only
+def parse_rss_feeds():
+    """
+    Эта функция запускается по расписанию.
+    Выполняется только в процессе-лидере (см. app/leader.py) — один раз на весь кластер.
+    """
+    with task_context():
+        now = datetime.utcnow()
+        fill_normalized_urls()
+        stagger_unscheduled(now)
+
+        # Только ленты, которым подошло время (см. "Расписание опроса")
+        due = RssSource.query.filter(
+            RssSource.is_active.is_(True),
+            RssSource.next_poll_at <= now
+        ).order_by(RssSource.next_poll_at).limit(current_app.config.get('RSS_POLL_BATCH_SIZE', 1000)).all()
+        if not due:
+            return
+
+        # Вместе с ними опрашиваются все активные источники с той же лентой
+        keys = {s.normalized_url for s in due}
+        groups = {}
+        for source in RssSource.query.filter(RssSource.is_active.is_(True),
+                                             RssSource.normalized_url.in_(keys)).order_by(RssSource.id):
+            groups.setdefault(source.normalized_url, []).append(source)
+
+        started = time.monotonic()
+        results = fetch_feeds(groups)
+        not_modified = failed = 0
+        
+        for key, sources in groups.items():
+            result = results[key]
+            leader = sources[0]
+            for source in sources:
+                source.last_status = result['status']
+
+            if result.get('error'):
+                failed += 1
+                logger.error(f"RSS: Error fetching {leader.url}: {result['error']}")
+                schedule_after_error(leader, now)
+                _share_schedule(leader, sources)
+                db.session.commit()
+                continue
+            if result['status'] == 304:
+                not_modified += 1
+                schedule_after_success(leader, now)
+                _share_schedule(leader, sources)
+                db.session.commit()
+                continue
+
+            try:
+                feed = parse_feed(result)
+            except Exception as e:
+                logger.error(f"RSS: Error parsing {leader.url}: {e}")
+                schedule_after_error(leader, now)
+                _share_schedule(leader, sources)
+                db.session.commit()
+                continue
+
+            # Записи раздаются каждому источнику группы; картинки скачиваются один раз
+            images, new_count = {}, 0
             for source in sources:
                 try:
-                    feed = feedparser.parse(source.url)
-                    if not feed.entries:
-                        continue
-                    
-                    # Ищем новые посты
-                    new_entries = []
-                    # last_guid может быть None, если это первый запуск
-                    last_guid = source.last_guid
-                    
-                    # Пробегаем по ленте сверху вниз
-                    for entry in feed.entries:
-                        guid = entry.get('id', entry.get('link'))
-                        
-                        # Если встретили пост, который уже был - останавливаемся
-                        if guid == last_guid:
-                            break 
-                        
-                        new_entries.append(entry)
-                    
-                    # Если постов много, а last_guid пустой (первый прогон),
-                    # берем только 1 самый свежий, чтобы не заспамить канал 20-ю постами.
-                    if not last_guid and new_entries:
-                        # logger.info(f"RSS: Первый запуск для {source.name}, берем только последний пост.")
-                        new_entries = [new_entries[0]]
-                    
-                    # Если постов слишком много (например, сайт лежал и вывалил 50 штук),
-                    # ограничим пачку до 5, чтобы не получить бан от Telegram
-                    if len(new_entries) > 5:
-                        new_entries = new_entries[:5]
-
-                    # Постим в хронологическом порядке (от старых к новым)
-                    for entry in reversed(new_entries):
-                        # ВАЖНО: Проверяем еще раз GUID перед обработкой, 
-                        # на случай если другой поток успел записать (двойная страховка)
-                        guid = entry.get('id', entry.get('link'))
-                        
-                        # Пробуем обработать
-                        process_entry(source, entry)
-                        
-                        # Сразу обновляем last_guid в базе после каждого поста!
-                        # Это защитит, если скрипт упадет на середине.
-                        source.last_guid = guid
-                        db.session.commit()
-                        
+                    new_count = max(new_count, ingest_feed(source, feed, result, images))
                 except Exception as e:
-                    logger.error(f"RSS: Error parsing {source.url}: {e}")
+                    logger.error(f"RSS: Error ingesting {source.url} (source {source.id}): {e}")
                     db.session.rollback() # Откат базы при ошибке
+            schedule_after_success(leader, now, feed, new_count)
+            _share_schedule(leader, sources)
+            db.session.commit()
 
-    finally:
-        # В конце ОБЯЗАТЕЛЬНО снимаем замок
-        fcntl.flock(lock_file, fcntl.LOCK_UN)
-        lock_file.close()
+        polled = sum(len(sources) for sources in groups.values())
+        logger.info(f"RSS: опрошено источников: {polled}, запросов: {len(groups)}, "
+                    f"за {time.monotonic() - started:.1f} сек., без изменений (304): {not_modified}, ошибок: {failed}")
 
-def process_entry(source, entry):
-    """Обработка одной записи RSS и создание поста"""
+def build_post(source, entry, images=None):
+    """
+    Собирает пост из записи RSS (без commit; сохраняет и публикует вызывающий).
+    images — кеш {URL картинки: имя файла}, общий для источников одной ленты.
+    """
 
     title = entry.get('title', 'Без заголовка')
     link = entry.get('link', '')
@@ -235,7 +518,11 @@ def process_entry(source, entry):
     # -------- МЕДИА --------
     media_files = []
     if image_url:
-        saved_filename = download_image(image_url)
+        if images is None:
+            images = {}
+        if image_url not in images:
+            images[image_url] = download_image(image_url, source.project_id)
+        saved_filename = images[image_url]
         if saved_filename:
             media_files.append(saved_filename)
 
@@ -259,12 +546,10 @@ def process_entry(source, entry):
         vk_layout='grid',
 
         publish_to_ok=source.publish_to_ok,
-        ok_group_id=source.ok_group_id
-    )
-
-    db.session.add(new_post)
-    db.session.commit()
+        ok_group_id=source.ok_group_id,
 
-    logger.info(f"RSS: Post created from {source.name} (ID: {new_post.id})")
-    publish_post_task(new_post.id)
+        # В том числе VK: у RSS-постов нет прямой отправки в VK из routes_main
+        publish_via_queue=True
+    )
+    return new_post
 
@@ -151,7 +151,10 @@ function renderFiles() {
 
     const info = document.createElement('div');
     info.innerHTML = `<strong>${file.name}</strong><br>
-                      <span class="file-info">${(file.size/1024/1024).toFixed(2)} МБ</span>`;
+                      <span class="file-info">${(file.size/1024/1024).toFixed(2)} МБ</span>
+                      <div class="progress mt-1" style="height: 4px; display: none;">
+                        <div class="progress-bar" role="progressbar" style="width: 0%"></div>
+                      </div>`;
 
     const remove = document.createElement('span');
     remove.innerHTML = '✕';
@@ -183,6 +186,103 @@ function refreshAndRender() {
   validateSubmit(); 
 }
 
+/* ------------ 8.1. ЗАГРУЗКА ФАЙЛОВ ПО ЧАСТЯМ (с дозагрузкой) ------------ */
+// Файл режется на части (размер задает сервер), части уходят параллельно.
+// ID загрузки хранится в localStorage: если связь оборвалась или страницу
+// перезагрузили, при повторной отправке того же файла докачиваются только недостающие части.
+const UPLOAD_PARALLEL_CHUNKS = 3;
+const UPLOAD_CHUNK_RETRIES = 5;
+
+function uploadKey(file) {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function uploadRequest(url, options) {
+    const response = await fetch(url, options);
+    const data = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        const error = new Error(data.message || `Ошибка загрузки (HTTP ${response.status})`);
+        error.status = response.status;
+        throw error;
+    }
+    return data;
+}
+
+async function startOrResumeUpload(file) {
+    const savedId = localStorage.getItem(uploadKey(file));
+    if (savedId) {
+        try {
+            return await uploadRequest(`/uploads/${savedId}`);
+        } catch (e) {
+            localStorage.removeItem(uploadKey(file)); // Загрузка устарела — начинаем заново
+        }
+    }
+    const info = await uploadRequest('/uploads', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({filename: file.name, size: file.size})
+    });
+    localStorage.setItem(uploadKey(file), info.upload_id);
+    return info;
+}
+
+function chunkLength(info, file, index) {
+    return Math.min(info.chunk_size, file.size - index * info.chunk_size);
+}
+
+async function putChunk(info, file, index) {
+    const start = index * info.chunk_size;
+    const blob = file.slice(start, start + chunkLength(info, file, index));
+    for (let attempt = 1; ; attempt++) {
+        try {
+            await uploadRequest(`/uploads/${info.upload_id}/chunks/${index}`, {method: 'PUT', body: blob});
+            return blob.size;
+        } catch (e) {
+            // Ошибки 4xx (кроме 429) повтором не исправить
+            const fatal = e.status && e.status < 500 && e.status !== 429;
+            if (fatal || attempt >= UPLOAD_CHUNK_RETRIES) throw e;
+            await sleep(Math.min(1000 * 2 ** attempt, 15000));
+        }
+    }
+}
+
+/**
+ * Загружает файл по частям и возвращает upload_id для формы поста.
+ * onProgress получает долю загруженного (0..1).
+ */
+async function uploadFile(file, onProgress) {
+    let info = await startOrResumeUpload(file);
+    if (!info.filename) {
+        const received = new Set(info.received);
+        const pending = [];
+        let loaded = 0;
+        for (let i = 0; i < info.total_chunks; i++) {
+            if (received.has(i)) loaded += chunkLength(info, file, i);
+            else pending.push(i);
+        }
+        onProgress(loaded / file.size);
+
+        const worker = async () => {
+            while (pending.length) {
+                loaded += await putChunk(info, file, pending.shift());
+                onProgress(loaded / file.size);
+            }
+        };
+        await Promise.all(Array.from({length: Math.min(UPLOAD_PARALLEL_CHUNKS, pending.length)}, worker));
+        info = await uploadRequest(`/uploads/${info.upload_id}/complete`, {method: 'POST'});
+    }
+    onProgress(1);
+    return info.upload_id;
+}
+
+function setUploadProgress(idx, fraction) {
+    const item = fileList ? fileList.children[idx] : null;
+    if (!item) return;
+    const progress = item.querySelector('.progress');
+    progress.style.display = 'flex';
+    progress.querySelector('.progress-bar').style.width = `${Math.round(fraction * 100)}%`;
+}
+
 /* ------------ ВСТАВКА ПОДПИСИ (Новая функция) ------------ */
 function insertSignature(text) {
     if (!quill) return;
@@ -303,7 +403,7 @@ async function pollPostStatus(postId) {
             
             const data = await response.json();
 
-            if (data.status === 'published' || data.status === 'failed') {
+            if (['published', 'failed', 'partial', 'retrying'].includes(data.status)) {
                 const historyUl = document.querySelector('ul.history');
                 if (historyUl) {
                     historyUl.insertAdjacentHTML('afterbegin', data.html);
@@ -314,7 +414,7 @@ async function pollPostStatus(postId) {
                 
                 if (data.status === 'published' && postSuccessToast) {
                     postSuccessToast.show();
-                } else if (data.status === 'failed' && postErrorToast && postErrorToastBody) {
+                } else if (data.status !== 'published' && postErrorToast && postErrorToastBody) {
                     postErrorToastBody.textContent = data.error_message || "Пост не опубликован (неизвестная ошибка).";
                     postErrorToast.show();
                 }
@@ -365,6 +465,12 @@ if (form) {
         const formData = new FormData(form);
 
         try {
+            // Файлы уходят заранее, по частям; в форме поста — только их upload_id
+            formData.delete('media');
+            for (const [idx, file] of fileArray.entries()) {
+                formData.append('upload_id', await uploadFile(file, fraction => setUploadProgress(idx, fraction)));
+            }
+
             const response = await fetch(form.action, {
                 method: 'POST',
                 body: formData
@@ -374,6 +480,7 @@ if (form) {
 
             if (data.status === 'ok') {
                 pollPostStatus(data.post_id);
+                fileArray.forEach(f => localStorage.removeItem(uploadKey(f)));
                 if (quill) quill.root.innerHTML = '';
                 fileArray = [];
                 refreshAndRender(); 
@@ -385,7 +492,8 @@ if (form) {
 
         } catch (error) {
             console.error('Ошибка отправки формы:', error);
-            if(postErrorToastBody) postErrorToastBody.textContent = 'Не удалось отправить форму. Проверьте консоль.';
+            // Ошибки сервера при загрузке файла показываем как есть
+            if(postErrorToastBody) postErrorToastBody.textContent = error.status ? error.message : 'Не удалось отправить форму. Проверьте консоль.';
             if(postErrorToast) postErrorToast.show();
         } finally {
             // 7. РАЗБЛОКИРУЕМ КНОПКУ (форма уже не заблокирована)
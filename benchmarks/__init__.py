@@ -0,0 +1,2 @@
+# benchmarks/__init__.py
+# Бенчмарки производительности (запуск: python -m benchmarks.<имя>)
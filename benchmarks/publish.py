@@ -0,0 +1,228 @@
+# benchmarks/publish.py
+"""
+Бенчмарк публикации постов (publish_post_task) на локальных заглушках API.
+
+Запуск из корня проекта:
+    python -m benchmarks.publish                       # все сценарии, 50 постов
+    python -m benchmarks.publish -s album -n 200 -c 8  # только альбомы, 8 постов параллельно
+    python -m benchmarks.publish --latency-ms 200 --rate-429 0.05 --error-rate 0.01
+
+Сценарии:
+    text  — только текст (TG, VK, OK, MAX)
+    album — 4 фото (TG, VK, OK, MAX, IG)
+    video — одно видео (TG, VK, OK, MAX)
+
+Для каждого сценария выводятся посты/сек, p50/p99 времени публикации одного поста
+и итоговые статусы. БД — временный SQLite (или --db), в реальную БД ничего не пишется.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cryptography.fernet import Fernet
+
+from benchmarks.stubs import StubSettings, start_stub_server
+
+SCENARIOS = ('text', 'album', 'video')
+
+
+def percentile(values, pct):
+    """Перцентиль по ближайшему рангу (values — отсортированный список)."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[k]
+
+
+def make_media(folder, image_kb, video_mb):
+    """Создает файлы-пустышки нужного размера (содержимое заглушкам не важно)."""
+    images = []
+    for i in range(4):
+        name = f"bench_{i}.jpg"
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(os.urandom(image_kb * 1024))
+        images.append(name)
+
+    video = "bench.mp4"
+    with open(os.path.join(folder, video), 'wb') as f:
+        for _ in range(video_mb):
+            f.write(os.urandom(1024 * 1024))
+    return {'text': [], 'album': images, 'video': [video]}
+
+
+def setup_project(db):
+    """Пользователь, проект, токены и каналы во всех соцсетях."""
+    from app.models import User, Project, SocialTokens, TgChannel, VkGroup, OkGroup, MaxChat
+
+    user = User(email='bench@example.com', is_active=True)
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.commit()
+
+    project = Project(user_id=user.id, name='Benchmark')
+    db.session.add(project)
+    db.session.commit()
+
+    tokens = SocialTokens(project_id=project.id)
+    tokens.tg_token = '123456:bench'
+    tokens.vk_token = 'vk-bench'
+    tokens.vk_refresh_token = 'vk-refresh'
+    tokens.vk_device_id = 'bench'
+    tokens.vk_token_expires_at = datetime.utcnow() + timedelta(days=1)
+    tokens.ok_token = 'ok-bench'
+    tokens.ok_app_pub_key = 'pub'
+    tokens.ok_app_secret_key = 'secret'
+    tokens.max_token = 'max-bench'
+    tokens.ig_user_id = '17841400000000000'
+    tokens.ig_page_token = 'ig-bench'
+
+    targets = dict(
+        tg_channel=TgChannel(user_id=user.id, project_id=project.id, name='TG', chat_id='@bench'),
+        vk_group=VkGroup(user_id=user.id, project_id=project.id, name='VK', group_id=1),
+        ok_group=OkGroup(project_id=project.id, name='OK', group_id='1'),
+        max_chat=MaxChat(project_id=project.id, name='MAX', chat_id='1'),
+    )
+    db.session.add(tokens)
+    db.session.add_all(targets.values())
+    db.session.commit()
+    return user, project, targets
+
+
+def create_posts(db, user, project, targets, media_files, count, with_ig):
+    from app.models import Post
+
+    posts = [Post(
+        user_id=user.id, project_id=project.id,
+        text='<b>Benchmark</b> post', text_vk='Benchmark post',
+        media_files=list(media_files), status='scheduled',
+        publish_to_tg=True, tg_channel_id=targets['tg_channel'].id,
+        publish_to_vk=True, vk_group_id=targets['vk_group'].id,
+        publish_to_ok=True, ok_group_id=targets['ok_group'].id,
+        publish_to_max=True, max_chat_id=targets['max_chat'].id,
+        publish_to_ig=with_ig,
+        platform_info={'buttons': []}
+    ) for _ in range(count)]
+    db.session.add_all(posts)
+    db.session.commit()
+    return [p.id for p in posts]
+
+
+def run_scenario(app, name, post_ids, concurrency):
+    from app import db
+    from app.models import Post
+    from app.services import publish_post_task
+
+    def timed(post_id):
+        started = time.perf_counter()
+        publish_post_task(post_id)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(timed, post_ids))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        statuses = Counter(status for (status,) in
+                           db.session.query(Post.status).filter(Post.id.in_(post_ids)))
+
+    return {
+        'scenario': name,
+        'posts': len(post_ids),
+        'elapsed': elapsed,
+        'rate': len(post_ids) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'mean': statistics.mean(latencies) if latencies else 0,
+        'statuses': dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк публикации постов на заглушках API.')
+    parser.add_argument('-s', '--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('-n', '--posts', type=int, default=50, help='Постов на сценарий')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='Постов публикуется параллельно')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов HTTP 500')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Доля ответов 429')
+    parser.add_argument('--image-kb', type=int, default=300)
+    parser.add_argument('--video-mb', type=int, default=5)
+    parser.add_argument('--rate-limit', action='store_true', help='Включить RATE_LIMITS (по умолчанию выключены)')
+    parser.add_argument('--no-upload-cache', action='store_true',
+                        help='Выключить кеш загрузок (каждый пост загружает медиа заново)')
+    parser.add_argument('--db', help='URI базы (по умолчанию временный SQLite)')
+    args = parser.parse_args()
+
+    settings = StubSettings(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                            error_rate=args.error_rate, rate_429=args.rate_429)
+    server, base_url = start_stub_server(settings)
+
+    workdir = tempfile.mkdtemp(prefix='postbot-bench-')
+    upload_dir = os.path.join(workdir, 'uploads')
+    os.makedirs(upload_dir)
+
+    # config.py требует FERNET_KEY при импорте
+    fernet_key = os.environ.setdefault('FERNET_KEY', Fernet.generate_key().decode())
+
+    from app import create_app, db
+    from config import Config
+
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'bench',
+        'SQLALCHEMY_DATABASE_URI': args.db or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'UPLOAD_FOLDER': upload_dir,
+        'FERNET_KEY': fernet_key,
+        'APP_URL': base_url,
+        'TG_API_BASE': base_url,
+        'VK_API_BASE': base_url,
+        'OK_API_BASE': base_url,
+        'MAX_API_BASE': base_url,
+        'IG_API_BASE': f"{base_url}/ig",
+        'PUBLISH_FANOUT_WORKERS': Config.PUBLISH_FANOUT_WORKERS,
+        'MEDIA_UPLOAD_CONCURRENCY': Config.MEDIA_UPLOAD_CONCURRENCY,
+        # Без повторов: неудачный пост сразу получает итоговый статус
+        'PUBLISH_MAX_RETRIES': 0,
+        'RATE_LIMIT_ENABLED': args.rate_limit,
+        'RATE_LIMITS': Config.RATE_LIMITS,
+        'RATE_LIMIT_MAX_WAIT_SECONDS': Config.RATE_LIMIT_MAX_WAIT_SECONDS,
+        'MEDIA_UPLOAD_CACHE_ENABLED': not args.no_upload_cache,
+        'MEDIA_UPLOAD_CACHE_TTL': Config.MEDIA_UPLOAD_CACHE_TTL,
+    }, start_scheduler=False)
+
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+    results = []
+    try:
+        with app.app_context():
+            user, project, targets = setup_project(db)
+            media = make_media(upload_dir, args.image_kb, args.video_mb)
+            post_ids = {
+                name: create_posts(db, user, project, targets, media[name], args.posts,
+                                   with_ig=(name == 'album'))
+                for name in scenarios
+            }
+
+        for name in scenarios:
+            results.append(run_scenario(app, name, post_ids[name], args.concurrency))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nЗаглушки: задержка {args.latency_ms}+{args.jitter_ms} мс, "
+          f"ошибки {args.error_rate:.0%}, 429 {args.rate_429:.0%}, параллельно {args.concurrency}")
+    print(f"{'сценарий':<8} {'постов':>7} {'посты/с':>9} {'p50, с':>8} {'p99, с':>8}  статусы")
+    for r in results:
+        print(f"{r['scenario']:<8} {r['posts']:>7} {r['rate']:>9.2f} {r['p50']:>8.3f} {r['p99']:>8.3f}  {r['statuses']}")
+    print(f"Запросов к заглушкам: {dict(settings.stats)}")
+
+
+if __name__ == '__main__':
+    main()
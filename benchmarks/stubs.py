@@ -0,0 +1,185 @@
+# benchmarks/stubs.py
+"""
+Локальные HTTP-заглушки API соцсетей для бенчмарков публикации.
+
+Один сервер отвечает за все платформы (маршрутизация по пути):
+  /bot<token>/<method>        — Telegram Bot API        (TG_API_BASE = <url>)
+  /method/<name>              — VK API                  (VK_API_BASE = <url>)
+  /vk/upload/{photo,video}    — серверы загрузки VK (адреса выдает сама заглушка)
+  /fb.do                      — OK API                  (OK_API_BASE = <url>)
+  /ok/upload/{photo,video}    — серверы загрузки OK
+  /api/v1/send                — MAX                     (MAX_API_BASE = <url>)
+  /ig/<user_id>/<method>      — Instagram Graph API     (IG_API_BASE = <url>/ig)
+
+Задержка, доля ошибок (HTTP 500) и доля ответов 429 задаются в StubSettings.
+"""
+import json
+import time
+import random
+import threading
+import itertools
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+@dataclass
+class StubSettings:
+    latency_ms: float = 50      # Базовая задержка ответа
+    jitter_ms: float = 20       # Случайная добавка к задержке (0..jitter_ms)
+    error_rate: float = 0.0     # Доля ответов HTTP 500
+    rate_429: float = 0.0       # Доля ответов 429 Too Many Requests
+    retry_after: int = 1        # retry_after в ответах 429
+    stats: Counter = field(default_factory=Counter)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ids = itertools.count(1000)
+
+    # Настройки и адрес сервера проставляет start_stub_server
+    settings = None
+    base_url = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _platform(self, path):
+        if path.startswith('/bot'): return 'tg'
+        if path.startswith('/method/') or path.startswith('/vk/'): return 'vk'
+        if path.startswith('/fb.do') or path.startswith('/ok/'): return 'ok'
+        if path.startswith('/api/v1/send'): return 'max'
+        if path.startswith('/ig/'): return 'ig'
+        return 'unknown'
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split('?')[0]
+        platform = self._platform(path)
+        settings = self.settings
+        settings.count(platform)
+
+        time.sleep((settings.latency_ms + random.uniform(0, settings.jitter_ms)) / 1000)
+
+        roll = random.random()
+        if roll < settings.rate_429:
+            settings.count(f'{platform}_429')
+            return self._send_json(
+                {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: stub',
+                 'parameters': {'retry_after': settings.retry_after}},
+                status=429, headers={'Retry-After': str(settings.retry_after)})
+        if roll < settings.rate_429 + settings.error_rate:
+            settings.count(f'{platform}_error')
+            return self._send_json({'ok': False, 'description': 'Stub error'}, status=500)
+
+        handler = getattr(self, f'_handle_{platform}', None)
+        if handler is None:
+            return self._send_json({'error': 'not found'}, status=404)
+        return handler(path, body)
+
+    do_GET = do_POST
+
+    # --- Telegram ---
+    def _tg_message(self, kind=None):
+        message = {'message_id': next(self.ids)}
+        if kind == 'photo':
+            message['photo'] = [{'file_id': f'stub-photo-{next(self.ids)}'}]
+        elif kind == 'video':
+            message['video'] = {'file_id': f'stub-video-{next(self.ids)}'}
+        return message
+
+    def _handle_tg(self, path, body):
+        method = path.rsplit('/', 1)[-1]
+        if method == 'sendMediaGroup':
+            # По сообщению на каждый элемент альбома (считаем по "type" в поле media)
+            kinds = ['photo'] * body.count(b'"type": "photo"') + ['video'] * body.count(b'"type": "video"')
+            return self._send_json({'ok': True, 'result': [self._tg_message(k) for k in kinds]
+                                    or [self._tg_message()]})
+        kind = {'sendPhoto': 'photo', 'sendVideo': 'video'}.get(method)
+        return self._send_json({'ok': True, 'result': self._tg_message(kind)})
+
+    # --- VK ---
+    def _handle_vk(self, path, body):
+        if path == '/vk/upload/photo':
+            return self._send_json({'server': 1, 'photo': '[{"photo":"stub"}]', 'hash': 'stub'})
+        if path == '/vk/upload/video':
+            return self._send_json({'size': len(body)})
+
+        method = path[len('/method/'):]
+        if method == 'photos.getWallUploadServer':
+            return self._send_json({'response': {'upload_url': f'{self.base_url}/vk/upload/photo',
+                                                 'album_id': 1, 'user_id': 1}})
+        if method == 'photos.saveWallPhoto':
+            return self._send_json({'response': [{'owner_id': -1, 'id': next(self.ids)}]})
+        if method == 'execute':
+            # Пачка photos.saveWallPhoto (см. _vk_save_wall_photos)
+            code = parse_qs(body.decode('utf-8', 'ignore')).get('code', [''])[0]
+            return self._send_json({'response': [[{'owner_id': -1, 'id': next(self.ids)}]
+                                                  for _ in range(code.count('saveWallPhoto'))]})
+        if method == 'video.save':
+            return self._send_json({'response': {'upload_url': f'{self.base_url}/vk/upload/video',
+                                                 'owner_id': -1, 'video_id': next(self.ids)}})
+        if method == 'wall.post':
+            return self._send_json({'response': {'post_id': next(self.ids)}})
+        return self._send_json({'response': 1})
+
+    # --- OK ---
+    def _handle_ok(self, path, body):
+        if path == '/ok/upload/photo':
+            # Токен на каждый файл pic1..picN
+            count = max(1, body.count(b'name="pic'))
+            return self._send_json({'photos': {f'p{next(self.ids)}': {'token': f'stub-{next(self.ids)}'}
+                                               for _ in range(count)}})
+        if path == '/ok/upload/video':
+            return self._send_json({})
+
+        params = parse_qs(body.decode('utf-8', 'ignore'))
+        method = params.get('method', [''])[0]
+        if method == 'photosV2.getUploadUrl':
+            return self._send_json({'upload_url': f'{self.base_url}/ok/upload/photo'})
+        if method == 'video.getUploadUrl':
+            return self._send_json({'upload_url': f'{self.base_url}/ok/upload/video',
+                                    'video_id': next(self.ids)})
+        if method == 'mediatopic.post':
+            return self._send_json(str(next(self.ids)))
+        return self._send_json({})
+
+    # --- MAX ---
+    def _handle_max(self, path, body):
+        return self._send_json({'ok': True})
+
+    # --- Instagram ---
+    def _handle_ig(self, path, body):
+        return self._send_json({'id': str(next(self.ids))})
+
+
+def start_stub_server(settings, host='127.0.0.1', port=0):
+    """Запускает заглушку в фоновом потоке. Возвращает (server, base_url)."""
+    handler = type('BoundStubHandler', (StubHandler,), {'settings': settings})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    handler.base_url = f"http://{host}:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, name='stub-api', daemon=True)
+    thread.start()
+    return server, handler.base_url
@@ -41,4 +41,137 @@ class Config:
     # OK (Одноклассники)
     OK_CLIENT_ID = os.environ.get('OK_CLIENT_ID')       # App ID
     OK_CLIENT_SECRET = os.environ.get('OK_CLIENT_SECRET') # Secret Key
-    OK_APP_PUB_KEY = os.environ.get('OK_APP_PUB_KEY')   # Public Key    
\ No newline at end of file
+    OK_APP_PUB_KEY = os.environ.get('OK_APP_PUB_KEY')   # Public Key
+
+    # --- Адреса API соцсетей (переопределяются для тестовых заглушек, см. benchmarks/) ---
+    TG_API_BASE = os.environ.get('TG_API_BASE', 'https://api.telegram.org')
+    VK_API_BASE = os.environ.get('VK_API_BASE', 'https://api.vk.ru')
+    OK_API_BASE = os.environ.get('OK_API_BASE', 'https://api.ok.ru')
+    MAX_API_BASE = os.environ.get('MAX_API_BASE', 'https://api.max-messenger.com')
+    IG_API_BASE = os.environ.get('IG_API_BASE', 'https://graph.facebook.com/v19.0')
+
+    # --- Кеш загрузок медиа в соцсети (повторно тот же файл не загружается) ---
+    MEDIA_UPLOAD_CACHE_ENABLED = os.environ.get('MEDIA_UPLOAD_CACHE_ENABLED', 'true').lower() in ['true', 'on', '1']
+    # Сколько секунд живет загруженный ID (file_id TG бессрочный, токены фото OK — короткие)
+    MEDIA_UPLOAD_CACHE_TTL = {
+        'tg': 180 * 24 * 3600,
+        'vk': 30 * 24 * 3600,
+        'ok': 12 * 3600,
+    }
+
+    # --- Загрузка больших файлов по частям (app/media.py) ---
+    MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', 5 * 1024 * 1024))
+    # Через сколько часов недокачанная загрузка считается брошенной и удаляется
+    MEDIA_UPLOAD_SESSION_HOURS = int(os.environ.get('MEDIA_UPLOAD_SESSION_HOURS', 24))
+
+    # --- Сборка мусора в UPLOAD_FOLDER (app/media.py) ---
+    MEDIA_GC_INTERVAL_HOURS = int(os.environ.get('MEDIA_GC_INTERVAL_HOURS', 6))
+    # Файлы моложе этого срока не трогаем: они могут еще ждать создания поста
+    MEDIA_GC_GRACE_HOURS = int(os.environ.get('MEDIA_GC_GRACE_HOURS', 24))
+    MEDIA_GC_BATCH_SIZE = int(os.environ.get('MEDIA_GC_BATCH_SIZE', 500))
+
+    # --- Параллельная загрузка медиа в VK/OK: не больше N загрузок одновременно на проект ---
+    MEDIA_UPLOAD_CONCURRENCY = int(os.environ.get('MEDIA_UPLOAD_CONCURRENCY', 3))
+
+    # --- Подготовка картинок под лимиты соцсетей (app/media_processing.py, нужен Pillow) ---
+    MEDIA_PREPROCESS_ENABLED = os.environ.get('MEDIA_PREPROCESS_ENABLED', 'true').lower() in ['true', 'on', '1']
+    # Процессов в пуле (обработка картинок не должна занимать веб-воркеры)
+    MEDIA_PROCESS_WORKERS = int(os.environ.get('MEDIA_PROCESS_WORKERS', 2))
+    # Максимальная сторона, максимальный размер файла и форматы, которые платформа примет как есть.
+    # Все остальное (и любые картинки с EXIF) пережимается в JPEG.
+    MEDIA_VARIANT_PROFILES = {
+        'tg': {'max_side': 2560, 'max_bytes': 10 * 1024 * 1024, 'formats': ('.jpg', '.jpeg', '.png', '.webp')},
+        'vk': {'max_side': 2560, 'max_bytes': 50 * 1024 * 1024, 'formats': ('.jpg', '.jpeg', '.png')},
+        'ok': {'max_side': 2560, 'max_bytes': 20 * 1024 * 1024, 'formats': ('.jpg', '.jpeg', '.png')},
+        'ig': {'max_side': 1440, 'max_bytes': 8 * 1024 * 1024, 'formats': ('.jpg', '.jpeg')},
+    }
+
+    # --- HTTP-клиент (app/http_client.py): общие keep-alive сессии по хостам ---
+    # Сколько хостов держим в пуле и сколько соединений на хост (>= параллельных отправок)
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 10))
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 20))
+    # Повторы при обрыве соединения (любые методы) и 5xx (только идемпотентные запросы)
+    HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+    HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+    # Таймаут по умолчанию, если у вызова нет своего
+    HTTP_TIMEOUT_SECONDS = int(os.environ.get('HTTP_TIMEOUT_SECONDS', 30))
+
+    # --- Планировщик (APScheduler) ---
+    # Окно (в секундах), в течение которого пропущенные публикации еще догоняются
+    # (например, после простоя). Посты, просроченные сильнее, помечаются как failed.
+    SCHEDULER_MISFIRE_GRACE_SECONDS = int(os.environ.get('SCHEDULER_MISFIRE_GRACE_SECONDS', 3600))
+
+    # --- Диспетчер публикаций (одна периодическая задача вместо задачи на каждый пост) ---
+    # Период опроса очереди = максимальная задержка публикации относительно scheduled_at
+    DISPATCHER_INTERVAL_SECONDS = int(os.environ.get('DISPATCHER_INTERVAL_SECONDS', 5))
+    # Сколько постов публикуются параллельно (слоты постоянного пула диспетчера)
+    DISPATCHER_CONCURRENCY = int(os.environ.get('DISPATCHER_CONCURRENCY', 4))
+
+    # --- Воркер публикаций (worker.py) ---
+    # Если включено, веб-процессы не запускают диспетчер:
+    # посты забирает отдельный воркер из таблицы posts (SELECT ... FOR UPDATE SKIP LOCKED).
+    # Несколько воркеров одновременно — только с PostgreSQL (DATABASE_URL), не с SQLite.
+    PUBLISH_WORKER_ENABLED = os.environ.get('PUBLISH_WORKER_ENABLED', 'false').lower() in ['true', 'on', '1']
+    PUBLISH_WORKER_BATCH_SIZE = int(os.environ.get('PUBLISH_WORKER_BATCH_SIZE', 10))
+    PUBLISH_WORKER_POLL_SECONDS = float(os.environ.get('PUBLISH_WORKER_POLL_SECONDS', 2))
+    # Сколько секунд пост "арендован" воркером; после истечения его может забрать другой
+    PUBLISH_LEASE_SECONDS = int(os.environ.get('PUBLISH_LEASE_SECONDS', 900))
+
+    # --- Предзагрузка медиа отложенных постов (app/services.prestage_media) ---
+    # За сколько минут до scheduled_at медиа загружаются в VK/OK/TG (в кеш загрузок),
+    # чтобы в момент публикации остался только wall.post / mediatopic.post / sendMediaGroup.
+    # 0 — выключено. Нужен MEDIA_UPLOAD_CACHE_ENABLED; TTL кеша должен быть больше окна.
+    MEDIA_PRESTAGE_MINUTES = int(os.environ.get('MEDIA_PRESTAGE_MINUTES', 30))
+    MEDIA_PRESTAGE_INTERVAL_SECONDS = int(os.environ.get('MEDIA_PRESTAGE_INTERVAL_SECONDS', 60))
+    # Сколько постов готовится за один запуск
+    MEDIA_PRESTAGE_BATCH_SIZE = int(os.environ.get('MEDIA_PRESTAGE_BATCH_SIZE', 20))
+
+    # Сколько соцсетей одного поста отправляются параллельно
+    PUBLISH_FANOUT_WORKERS = int(os.environ.get('PUBLISH_FANOUT_WORKERS', 5))
+
+    # Автоповтор неудачных отправок: экспоненциальная задержка BASE * 2^n (не больше MAX) со случайным разбросом
+    PUBLISH_MAX_RETRIES = int(os.environ.get('PUBLISH_MAX_RETRIES', 3))
+    PUBLISH_RETRY_BASE_SECONDS = int(os.environ.get('PUBLISH_RETRY_BASE_SECONDS', 60))
+    PUBLISH_RETRY_MAX_SECONDS = int(os.environ.get('PUBLISH_RETRY_MAX_SECONDS', 3600))
+
+    # --- Ограничение частоты отправки (токен-бакеты в БД, общие для всего кластера) ---
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() in ['true', 'on', '1']
+    # Вид ключа -> (запросов в секунду, размер пачки)
+    RATE_LIMITS = {
+        'tg_bot': (25, 30),       # на бота: Telegram допускает ~30 сообщений/сек
+        'tg_chat': (20 / 60, 3),  # на бот+чат: ~20 сообщений/мин в канал или группу
+        'vk_group': (3, 3),       # на группу VK
+        'ok_group': (2, 2),       # на группу OK
+    }
+    # Дольше этого не ждем: отправка завершается ошибкой
+    RATE_LIMIT_MAX_WAIT_SECONDS = int(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', 300))
+    # То же для отправки прямо из веб-запроса (VK из формы): дольше — пост досылает очередь
+    RATE_LIMIT_WEB_MAX_WAIT_SECONDS = int(os.environ.get('RATE_LIMIT_WEB_MAX_WAIT_SECONDS', 2))
+    # Пауза для группы VK после ошибки flood control (код 9)
+    RATE_LIMIT_FLOOD_DELAY_SECONDS = int(os.environ.get('RATE_LIMIT_FLOOD_DELAY_SECONDS', 60))
+
+    # --- Лидер периодических задач (RSS, биллинг): один на весь кластер ---
+    # Аренда лидера в таблице scheduler_locks; без продления истекает через LEADER_LEASE_SECONDS
+    LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', 60))
+    LEADER_HEARTBEAT_SECONDS = int(os.environ.get('LEADER_HEARTBEAT_SECONDS', 20))
+
+    # --- Опрос RSS (app/services_rss.py) ---
+    # Ленты скачиваются параллельно: потоков в пуле и не больше N запросов к одному хосту
+    RSS_FETCH_WORKERS = int(os.environ.get('RSS_FETCH_WORKERS', 16))
+    RSS_FETCH_PER_HOST = int(os.environ.get('RSS_FETCH_PER_HOST', 2))
+    # Таймауты соединения и чтения (сек) и общий лимит времени на скачивание одной ленты
+    RSS_CONNECT_TIMEOUT = float(os.environ.get('RSS_CONNECT_TIMEOUT', 5))
+    RSS_READ_TIMEOUT = float(os.environ.get('RSS_READ_TIMEOUT', 15))
+    RSS_FETCH_DEADLINE_SECONDS = int(os.environ.get('RSS_FETCH_DEADLINE_SECONDS', 30))
+    # Ленты больше этого размера не скачиваются
+    RSS_MAX_FEED_BYTES = int(os.environ.get('RSS_MAX_FEED_BYTES', 5 * 1024 * 1024))
+    # Задача rss_job запускается раз в RSS_POLL_TICK_SECONDS и опрашивает только ленты,
+    # у которых наступил next_poll_at (не больше RSS_POLL_BATCH_SIZE за запуск)
+    RSS_POLL_TICK_SECONDS = int(os.environ.get('RSS_POLL_TICK_SECONDS', 60))
+    RSS_POLL_BATCH_SIZE = int(os.environ.get('RSS_POLL_BATCH_SIZE', 1000))
+    # Интервал опроса ленты подстраивается под частоту ее публикаций в этих пределах (минуты)
+    RSS_DEFAULT_INTERVAL_MINUTES = int(os.environ.get('RSS_DEFAULT_INTERVAL_MINUTES', 15))
+    RSS_MIN_INTERVAL_MINUTES = int(os.environ.get('RSS_MIN_INTERVAL_MINUTES', 5))
+    RSS_MAX_INTERVAL_MINUTES = int(os.environ.get('RSS_MAX_INTERVAL_MINUTES', 240))
+    # После ошибок подряд интервал удваивается, но не больше этого (часы)
+    RSS_MAX_BACKOFF_HOURS = int(os.environ.get('RSS_MAX_BACKOFF_HOURS', 24))
@@ -13,19 +13,22 @@ def app():
     
     # 1. Создаем временную папку для загрузок
     upload_dir = tempfile.mkdtemp()
+    # БД — во временном файле, а не в памяти: публикация работает в нескольких потоках,
+    # а :memory: отдает всем потокам одно соединение (транзакции потоков смешиваются)
+    db_dir = tempfile.mkdtemp()
     
     # 2. Генерируем ключ шифрования
     fernet_key = Fernet.generate_key().decode()
 
     app = create_app({
         'TESTING': True,
-        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(db_dir, 'test.db')}",
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
         'SECRET_KEY': 'test_secret',
         'WTF_CSRF_ENABLED': False,
         'UPLOAD_FOLDER': upload_dir,
         'FERNET_KEY': fernet_key
-    })
+    }, start_scheduler=False) # Фоновые задачи в тестах не нужны
 
     with app.app_context():
         db.create_all()
@@ -45,6 +48,7 @@ def app():
     
     # Удаляем временную папку
     shutil.rmtree(upload_dir)
+    shutil.rmtree(db_dir)
 
 @pytest.fixture
 def client(app):
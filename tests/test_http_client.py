@@ -0,0 +1,70 @@
+# tests/test_http_client.py
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from urllib3.exceptions import ConnectTimeoutError, ReadTimeoutError, MaxRetryError
+
+from app import http_client
+
+@pytest.fixture
+def server(app):
+    """Локальный сервер, который на всё отвечает 503 и считает запросы."""
+    app.config['HTTP_RETRY_BACKOFF'] = 0
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self):
+            hits.append(self.command)
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        do_GET = do_POST = _reply
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}", hits
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_session_per_host(app):
+    """Одна сессия на хост (и набор повторов); после fork сессии создаются заново."""
+    first = http_client.session_for('https://api.telegram.org/bot1/sendMessage')
+    assert http_client.session_for('https://api.telegram.org/bot2/sendPhoto') is first
+    assert http_client.session_for('https://api.vk.com/method/wall.post') is not first
+    assert http_client.session_for('https://api.telegram.org/x', retries=0) is not first
+
+    http_client._owner_pid = -1  # как будто мы в дочернем процессе
+    assert http_client.session_for('https://api.telegram.org/bot1/sendMessage') is not first
+
+def test_get_retried_on_5xx_post_not(server):
+    """5xx повторяются для GET; POST уходит один раз (иначе дубли постов)."""
+    url, hits = server
+    assert http_client.get(url, retries=2).status_code == 503
+    assert hits == ['GET'] * 3
+
+    hits.clear()
+    assert http_client.post(url, data=b'x', retries=2).status_code == 503
+    assert hits == ['POST']
+
+    hits.clear()
+    http_client.get(url, retries=0)
+    assert hits == ['GET']
+
+def test_retry_policy_errors(app):
+    """Ошибка соединения повторяется для любого метода, ошибка чтения — только для идемпотентных."""
+    retry = http_client._make_retry(2)
+    connect_error = ConnectTimeoutError(None, 'connect timed out')
+    read_error = ReadTimeoutError(None, '/', 'read timed out')
+
+    assert retry.increment('POST', '/', error=connect_error).total == 1
+    assert retry.increment('GET', '/', error=read_error).total == 1
+    with pytest.raises(ReadTimeoutError):
+        retry.increment('POST', '/', error=read_error)
+
+    with pytest.raises(MaxRetryError):
+        http_client._make_retry(0).increment('GET', '/', error=connect_error)
@@ -0,0 +1,48 @@
+# tests/test_leader.py
+from datetime import datetime, timedelta
+from app import db
+from app.models import SchedulerLock
+from app.leader import acquire_lock, release_lock
+
+def test_single_leader(app):
+    """Аренду держит только один процесс, пока она не истекла."""
+    assert acquire_lock('scheduler', 'host-a:1', 60) is True
+    assert acquire_lock('scheduler', 'host-b:2', 60) is False
+    # Лидер продлевает свою аренду
+    assert acquire_lock('scheduler', 'host-a:1', 60) is True
+
+def test_expired_lease_taken_over(app):
+    """Аренду умершего лидера забирает другой процесс."""
+    db.session.add(SchedulerLock(name='scheduler', holder='dead:1',
+                                 expires_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+
+    assert acquire_lock('scheduler', 'host-b:2', 60) is True
+    assert acquire_lock('scheduler', 'dead:1', 60) is False
+
+def test_release(app):
+    assert acquire_lock('scheduler', 'host-a:1', 60) is True
+    release_lock('scheduler', 'host-a:1')
+    assert acquire_lock('scheduler', 'host-b:2', 60) is True
+
+def test_task_context_reuses_app(app, monkeypatch):
+    """Фоновые задачи работают в одном общем приложении, а не создают новое на каждый вызов."""
+    import threading
+    import app as app_module
+    from flask import current_app
+    def fail(*args, **kwargs):
+        raise AssertionError('create_app() на каждую задачу')
+    monkeypatch.setattr(app_module, 'create_app', fail)
+
+    apps = []
+    def task():
+        # Поток планировщика: своего app_context нет
+        for _ in range(3):
+            with app_module.task_context():
+                apps.append(current_app._get_current_object())
+    thread = threading.Thread(target=task)
+    thread.start()
+    thread.join()
+
+    assert apps == [app] * 3
+    assert app_module.get_task_app() is app
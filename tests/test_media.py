@@ -0,0 +1,322 @@
+# tests/test_media.py
+import io
+import os
+import hashlib
+import pytest
+from app import db
+from app.models import MediaFile
+from app.media import store_stream, acquire_media, release_media, unlink_media, media_path, iter_media_entries
+
+def test_store_deduplicates(app):
+    """Одинаковое содержимое хранится одним файлом с именем по хешу."""
+    data = b'logo' * 1000
+    first = store_stream(io.BytesIO(data), 'logo.PNG')
+    second = store_stream(io.BytesIO(data), 'copy.png')
+
+    assert first == second == hashlib.sha256(data).hexdigest() + '.png'
+    files = [e.name for e in iter_media_entries() if not e.name.startswith('.')]
+    assert files == [first]
+    assert os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], first[:2], first[2:4], first))
+    assert MediaFile.query.filter_by(filename=first).one().size == len(data)
+
+def test_file_removed_with_last_reference(app):
+    """Файл удаляется с диска только вместе с последней ссылкой."""
+    name = store_stream(io.BytesIO(b'picture'), 'a.jpg')
+    path = media_path(name)
+
+    acquire_media([name])
+    acquire_media([name])
+    db.session.commit()
+
+    assert release_media([name]) == []
+    db.session.commit()
+    assert os.path.exists(path)
+
+    orphaned = release_media([name])
+    db.session.commit()
+    unlink_media(orphaned)
+    assert orphaned == [name]
+    assert not os.path.exists(path)
+    assert MediaFile.query.filter_by(filename=name).first() is None
+
+class _Resp:
+    def __init__(self, ok, payload):
+        self.ok = ok
+        self._payload = payload
+    def json(self):
+        return self._payload
+
+def test_tg_upload_cache(app, monkeypatch):
+    """Повторная отправка того же файла идет по file_id; отклоненный file_id загружается заново."""
+    from app import services
+    app.config['MEDIA_UPLOAD_CACHE_ENABLED'] = True
+    app.config['MEDIA_UPLOAD_CACHE_TTL'] = {'tg': 3600}
+
+    name = store_stream(io.BytesIO(b'photo'), 'a.jpg')
+    path = media_path(name)
+    calls = []
+
+    def fake_post(token, chat_id, method, files=None, data=None, **kwargs):
+        calls.append({'files': bool(files), 'photo': (data or {}).get('photo')})
+        if (data or {}).get('photo') == 'stale':
+            return _Resp(False, {'description': 'Bad Request: wrong file identifier'})
+        return _Resp(True, {'result': {'message_id': len(calls), 'photo': [{'file_id': 'fid-1'}]}})
+    monkeypatch.setattr(services, '_tg_post', fake_post)
+
+    services.tg_send_service('1:x', '@c', 'text', [path], None)
+    services.tg_send_service('1:x', '@c', 'text', [path], None)
+    assert calls == [{'files': True, 'photo': None}, {'files': False, 'photo': 'fid-1'}]
+
+    # file_id устарел: запись забывается, файл отправляется заново
+    from app.models import MediaUploadCache
+    MediaUploadCache.query.update({'remote_id': 'stale'})
+    db.session.commit()
+    calls.clear()
+    msg_id, err = services.tg_send_service('1:x', '@c', 'text', [path], None)
+    assert err is None
+    assert calls == [{'files': False, 'photo': 'stale'}, {'files': True, 'photo': None}]
+    assert MediaUploadCache.query.one().remote_id == 'fid-1'
+
+def test_platform_variants(app):
+    """Большая webp-картинка пережимается в JPEG по лимитам платформы, подходящая остается как есть."""
+    pytest.importorskip('PIL')
+    from PIL import Image
+    from config import Config
+    from app.media_processing import platform_media
+    app.config['MEDIA_PREPROCESS_ENABLED'] = True
+    app.config['MEDIA_VARIANT_PROFILES'] = Config.MEDIA_VARIANT_PROFILES
+
+    big = io.BytesIO()
+    Image.new('RGBA', (3000, 1000), (255, 0, 0, 128)).save(big, 'WEBP')
+    big_path = media_path(store_stream(io.BytesIO(big.getvalue()), 'big.webp'))
+    small = io.BytesIO()
+    Image.new('RGB', (800, 600)).save(small, 'PNG')
+    small_path = media_path(store_stream(io.BytesIO(small.getvalue()), 'small.png'))
+
+    vk_big, vk_small = platform_media([big_path, small_path], 'vk')
+    assert vk_small == small_path
+    assert vk_big.endswith('.vk.jpg')
+    with Image.open(vk_big) as img:
+        assert img.format == 'JPEG' and img.size == (2560, 853)
+        # Полупрозрачный красный ложится на белый фон
+        r, g, b = img.getpixel((0, 0))
+        assert r > 240 and 110 < g < 145 and 110 < b < 145
+    with Image.open(platform_media([big_path], 'ig')[0]) as img:
+        assert max(img.size) == 1440
+
+    # Варианты удаляются вместе с оригиналом
+    acquire_media([os.path.basename(big_path)])
+    orphaned = release_media([os.path.basename(big_path)])
+    db.session.commit()
+    unlink_media(orphaned)
+    assert not os.path.exists(vk_big)
+
+def test_variant_shrinks_to_max_bytes(app):
+    """Если на минимальном качестве файл больше лимита, уменьшается сторона; не вышло — остается оригинал."""
+    pytest.importorskip('PIL')
+    from PIL import Image
+    from app.media_processing import build_variant
+    folder = app.config['UPLOAD_FOLDER']
+    Image.frombytes('RGB', (1500, 1500), os.urandom(1500 * 1500 * 3)).save(os.path.join(folder, 'noise.png'))
+    profile = {'max_side': 1500, 'max_bytes': 200 * 1024, 'formats': ('.jpg',)}
+
+    name = build_variant(folder, 'noise.png', 'vk', profile)
+    assert os.path.getsize(os.path.join(folder, name)) <= profile['max_bytes']
+    with Image.open(os.path.join(folder, name)) as img:
+        assert max(img.size) < 1500
+
+    assert build_variant(folder, 'noise.png', 'ig', dict(profile, max_bytes=1024)) is None
+    assert not [f for f in os.listdir(folder) if f.startswith('.tmp-')]
+
+def test_chunked_upload_resume(app, auth_client):
+    """Части принимаются в любом порядке, недостающие видны в статусе, пост ссылается на upload_id."""
+    from app.models import Post
+    client, user = auth_client
+    app.config['MEDIA_CHUNK_SIZE'] = 4
+    data = b'0123456789'
+
+    info = client.post('/uploads', json={'filename': 'clip.MP4', 'size': len(data)}).get_json()
+    upload_id = info['upload_id']
+    assert info['total_chunks'] == 3
+
+    assert client.put(f'/uploads/{upload_id}/chunks/2', data=data[8:]).status_code == 200
+    assert client.put(f'/uploads/{upload_id}/chunks/0', data=data[:4]).status_code == 200
+    # Обрыв: часть пришла не целиком и не засчитана
+    assert client.put(f'/uploads/{upload_id}/chunks/1', data=data[4:6]).status_code == 400
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 400
+    assert client.get(f'/uploads/{upload_id}').get_json()['received'] == [0, 2]
+
+    client.put(f'/uploads/{upload_id}/chunks/1', data=data[4:8])
+    filename = client.post(f'/uploads/{upload_id}/complete').get_json()['filename']
+    assert filename == hashlib.sha256(data).hexdigest() + '.mp4'
+    with open(media_path(filename), 'rb') as f:
+        assert f.read() == data
+
+    resp = client.post('/', data={'text_html': '<p>Видео</p>', 'upload_id': upload_id})
+    assert resp.get_json()['status'] == 'ok'
+    assert Post.query.get(resp.get_json()['post_id']).media_files == [filename]
+    assert MediaFile.query.filter_by(filename=filename).one().ref_count == 1
+    assert client.get(f'/uploads/{upload_id}').status_code == 404
+
+def test_garbage_collector(app):
+    """GC удаляет старые файлы без ссылок и оставляет файлы постов (в т.ч. старых, без индекса)."""
+    from app.models import Post, User, PostMedia
+    from app.media import collect_media_garbage
+    folder = app.config['UPLOAD_FOLDER']
+    user = User(email='gc@example.com')
+    user.set_password('x')
+    db.session.add(user)
+    db.session.commit()
+
+    kept = store_stream(io.BytesIO(b'kept'), 'kept.jpg')
+    post = Post(user_id=user.id, text='t', media_files=[kept])
+    db.session.add(post)
+    acquire_media([kept], post)
+    # Пост, созданный до появления индекса post_media
+    legacy = 'legacy-uuid.jpg'
+    open(os.path.join(folder, legacy), 'wb').write(b'legacy')
+    db.session.add(Post(user_id=user.id, text='t', media_files=[legacy]))
+    db.session.commit()
+
+    orphan = store_stream(io.BytesIO(b'orphan' * 100), 'rss.jpg')
+    fresh = store_stream(io.BytesIO(b'fresh'), 'fresh.jpg')
+    stale_variant = 'f' * 64 + '.vk.jpg'
+    for name in (stale_variant, '.tmp-abc'):
+        open(os.path.join(folder, name), 'wb').write(b'x')
+    old = 0
+    for entry in iter_media_entries():
+        if entry.name != fresh:
+            os.utime(entry.path, (old, old))
+
+    report = collect_media_garbage()
+
+    assert sorted(e.name for e in iter_media_entries()) == sorted([kept, legacy, fresh])
+    assert report['removed'] == 3
+    assert report['reclaimed_bytes'] == 600 + 1 + 1
+    assert report['indexed_posts'] == 1
+    assert PostMedia.query.filter_by(filename=legacy).count() == 1
+    assert report['backfilled'] == 1
+    assert MediaFile.query.filter_by(filename=legacy).one().ref_count == 1
+    assert MediaFile.query.filter_by(filename=orphan).first() is None
+    assert MediaFile.query.filter_by(filename=kept).one().ref_count == 1
+
+def test_shard_command(app, runner):
+    """flask media-shard переносит старые файлы из корня в ab/cd/, пути продолжают работать."""
+    folder = app.config['UPLOAD_FOLDER']
+    legacy = 'ab12cd34.jpg'
+    open(os.path.join(folder, legacy), 'wb').write(b'legacy')
+    assert media_path(legacy) == os.path.join(folder, legacy)
+
+    result = runner.invoke(args=['media-shard'])
+    assert 'Перенесено файлов: 1' in result.output
+    assert media_path(legacy) == os.path.join(folder, 'ab', '12', legacy)
+    assert os.path.exists(media_path(legacy))
+
+def test_media_usage_and_quota(app, auth_client):
+    """Объем файлов считается по проектам и в целом; лимит тарифа max_files_size_mb соблюдается."""
+    from app.models import MediaUsage
+    from app.media import recount_usage, release_posts_media
+    client, user = auth_client
+    project_id = user.current_project_id
+
+    name = store_stream(io.BytesIO(b'x' * 1000), 'a.jpg', project_id)
+    store_stream(io.BytesIO(b'x' * 1000), 'copy.jpg', project_id)  # дубль не считается
+    assert MediaFile.query.filter_by(filename=name).one().project_id == project_id
+    assert (MediaUsage.query.get(project_id).files_count, MediaUsage.query.get(project_id).total_bytes) == (1, 1000)
+    assert MediaUsage.query.get(0).total_bytes == 1000
+
+    # Тот же файл в посте другого проекта засчитывается и ему; на диске он один
+    from app.models import Post, Project
+    other = Project(user_id=user.id, name='Other')
+    db.session.add(other)
+    db.session.commit()
+    posts = [Post(user_id=user.id, project_id=pid, text='t', media_files=[name, name])
+             for pid in (project_id, other.id, other.id)]
+    for post in posts:
+        db.session.add(post)
+        acquire_media(post.media_files, post)
+    db.session.commit()
+    usage = lambda pid: (MediaUsage.query.get(pid).files_count, MediaUsage.query.get(pid).total_bytes)
+    assert usage(project_id) == usage(other.id) == (1, 1000)
+    assert usage(0) == (1, 1000)
+
+    release_media(posts[1].media_files, posts[1])
+    db.session.delete(posts[1])
+    db.session.commit()
+    assert usage(other.id) == (1, 1000)  # файл остался в другом посте проекта
+    recount_usage()
+    assert usage(project_id) == usage(other.id) == usage(0) == (1, 1000)
+
+    orphaned = release_posts_media(Post.query)
+    Post.query.delete()
+    db.session.commit()
+    unlink_media(orphaned)
+    assert usage(project_id) == usage(other.id) == usage(0) == (0, 0)
+    recount_usage()
+    assert usage(project_id) == usage(other.id) == usage(0) == (0, 0)
+
+    user.tariff_rel.options = {'max_files_size_mb': 1}
+    db.session.commit()
+    resp = client.post('/uploads', json={'filename': 'big.mp4', 'size': 2 * 1024 * 1024})
+    assert resp.status_code == 403
+    assert client.post('/uploads', json={'filename': 'ok.mp4', 'size': 1024}).status_code == 201
+    # Файлы формы проверяются по своему размеру
+    form = lambda size: {'text_html': '<p>x</p>', 'media': (io.BytesIO(b'x' * size), 'a.jpg')}
+    assert client.post('/', data=form(100), content_type='multipart/form-data').status_code == 200
+    assert client.post('/', data=form(2 * 1024 * 1024), content_type='multipart/form-data').status_code == 403
+
+def test_vk_parallel_upload_keeps_order(app):
+    """Фото и видео VK загружаются параллельно, фото сохраняются одним execute, порядок вложений сохраняется."""
+    import time
+    from types import SimpleNamespace
+    from app import services
+    folder = app.config['UPLOAD_FOLDER']
+    paths = []
+    for name in ('1.jpg', '2.mp4', '3.png'):
+        paths.append(os.path.join(folder, name))
+        open(paths[-1], 'wb').write(name.encode())
+
+    class Http:
+        def post(self, url, files):
+            name = files['photo'][0]
+            time.sleep(0.05 if name == '1.jpg' else 0)  # первое фото загружается дольше
+            return _Resp(True, {'server': 1, 'photo': name, 'hash': 'h'})
+
+    executes = []
+    def execute(code):
+        executes.append(code)
+        return [[{'owner_id': -5, 'id': i}] for i in range(code.count('saveWallPhoto'))]
+
+    vk = SimpleNamespace(photos=SimpleNamespace(getWallUploadServer=lambda group_id: {'upload_url': 'u'}),
+                         execute=execute)
+    vk_upload = SimpleNamespace(vk=vk, http=Http(),
+                                video=lambda **kw: {'owner_id': -5, 'video_id': 77})
+
+    attach, cached = services._vk_upload_attachments(vk_upload, 5, paths, 'text', project_id=1)
+    assert attach == ['photo-5_0', 'video-5_77', 'photo-5_1']
+    assert cached == [] and len(executes) == 1
+    assert executes[0].index('1.jpg') < executes[0].index('3.png')
+
+def test_multipart_stream(app):
+    """Потоковое тело multipart: длина известна заранее, файл читается кусками и закрывается после отправки."""
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.formparser import parse_form_data
+    from app.multipart import MultipartStream
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'clip.mp4')
+    open(path, 'wb').write(os.urandom(200 * 1024))
+
+    body = MultipartStream({'chat_id': '@c', 'caption': 'Привет'}, {'video': path})
+    chunks = iter(lambda: body.read(8192), b'')
+    raw = b''.join(chunks)
+    assert len(raw) == len(body)
+    assert body._file is None
+    body.seek(0)
+    assert body.read() == raw
+
+    environ = EnvironBuilder(method='POST', input_stream=io.BytesIO(raw),
+                             headers={'Content-Type': body.content_type,
+                                      'Content-Length': str(len(raw))}).get_environ()
+    _, form, files = parse_form_data(environ)
+    assert form['caption'] == 'Привет'
+    assert files['video'].filename == 'clip.mp4'
+    assert files['video'].read() == open(path, 'rb').read()
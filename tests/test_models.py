@@ -28,4 +28,25 @@ def test_tariff_limits(client, auth_client):
     db.session.commit()
     
     allowed, msg = user.can_create_project()
-    assert allowed is True # Теперь можно
\ No newline at end of file
+    assert allowed is True # Теперь можно
+
+def test_upgrade_schema_adds_missing_columns(app):
+    """В таблицу, созданную старой версией (без новых колонок), колонки добавляются при старте."""
+    from sqlalchemy import inspect, text
+    from app.models import Post
+    from app.schema import COLUMNS, INDEXES, upgrade_schema
+    with db.engine.begin() as conn:
+        for table, index in INDEXES:
+            conn.execute(text(f"DROP INDEX {index}"))
+        for table, column in COLUMNS:
+            for index in db.metadata.tables[table].indexes:
+                if column in index.columns:
+                    conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+
+    added = upgrade_schema()
+    assert {f"{t}.{c}" for t, c in COLUMNS} | {i for t, i in INDEXES} <= set(added)
+    for table, column in COLUMNS:
+        assert column in {c['name'] for c in inspect(db.engine).get_columns(table)}
+    assert Post.query.count() == 0
+    assert upgrade_schema() == []
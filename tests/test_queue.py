@@ -0,0 +1,230 @@
+# tests/test_queue.py
+from datetime import datetime, timedelta
+from app import db
+from app.models import Post
+from app import services_queue
+from app.services_queue import claim_due_posts, claim_posts, expire_missed_posts, dispatch_batch
+
+def _make_post(user, **kwargs):
+    params = dict(user_id=user.id, project_id=user.current_project_id,
+                  text='Тест', status='scheduled', publish_to_tg=True)
+    params.update(kwargs)
+    post = Post(**params)
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+def test_claim_only_due_posts(app, auth_client):
+    """Забираются только посты с наступившим временем, и только один раз."""
+    client, user = auth_client
+
+    due = _make_post(user, scheduled_at=datetime.utcnow() - timedelta(minutes=1))
+    now_post = _make_post(user, scheduled_at=None)
+    future = _make_post(user, scheduled_at=datetime.utcnow() + timedelta(hours=1))
+
+    claimed = claim_due_posts('worker-1', limit=10, lease_seconds=60)
+    assert set(claimed) == {due.id, now_post.id}
+
+    db.session.refresh(due)
+    assert due.status == 'publishing'
+    assert due.locked_by == 'worker-1'
+    assert due.locked_until > datetime.utcnow()
+
+    # Повторно те же посты не выдаются
+    assert claim_due_posts('worker-2', limit=10, lease_seconds=60) == []
+
+    db.session.refresh(future)
+    assert future.status == 'scheduled'
+
+def test_claim_stale_lease(app, auth_client):
+    """Пост упавшего воркера забирается после истечения аренды."""
+    client, user = auth_client
+
+    post = _make_post(user, status='publishing', locked_by='dead-worker',
+                      locked_until=datetime.utcnow() - timedelta(seconds=1))
+
+    assert claim_due_posts('worker-2', limit=10, lease_seconds=60) == [post.id]
+    db.session.refresh(post)
+    assert post.locked_by == 'worker-2'
+
+def test_claim_race(app, auth_client):
+    """Два воркера прочитали одни и те же посты: каждый пост достается только одному."""
+    client, user = auth_client
+    post = _make_post(user, scheduled_at=None)
+    stale = _make_post(user, status='publishing', locked_by='dead-worker',
+                       locked_until=datetime.utcnow() - timedelta(seconds=1))
+    seen = [post.id, stale.id]  # оба воркера выбрали эти строки до захвата
+
+    assert claim_posts(seen, 'worker-1', lease_seconds=60) == [post.id, stale.id]
+    assert claim_posts(seen, 'worker-2', lease_seconds=60) == []
+    db.session.refresh(post)
+    assert post.locked_by == 'worker-1'
+
+def test_expire_missed_posts(app, auth_client):
+    """Посты, просроченные сильнее окна, не публикуются, а помечаются failed."""
+    client, user = auth_client
+    app.config['SCHEDULER_MISFIRE_GRACE_SECONDS'] = 3600
+
+    old = _make_post(user, scheduled_at=datetime.utcnow() - timedelta(days=1))
+    recent = _make_post(user, scheduled_at=datetime.utcnow() - timedelta(minutes=5))
+
+    assert expire_missed_posts() == 1
+    db.session.refresh(old)
+    db.session.refresh(recent)
+    assert old.status == 'failed'
+    assert recent.status == 'scheduled'
+
+def test_dispatch_batch(app, auth_client, monkeypatch):
+    """Диспетчер забирает пачку и публикует каждый пост."""
+    client, user = auth_client
+    published = []
+    monkeypatch.setattr(services_queue, 'publish_claimed_post', lambda pid: published.append(pid))
+
+    post_ids = [_make_post(user, scheduled_at=None).id for _ in range(3)]
+
+    assert dispatch_batch('dispatcher', batch_size=2, lease_seconds=60) == 2
+    assert dispatch_batch('dispatcher', batch_size=2, lease_seconds=60) == 1
+    assert dispatch_batch('dispatcher', batch_size=2, lease_seconds=60) == 0
+    assert sorted(published) == sorted(post_ids)
+
+def test_publish_pool_no_head_of_line_blocking(app, auth_client, monkeypatch):
+    """Медленный пост занимает один слот пула: остальные посты публикуются, не дожидаясь его."""
+    import threading
+    client, user = auth_client
+    slow_id = _make_post(user, scheduled_at=None).id
+    fast_ids = [_make_post(user, scheduled_at=None).id for _ in range(3)]
+
+    release = threading.Event()
+    published = []
+    def fake_publish(pid):
+        if pid == slow_id:
+            release.wait(5)
+        published.append(pid)
+    monkeypatch.setattr(services_queue, 'publish_claimed_post', fake_publish)
+
+    pool = services_queue.PublishPool(app, 'dispatcher', concurrency=2, lease_seconds=60)
+    assert pool.fill() == 2
+    assert pool.fill() == 0
+    for _ in range(100):
+        if sorted(published) == sorted(fast_ids):
+            break
+        threading.Event().wait(0.05)
+    assert sorted(published) == sorted(fast_ids)
+
+    release.set()
+    pool.shutdown()
+    assert published[-1] == slow_id and pool.active == 0
+
+def test_prestage_media(app, auth_client, monkeypatch):
+    """Медиа поста загружаются в чат-кеш заранее; в момент публикации файлы уже не отправляются."""
+    import io
+    from app import services
+    from app.models import SocialTokens, TgChannel
+    from app.media import store_stream
+    client, user = auth_client
+    app.config['MEDIA_UPLOAD_CACHE_ENABLED'] = True
+    app.config['MEDIA_UPLOAD_CACHE_TTL'] = {'tg': 3600}
+    app.config['MEDIA_PRESTAGE_MINUTES'] = 30
+
+    tokens = SocialTokens(project_id=user.current_project_id, tg_cache_chat_id='-100cache')
+    tokens.tg_token = '1:x'
+    channel = TgChannel(user_id=user.id, project_id=user.current_project_id, name='c', chat_id='@c')
+    db.session.add_all([tokens, channel])
+    db.session.commit()
+
+    name = store_stream(io.BytesIO(b'video'), 'clip.mp4')
+    soon = _make_post(user, tg_channel_id=channel.id, media_files=[name],
+                      scheduled_at=datetime.utcnow() + timedelta(minutes=10))
+    later = _make_post(user, tg_channel_id=channel.id, media_files=[name],
+                       scheduled_at=datetime.utcnow() + timedelta(hours=2))
+
+    calls = []
+    def fake_post(token, chat_id, method, files=None, data=None, **kwargs):
+        calls.append((chat_id, bool(files)))
+        return type('Resp', (), {'ok': True, 'json': lambda self: {
+            'result': {'message_id': 1, 'video': {'file_id': 'fid'}}}})()
+    monkeypatch.setattr(services, '_tg_post', fake_post)
+
+    assert services.prestage_media() == 1
+    assert calls == [('-100cache', True)]
+    db.session.refresh(soon)
+    db.session.refresh(later)
+    assert soon.media_staged_at is not None and later.media_staged_at is None
+    assert services.prestage_media() == 0
+
+    calls.clear()
+    Post.query.filter_by(id=soon.id).update({'status': 'publishing'})
+    db.session.commit()
+    services.publish_claimed_post(soon.id)
+    assert calls == [('@c', False)]
+
+def test_delete_forgets_staged_media(app, auth_client):
+    """Удаление подготовленного заранее поста убирает его ID из кеша загрузок."""
+    import io
+    from app import ratelimit
+    from app.models import SocialTokens, TgChannel
+    from app.media import store_stream, media_path, cached_upload, remember_upload
+    client, user = auth_client
+    app.config['MEDIA_UPLOAD_CACHE_ENABLED'] = True
+    app.config['MEDIA_UPLOAD_CACHE_TTL'] = {'tg': 3600}
+
+    tokens = SocialTokens(project_id=user.current_project_id)
+    tokens.tg_token = '1:x'
+    channel = TgChannel(user_id=user.id, project_id=user.current_project_id, name='c', chat_id='@c')
+    db.session.add_all([tokens, channel])
+    db.session.commit()
+
+    name = store_stream(io.BytesIO(b'video'), 'clip.mp4')
+    post = _make_post(user, tg_channel_id=channel.id, media_files=[name], media_staged_at=datetime.utcnow(),
+                      scheduled_at=datetime.utcnow() + timedelta(minutes=10))
+    bot_key = ratelimit.tg_bot_key('1:x')
+    remember_upload(media_path(name), 'tg', bot_key, 'fid')
+    assert cached_upload(media_path(name), 'tg', bot_key) == 'fid'
+
+    client.post(f'/delete/{post.id}')
+    assert db.session.get(Post, post.id) is None
+    assert cached_upload(media_path(name), 'tg', bot_key) is None
+
+def test_direct_vk_send_not_claimed(app, auth_client, monkeypatch):
+    """Пока routes_main отправляет пост в VK напрямую, очередь его не забирает; затем TG публикует очередь."""
+    from app import routes_main
+    from app.models import SocialTokens, VkGroup
+    client, user = auth_client
+    db.session.add(SocialTokens(project_id=user.current_project_id))
+    group = VkGroup(user_id=user.id, project_id=user.current_project_id, name='vk', group_id=5)
+    db.session.add(group)
+    db.session.commit()
+
+    claimed_during_send = []
+    def fake_vk(*args, **kwargs):
+        claimed_during_send.extend(claim_due_posts('dispatcher', limit=10, lease_seconds=60))
+        return 99, None
+    monkeypatch.setattr(routes_main, 'vk_send_service', fake_vk)
+
+    resp = client.post('/', data={'text_html': '<p>Пост</p>', 'publish_vk': '1', 'channel_vk': group.id,
+                                  'publish_tg': '1'})
+    post = db.session.get(Post, resp.get_json()['post_id'])
+    assert claimed_during_send == []
+    assert post.status == 'scheduled' and post.locked_by is None
+    assert post.platform_info["vk_post_id"] == 99, (post.platform_info, post.error_message)
+    assert claim_due_posts('dispatcher', limit=10, lease_seconds=60) == [post.id]
+
+def test_direct_vk_send_rate_limited_goes_to_queue(app, auth_client, monkeypatch):
+    """Если слот VK не освобождается быстро, веб-запрос не ждет: пост только в VK досылает очередь."""
+    from app import routes_main
+    from app.models import SocialTokens, VkGroup
+    from app.ratelimit import RateLimitError
+    client, user = auth_client
+    db.session.add(SocialTokens(project_id=user.current_project_id))
+    group = VkGroup(user_id=user.id, project_id=user.current_project_id, name='vk', group_id=5)
+    db.session.add(group)
+    db.session.commit()
+
+    def fake_vk(*args, **kwargs):
+        raise RateLimitError('Превышен лимит отправки (vk_group), ожидание 60 сек.')
+    monkeypatch.setattr(routes_main, 'vk_send_service', fake_vk)
+
+    resp = client.post('/', data={'text_html': '<p>Пост</p>', 'publish_vk': '1', 'channel_vk': group.id})
+    post = db.session.get(Post, resp.get_json()['post_id'])
+    assert post.status == 'scheduled' and post.publish_via_queue and post.error_message is None
+    assert claim_due_posts('dispatcher', limit=10, lease_seconds=60) == [post.id]
@@ -0,0 +1,73 @@
+# tests/test_ratelimit.py
+import pytest
+from types import SimpleNamespace
+from app import db, ratelimit
+from app.models import RateLimitBucket
+
+@pytest.fixture
+def limits(app, monkeypatch):
+    """
+    Включаем ограничитель и не спим по-настоящему, а записываем ожидания.
+    Часы стоят (ожидания не зависят от скорости записи в БД) и идут только во "сне".
+    """
+    app.config['RATE_LIMIT_ENABLED'] = True
+    app.config['RATE_LIMITS'] = {'test': (1, 2)}
+    app.config['RATE_LIMIT_MAX_WAIT_SECONDS'] = 30
+
+    sleeps = []
+    clock = [1_000_000.0]
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+    monkeypatch.setattr(ratelimit, 'time', SimpleNamespace(time=lambda: clock[0], sleep=sleep))
+    return sleeps
+
+def test_burst_then_wait(limits):
+    """Первые `burst` отправок идут сразу, следующая ждет пополнения."""
+    ratelimit.acquire('test', 'chat')
+    ratelimit.acquire('test', 'chat')
+    assert limits == []
+
+    ratelimit.acquire('test', 'chat')
+    assert len(limits) == 1
+    assert 0.9 < limits[0] <= 1.0
+
+    # Другой ключ — отдельный бакет
+    ratelimit.acquire('test', 'other')
+    assert len(limits) == 1
+
+def test_penalize_delays_send(limits):
+    """После 429 отправка откладывается на retry_after, а не падает."""
+    ratelimit.penalize('test', 'chat', 10)
+    ratelimit.acquire('test', 'chat')
+    assert 10 < limits[0] <= 11
+
+def test_wait_over_limit_raises(limits):
+    """Слишком долгое ожидание — ошибка, слот при этом не резервируется."""
+    ratelimit.penalize('test', 'chat', 100)
+    with pytest.raises(ratelimit.RateLimitError):
+        ratelimit.acquire('test', 'chat')
+
+    bucket = db.session.get(RateLimitBucket, 'test:chat')
+    assert bucket.tokens == 0
+
+def test_web_request_waits_briefly(app, limits):
+    """В веб-запросе долго не ждем: ошибка сразу, отправку доделает очередь."""
+    app.config['RATE_LIMIT_WEB_MAX_WAIT_SECONDS'] = 2
+    ratelimit.penalize('test', 'chat', 10)
+    with app.test_request_context('/'):
+        with pytest.raises(ratelimit.RateLimitError):
+            ratelimit.acquire('test', 'chat')
+    assert limits == []
+
+    ratelimit.acquire('test', 'chat')
+    assert 10 < limits[0] <= 11
+
+def test_db_failure_fails_closed(limits, monkeypatch, caplog):
+    """Без бакета отправка не идет мимо лимита: ошибка и предупреждение в логе."""
+    def broken(*args):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(ratelimit, '_reserve', broken)
+    with pytest.raises(ratelimit.RateLimitError):
+        ratelimit.acquire('test', 'chat')
+    assert 'test:chat' in caplog.text and 'database is locked' in caplog.text
@@ -0,0 +1,135 @@
+# tests/test_retry.py
+from datetime import datetime
+from app import db
+from app import services
+from app.models import Post, SocialTokens, TgChannel, MaxChat
+from app.services import publish_claimed_post
+from app.services_queue import retry_failed_posts, claim_due_posts
+
+def _make_post(user):
+    """Пост в TG и MAX проекта пользователя (токены и чаты создаются тут же)."""
+    tokens = SocialTokens(project_id=user.current_project_id)
+    tokens.tg_token = '123:abc'
+    tokens.max_token = 'max'
+    channel = TgChannel(user_id=user.id, project_id=user.current_project_id, name='TG', chat_id='@test')
+    chat = MaxChat(project_id=user.current_project_id, name='MAX', chat_id='42')
+    db.session.add_all([tokens, channel, chat])
+    db.session.commit()
+
+    post = Post(user_id=user.id, project_id=user.current_project_id, text='Тест', text_vk='Тест',
+                status='publishing', publish_to_tg=True, tg_channel_id=channel.id,
+                publish_to_max=True, max_chat_id=chat.id, platform_info={'buttons': []})
+    db.session.add(post)
+    db.session.commit()
+    return post.id
+
+def test_retry_only_failed_platform(app, auth_client, monkeypatch):
+    """После частичной ошибки повторяется только платформа с ошибкой."""
+    client, user = auth_client
+    app.config['PUBLISH_MAX_RETRIES'] = 3
+    post_id = _make_post(user)
+
+    calls = {'tg': 0, 'max': 0}
+    def fake_tg(token, chat_id, text, media_paths, buttons_json):
+        calls['tg'] += 1
+        return (None, 'Timeout') if calls['tg'] == 1 else (777, None)
+    def fake_max(tokens, chat_id, text):
+        calls['max'] += 1
+        return 'ok', None
+    monkeypatch.setattr(services, 'tg_send_service', fake_tg)
+    monkeypatch.setattr(services, 'max_send_service', fake_max)
+
+    publish_claimed_post(post_id)
+    post = db.session.get(Post, post_id)
+    assert post.status == 'retrying'
+    assert post.retry_count == 1
+    assert post.next_retry_at > datetime.utcnow()
+    assert post.platform_info.get('max_sent')
+
+    publish_claimed_post(post_id)
+    post = db.session.get(Post, post_id)
+    assert post.status == 'published'
+    assert post.platform_info['tg_msg_id'] == 777
+    assert calls == {'tg': 2, 'max': 1}
+
+def test_retries_exhausted_partial(app, auth_client, monkeypatch):
+    """Когда попытки кончились, пост с частичным успехом получает статус partial."""
+    client, user = auth_client
+    app.config['PUBLISH_MAX_RETRIES'] = 0
+    post_id = _make_post(user)
+
+    monkeypatch.setattr(services, 'tg_send_service', lambda *a: (None, 'Timeout'))
+    monkeypatch.setattr(services, 'max_send_service', lambda *a: ('ok', None))
+
+    publish_claimed_post(post_id)
+    assert db.session.get(Post, post_id).status == 'partial'
+
+    # Массовый повтор ставит пост в очередь заново
+    assert retry_failed_posts(user.current_project_id) == 1
+    assert claim_due_posts('worker-1', limit=10, lease_seconds=60) == [post_id]
+
+def test_lease_extended_and_ownership_checked(app, auth_client, monkeypatch):
+    """Аренда продлевается во время отправки; если пост забрал другой воркер, результат не сохраняется."""
+    import time
+    client, user = auth_client
+    app.config['PUBLISH_LEASE_SECONDS'] = 0.3
+    post_id = _make_post(user)
+    Post.query.filter_by(id=post_id).update({'locked_by': 'worker-1', 'locked_until': datetime.utcnow()})
+    db.session.commit()
+
+    leases = []
+    def slow_tg(token, chat_id, text, media_paths, buttons_json):
+        time.sleep(0.25)
+        leases.append(db.session.query(Post.locked_until).filter_by(id=post_id).scalar())
+        return 1, None
+    monkeypatch.setattr(services, 'tg_send_service', slow_tg)
+    monkeypatch.setattr(services, 'max_send_service', lambda tokens, chat_id, text: ('ok', None))
+
+    publish_claimed_post(post_id)
+    assert leases[0] > datetime.utcnow()
+    assert db.session.get(Post, post_id).status == 'published'
+
+    # Аренду забрал worker-2: результат worker-1 отбрасывается
+    Post.query.filter_by(id=post_id).update({'status': 'publishing', 'locked_by': 'worker-1', 'platform_info': {}})
+    db.session.commit()
+    def stolen_tg(token, chat_id, text, media_paths, buttons_json):
+        Post.query.filter_by(id=post_id).update({'locked_by': 'worker-2'})
+        db.session.commit()
+        return 2, None
+    monkeypatch.setattr(services, 'tg_send_service', stolen_tg)
+
+    publish_claimed_post(post_id)
+    post = db.session.get(Post, post_id)
+    assert post.status == 'publishing' and post.locked_by == 'worker-2'
+    assert post.platform_info == {}
+
+def test_fanout_merges_results(app, auth_client, monkeypatch):
+    """Параллельная отправка в две платформы: результаты и ошибки сводятся, а токен,
+    обновленный внутри отправки, сохраняется (каждый поток работает со своей сессией)."""
+    import threading
+    client, user = auth_client
+    app.config['PUBLISH_MAX_RETRIES'] = 0
+    post_id = _make_post(user)
+
+    threads = set()
+    def fake_tg(token, chat_id, text, media_paths, buttons_json):
+        threads.add(threading.get_ident())
+        return 555, None
+    def fake_max(tokens, chat_id, text):
+        threads.add(threading.get_ident())
+        # Как обновление токена OK при ошибке 102: меняет токены и делает commit
+        tokens.max_token = 'max-refreshed'
+        db.session.commit()
+        return None, 'Chat not found'
+    monkeypatch.setattr(services, 'tg_send_service', fake_tg)
+    monkeypatch.setattr(services, 'max_send_service', fake_max)
+
+    publish_claimed_post(post_id)
+    assert threading.get_ident() not in threads
+
+    db.session.expire_all()
+    post = db.session.get(Post, post_id)
+    assert post.status == 'partial'
+    assert post.platform_info == {'buttons': [], 'tg_msg_id': 555}
+    assert post.error_message == 'MAX: Chat not found'
+    assert SocialTokens.query.filter_by(project_id=user.current_project_id).one().max_token == 'max-refreshed'
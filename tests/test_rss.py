@@ -0,0 +1,208 @@
+# tests/test_rss.py
+import io
+from datetime import datetime, timedelta
+from app import db
+from app.models import RssSource, Post
+from app import services_rss
+
+FEED = b"""<?xml version="1.0"?><rss version="2.0"><channel><title>t</title>
+<item><title>Second</title><link>https://example.com/2</link><guid>https://example.com/2</guid></item>
+<item><title>First</title><link>https://example.com/1</link><guid>https://example.com/1</guid></item>
+</channel></rss>"""
+
+class _Raw:
+    connection = None
+    def __init__(self, content):
+        self._body = io.BytesIO(content)
+    def read1(self, size, decode_content=None):
+        return self._body.read(size)
+
+class _Resp:
+    def __init__(self, status, content=b'', headers=None, url='https://example.com/feed'):
+        self.status_code = status
+        self.raw = _Raw(content)
+        self.headers = headers or {}
+        self.url = url
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(response=self)
+
+def test_conditional_get(app, auth_client, monkeypatch):
+    """Валидаторы ленты сохраняются и отправляются; на 304 лента не разбирается и посты не создаются."""
+    client, user = auth_client
+    source = RssSource(user_id=user.id, project_id=user.current_project_id, name='s',
+                       url='https://example.com/feed', last_guid='https://example.com/1',
+                       next_poll_at=datetime.utcnow())
+    db.session.add(source)
+    db.session.commit()
+
+    sent = []
+    responses = [_Resp(200, FEED, {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}),
+                 _Resp(304)]
+    def fake_get(url, headers=None, **kwargs):
+        sent.append(headers)
+        return responses.pop(0)
+    monkeypatch.setattr(services_rss.http_client, 'get', fake_get)
+
+    services_rss.parse_rss_feeds()
+    db.session.refresh(source)
+    assert (source.etag, source.last_guid, source.last_status) == ('"v1"', 'https://example.com/2', 200)
+    assert Post.query.count() == 1
+
+    source.next_poll_at = datetime.utcnow()
+    db.session.commit()
+    services_rss.parse_rss_feeds()
+    assert sent[1] == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+    db.session.refresh(source)
+    assert source.last_status == 304
+    assert Post.query.count() == 1
+
+def test_fetch_limits(app, monkeypatch):
+    """Ленты скачиваются параллельно с лимитом на хост; слишком большая лента отклоняется."""
+    import time
+    import threading
+    app.config['RSS_FETCH_PER_HOST'] = 2
+    app.config['RSS_MAX_FEED_BYTES'] = 100
+    active, peak = {}, {}
+    lock = threading.Lock()
+
+    def fake_get(url, **kwargs):
+        host = url.split('/')[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+        return _Resp(200, b'x' * (1000 if 'big' in url else 10), url=url)
+    monkeypatch.setattr(services_rss.http_client, 'get', fake_get)
+
+    groups = {i: [RssSource(id=i, url=f'https://{"a" if i < 6 else "b"}.example/{"big" if i == 7 else i}')]
+              for i in range(8)}
+    results = services_rss.fetch_feeds(groups)
+
+    assert peak['a.example'] == 2
+    assert results[0]['content'] == b'x' * 10
+    assert 'error' in results[7] and 'error' not in results[6]
+
+def test_fetch_deadline_stalled_server(app):
+    """Зависший сервер: лимит времени держится и до заголовков, и на «капающем» теле, без повторов."""
+    import socket
+    import threading
+    import time
+    import pytest
+    app.config['RSS_FETCH_DEADLINE_SECONDS'] = 1
+    app.config['RSS_READ_TIMEOUT'] = 10
+
+    def serve(listener, trickle):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            accepted.append(conn)
+            conn.recv(4096)
+            if trickle:
+                conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n")
+                try:
+                    for _ in range(20):
+                        conn.sendall(b"x")
+                        time.sleep(0.2)
+                except OSError:
+                    pass
+
+    for trickle in (False, True):
+        accepted = []
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        threading.Thread(target=serve, args=(listener, trickle), daemon=True).start()
+        started = time.monotonic()
+        try:
+            with pytest.raises(Exception):
+                services_rss.fetch_feed(f'http://127.0.0.1:{listener.getsockname()[1]}/feed')
+        finally:
+            listener.close()
+        assert time.monotonic() - started < 2
+        assert len(accepted) == 1
+        for conn in accepted:
+            conn.close()
+
+def test_poll_schedule(app, auth_client, monkeypatch):
+    """Опрашиваются только ленты, которым подошло время; интервал следует частоте публикаций и растет после ошибок."""
+    import feedparser
+    client, user = auth_client
+    now = datetime.utcnow()
+    due = RssSource(user_id=user.id, url='https://a.example/feed', next_poll_at=now - timedelta(seconds=1),
+                    poll_interval=900)
+    later = RssSource(user_id=user.id, url='https://b.example/feed', next_poll_at=now + timedelta(hours=1))
+    legacy = RssSource(user_id=user.id, url='https://c.example/feed')
+    db.session.add_all([due, later, legacy])
+    db.session.commit()
+
+    fetched = []
+    monkeypatch.setattr(services_rss, 'fetch_feeds',
+                        lambda groups: {key: fetched.append(sources[0].url) or {'status': 500, 'error': 'boom'}
+                                        for key, sources in groups.items()})
+    services_rss.parse_rss_feeds()
+    assert fetched == ['https://a.example/feed']
+    # Лента без расписания получила срок в пределах интервала по умолчанию
+    assert now < legacy.next_poll_at <= now + timedelta(minutes=15, seconds=1)
+    # Ошибка: 900 * 2 сек. (±10%), сам интервал не меняется
+    assert due.error_count == 1 and due.poll_interval == 900
+    assert timedelta(seconds=1600) < due.next_poll_at - now < timedelta(seconds=2000)
+
+    # Записи раз в 20 минут -> опрос раз в 10 минут; ошибки сбрасываются
+    feed = feedparser.parse(FEED.replace(b'<guid>', b'<pubDate>Mon, 01 Jan 2024 10:00:00 GMT</pubDate><guid>', 1)
+                                .replace(b'</item>\n<item>', b'</item><item><pubDate>Mon, 01 Jan 2024 09:40:00 GMT</pubDate>'))
+    services_rss.schedule_after_success(due, now, feed, new_count=1)
+    assert due.poll_interval == 600 and due.error_count == 0
+
+def test_shared_feed(app, auth_client, monkeypatch):
+    """Одна лента в двух проектах скачивается один раз; записи раздаются по last_guid каждого источника."""
+    client, user = auth_client
+    now = datetime.utcnow()
+    first = RssSource(user_id=user.id, url='https://Example.com/feed', last_guid='https://example.com/1',
+                      next_poll_at=now)
+    second = RssSource(user_id=user.id, url='https://example.com:443/feed#top', last_guid='https://example.com/0',
+                       next_poll_at=now + timedelta(minutes=10))
+    db.session.add_all([first, second])
+    db.session.commit()
+
+    feed = FEED.replace(b'</item>', b'<enclosure url="https://example.com/pic.jpg" type="image/jpeg"/></item>')
+    requests_made, images = [], []
+    monkeypatch.setattr(services_rss.http_client, 'get',
+                        lambda url, **kw: requests_made.append(url) or _Resp(200, feed, {'ETag': '"v1"'}))
+    monkeypatch.setattr(services_rss, 'download_image', lambda url, project_id: images.append(url) or None)
+
+    services_rss.parse_rss_feeds()
+
+    assert len(requests_made) == 1
+    assert images == ['https://example.com/pic.jpg']
+    # Первому источнику — одна новая запись, второму — обе
+    assert Post.query.count() == 3
+    assert first.last_guid == second.last_guid == 'https://example.com/2'
+    assert first.next_poll_at == second.next_poll_at
+
+def test_rss_posts_go_to_queue(app, auth_client, monkeypatch):
+    """RSS только создает посты (одной транзакцией на источник); VK-only посты забирает очередь."""
+    from app.services_queue import claim_due_posts
+    client, user = auth_client
+    source = RssSource(user_id=user.id, project_id=user.current_project_id, url='https://example.com/feed',
+                       last_guid='https://example.com/0', publish_to_vk=True, vk_group_id=1,
+                       next_poll_at=datetime.utcnow())
+    db.session.add(source)
+    db.session.commit()
+    monkeypatch.setattr(services_rss.http_client, 'get', lambda url, **kw: _Resp(200, FEED))
+
+    services_rss.parse_rss_feeds()
+
+    posts = Post.query.order_by(Post.id).all()
+    assert [p.text_vk.split('\n')[0] for p in posts] == ['First', 'Second']
+    assert all(p.status == 'scheduled' for p in posts)
+    assert sorted(claim_due_posts('worker', limit=10)) == [p.id for p in posts]
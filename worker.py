@@ -0,0 +1,35 @@
+# worker.py
+"""
+Отдельный процесс публикации постов.
+
+Запуск:
+    python worker.py             # один процесс
+    python worker.py -n 4        # четыре процесса на этом хосте
+
+Воркеров можно запускать на нескольких хостах одновременно: посты забираются
+из таблицы posts через SELECT ... FOR UPDATE SKIP LOCKED (нужен PostgreSQL).
+В конфиге веб-приложения при этом должно быть PUBLISH_WORKER_ENABLED=true.
+"""
+import argparse
+import multiprocessing
+
+def _run():
+    # Приложение создаем внутри процесса, чтобы не делить соединения с БД после fork
+    from app import create_app
+    from app.services_queue import run_worker
+
+    app = create_app(start_scheduler=False)
+    run_worker(app)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Воркер публикации постов')
+    parser.add_argument('-n', '--processes', type=int, default=1,
+                        help='Количество процессов-воркеров на этом хосте')
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        _run()
+    else:
+        procs = [multiprocessing.Process(target=_run) for _ in range(args.processes)]
+        for p in procs: p.start()
+        for p in procs: p.join()